@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+生成用于性能测试的合成书籍.
+"""
+import os
+import random
+import zlib
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+         'elit', 'sed', 'do', 'eiusmod', 'tempor', '魔法', '少女', '第', '章',
+         'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>{title}</title>
+<style>p {{ margin: 0 }}</style>
+<script>var tracker = {{"page": "{title}"}};</script>
+</head>
+<body>
+<nav class="menu"><a href="/">home</a> <a href="/forum">forum</a></nav>
+{content}
+<div class="ad" style="display:none"><script>showAd();</script></div>
+</body>
+</html>
+"""
+
+
+def _png(width, payload):
+    """
+    生成一个带有合法PNG文件头的图片, 内容由 payload 决定.
+    """
+    header = b'\x89PNG\r\n\x1a\n'
+    ihdr = b'IHDR' + width.to_bytes(4, 'big') * 2 + b'\x08\x02\x00\x00\x00'
+    ihdr_chunk = len(ihdr[4:]).to_bytes(4, 'big') + ihdr + \
+        zlib.crc32(ihdr).to_bytes(4, 'big')
+    idat = b'IDAT' + payload
+    idat_chunk = len(payload).to_bytes(4, 'big') + idat + \
+        zlib.crc32(idat).to_bytes(4, 'big')
+    return header + ihdr_chunk + idat_chunk
+
+
+def _paragraph(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    text = ' '.join(words)
+    # 加入一些会被清理掉的属性和标签
+    return '<p class="text" style="color: red" data-id="%d">%s <span title="s">%s</span>&nbsp;<br></p>' % (
+        rng.randint(0, 1000), text, rng.choice(WORDS))
+
+
+def _nest(rng, inner, depth):
+    for level in range(depth):
+        tag = rng.choice(['div', 'section', 'div', 'td'])
+        inner = '<%s class="level%d" id="n%d">%s</%s>' % (
+            tag, level, rng.randint(0, 10 ** 6), inner, tag)
+    return inner
+
+
+def generate_book(directory, chapters=50, chapter_size=20000, depth=4,
+                  images_per_chapter=4, duplicate_ratio=0.5, image_size=4096, seed=0):
+    """
+    在 directory 中生成一本合成书籍.
+
+    Parameters:
+        directory (str): 输出目录. 章节为 chapter_<n>.html, 图片在 images/ 中.
+        chapters (int): 章节数.
+        chapter_size (int): 每章正文的大约字符数.
+        depth (int): 正文外层嵌套的标签层数.
+        images_per_chapter (int): 每章的图片数.
+        duplicate_ratio (float): 图片中引用公共图片(横幅, 分隔线等)的比例.
+        image_size (int): 每张图片的大约字节数.
+        seed (int): 随机数种子, 相同参数生成的书籍完全相同.
+
+    Returns:
+        list: 章节文件相对于 directory 的路径, 按章节顺序排列.
+    """
+    rng = random.Random(seed)
+    image_dir = os.path.join(directory, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    shared_images = []
+    for n in range(4):
+        name = 'shared_%d.png' % n
+        with open(os.path.join(image_dir, name), 'wb') as f:
+            f.write(_png(64 + n, bytes(rng.getrandbits(8) for _ in range(image_size))))
+        shared_images.append(name)
+    chapter_files = []
+    unique_image_number = 0
+    for chapter_number in range(chapters):
+        paragraphs = []
+        length = 0
+        while length < chapter_size:
+            paragraph = _paragraph(rng, rng.randint(200, 600))
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        for _ in range(images_per_chapter):
+            if rng.random() < duplicate_ratio:
+                name = rng.choice(shared_images)
+            else:
+                # 一半的图片没有后缀, 需要根据内容判断类型
+                name = 'unique_%d%s' % (unique_image_number, rng.choice(['.png', '']))
+                unique_image_number += 1
+                with open(os.path.join(image_dir, name), 'wb') as f:
+                    f.write(_png(32, bytes(rng.getrandbits(8) for _ in range(image_size))))
+            position = rng.randint(0, len(paragraphs))
+            paragraphs.insert(position, '<img src="images/%s" alt="x" class="pic">' % name)
+        content = _nest(rng, '\n'.join(paragraphs), depth)
+        file_name = 'chapter_%d.html' % chapter_number
+        with open(os.path.join(directory, file_name), 'w', encoding='utf-8') as f:
+            f.write(PAGE_TEMPLATE.format(title='第%d章' % chapter_number, content=content))
+        chapter_files.append(file_name)
+    return chapter_files
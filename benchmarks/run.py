@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+html2epub 的性能测试.
+
+在临时目录中生成一本合成书籍, 用本地http服务器代替真实网站, 分别测量清理, 转换和打包各阶段的耗时,
+吞吐量和内存峰值. 结果可以保存为基准, 之后的运行与基准比较, 发现性能退化.
+
+用法:
+    python -m benchmarks.run                    # 运行并与 benchmarks/baseline.json 比较
+    python -m benchmarks.run --save-baseline    # 运行并保存为新的基准
+    python -m benchmarks.run --chapters 200 --images-per-chapter 10 --output result.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import html2epub
+from html2epub import chapter
+from html2epub import clean
+
+from . import corpus
+from .server import LocalServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+STAGES = ('clean', 'html_to_xhtml', 'create_chapter_from_string', 'create_chapter_from_file',
+          'create_chapter_from_url', 'create_chapters_from_urls', 'add_chapter', 'create_epub')
+
+
+class _Recorder():
+    """
+    记录每个阶段的耗时, 处理的项目数和字节数, 以及(可选的)内存峰值.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, items, size):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        result = {'seconds': elapsed, 'items': items,
+                  'items_per_second': items / elapsed if elapsed else None,
+                  'mb_per_second': size / 1e6 / elapsed if elapsed else None}
+        if self.trace_memory:
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1] - start_memory
+        self.results[name] = result
+
+
+def run_pipeline(book_dir, chapter_files, base_url, recorder, work_dir):
+    """
+    依次运行所有阶段, 每个阶段处理整本书.
+    """
+    paths = [os.path.join(book_dir, name) for name in chapter_files]
+    urls = [base_url + name for name in chapter_files]
+    raw = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            raw.append(f.read())
+    size = sum(len(s.encode('utf-8')) for s in raw)
+    count = len(raw)
+
+    with recorder.stage('clean', count, size):
+        cleaned = [clean.clean(s) for s in raw]
+    with recorder.stage('html_to_xhtml', count, size):
+        for s in cleaned:
+            clean.html_to_xhtml(s)
+    del cleaned
+
+    session = html2epub.Session()
+    factory = chapter.ChapterFactory(session=session)
+    with recorder.stage('create_chapter_from_string', count, size):
+        for s, url in zip(raw, urls):
+            factory.create_chapter_from_string(s, url=url)
+    with recorder.stage('create_chapter_from_file', count, size):
+        for path, url in zip(paths, urls):
+            factory.create_chapter_from_file(path, url=url)
+    with recorder.stage('create_chapter_from_url', count, size):
+        for url in urls:
+            factory.create_chapter_from_url(url)
+    with recorder.stage('create_chapters_from_urls', count, size):
+        chapters = list(factory.create_chapters_from_urls(urls))
+
+    epub = html2epub.Epub('benchmark', epub_dir=os.path.join(work_dir, 'book'),
+                          session=session)
+    with recorder.stage('add_chapter', count, size):
+        for c in chapters:
+            epub.add_chapter(c)
+    del chapters
+    output_directory = os.path.join(work_dir, 'out')
+    os.makedirs(output_directory, exist_ok=True)
+    with recorder.stage('create_epub', count, size):
+        epub_path = epub.create_epub(output_directory)
+    os.remove(epub_path)
+    session.close()
+
+
+def run(config, repeat=3, trace_memory=True):
+    """
+    生成书籍并运行测试.
+
+    Parameters:
+        config (dict): corpus.generate_book 的参数.
+        repeat (int): 计时的次数, 每个阶段取最短的一次.
+        trace_memory (bool): 是否额外运行一次以测量内存峰值. tracemalloc 会拖慢运行, 所以不和计时一起进行.
+
+    Returns:
+        dict: 每个阶段的测试结果.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        book_dir = os.path.join(temp_dir, 'www')
+        chapter_files = corpus.generate_book(book_dir, **config)
+        stages = {}
+        with LocalServer(book_dir) as server:
+            for n in range(repeat):
+                recorder = _Recorder()
+                with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+                    run_pipeline(book_dir, chapter_files, server.base_url, recorder, work_dir)
+                for name, result in recorder.results.items():
+                    if name not in stages or result['seconds'] < stages[name]['seconds']:
+                        stages[name] = result
+            if trace_memory:
+                recorder = _Recorder(trace_memory=True)
+                tracemalloc.start()
+                try:
+                    with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+                        run_pipeline(book_dir, chapter_files, server.base_url, recorder, work_dir)
+                finally:
+                    tracemalloc.stop()
+                for name, result in recorder.results.items():
+                    stages[name]['peak_memory'] = result['peak_memory']
+    return stages
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基准比较.
+
+    Parameters:
+        results (dict): 本次运行的结果.
+        baseline (dict): 保存的基准.
+        tolerance (float): 允许的相对退化, 例如 0.25 表示慢25%或内存多25%以内不算退化.
+
+    Returns:
+        list: 发生退化的 (阶段, 指标, 基准值, 本次值).
+    """
+    regressions = []
+    for name, base in baseline['stages'].items():
+        current = results['stages'].get(name)
+        if current is None:
+            continue
+        for metric in ('seconds', 'peak_memory'):
+            if base.get(metric) and current.get(metric) is not None \
+                    and current[metric] > base[metric] * (1 + tolerance):
+                regressions.append((name, metric, base[metric], current[metric]))
+    return regressions
+
+
+def _print_table(results, baseline=None):
+    print('%-28s %10s %10s %10s %12s %8s' %
+          ('stage', 'seconds', 'items/s', 'MB/s', 'peak KiB', 'vs base'))
+    for name in STAGES:
+        result = results['stages'].get(name)
+        if result is None:
+            continue
+        ratio = ''
+        if baseline is not None and name in baseline['stages']:
+            ratio = '%.2fx' % (result['seconds'] / baseline['stages'][name]['seconds'])
+        peak = result.get('peak_memory')
+        print('%-28s %10.4f %10.1f %10.2f %12s %8s' % (
+            name, result['seconds'], result['items_per_second'] or 0,
+            result['mb_per_second'] or 0, '-' if peak is None else '%d' % (peak // 1024), ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='html2epub benchmarks')
+    parser.add_argument('--chapters', type=int, default=50)
+    parser.add_argument('--chapter-size', type=int, default=20000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--images-per-chapter', type=int, default=4)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc pass')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    config = {'chapters': args.chapters, 'chapter_size': args.chapter_size,
+              'depth': args.depth, 'images_per_chapter': args.images_per_chapter,
+              'duplicate_ratio': args.duplicate_ratio, 'seed': args.seed}
+    results = {'config': config, 'python': sys.version.split()[0],
+               'stages': run(config, args.repeat, not args.no_memory)}
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print('baseline was recorded with a different corpus, not comparing')
+            baseline = None
+    _print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('baseline saved to %s' % args.baseline)
+        return 0
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g' % (name, metric, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
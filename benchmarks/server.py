@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+代替真实网站的本地http服务器.
+"""
+import functools
+import http.server
+import threading
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    extensions_map = dict(http.server.SimpleHTTPRequestHandler.extensions_map,
+                          **{'.html': 'text/html; charset=utf-8'})
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer():
+    """
+    在后台线程中提供 directory 中的静态文件.
+
+    Parameters:
+        directory (str): 网站根目录.
+
+    Attributes:
+        base_url (str): 服务器地址, 以 / 结尾.
+    """
+
+    def __init__(self, directory):
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), functools.partial(_QuietHandler, directory=directory))
+        self._server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d/' % self._server.server_port
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
@@ -2,3 +2,11 @@ from .chapter import create_chapter_from_string
 from .chapter import create_chapter_from_file
 from .chapter import create_chapter_from_url
 from .epub import Epub
+from .session import Session
+from .cache import HttpCache
+from .scheduler import FetchScheduler
+from .stats import BuildStats
+from .image import ImageOptimizer
+from .crawl import Crawler
+from .crawl import SiteAdapter
+from .crawl import SelectorAdapter
@@ -0,0 +1,144 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import asyncio
+import collections
+import concurrent.futures
+import functools
+
+# Local modules
+from . import chapter
+from . import constants
+
+
+class AsyncChapterFactory():
+    """
+    ChapterFactory 的asyncio版本. 获取网页和清理html都在线程池(或 ChapterFactory 的进程池)中进行,
+    不会阻塞事件循环. 同时进行的章节数量受 max_concurrency 限制, 等待中的协程可以随时取消.
+
+    Parameters:
+        factory (Option[ChapterFactory]): 实际创建章节的 ChapterFactory, 为None时使用默认设置创建一个.
+        max_concurrency (Option[int]): 同时获取和处理的最大章节数.
+    """
+
+    def __init__(self, factory=None, max_concurrency=constants.DEFAULT_CHAPTER_WORKERS):
+        if factory is None:
+            factory = chapter.ChapterFactory()
+        self.factory = factory
+        self.max_concurrency = max_concurrency
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency)
+        # 在事件循环中第一次使用时创建
+        self._semaphore = None
+
+    async def _run(self, function, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(function, *args))
+
+    async def create_chapter_from_url(self, url, title=None):
+        """
+        见 ChapterFactory.create_chapter_from_url.
+        """
+        return await self._run(self.factory.create_chapter_from_url, url, title)
+
+    async def create_chapter_from_file(self, file_name, url=None, title=None):
+        """
+        见 ChapterFactory.create_chapter_from_file.
+        """
+        return await self._run(self.factory.create_chapter_from_file, file_name, url, title)
+
+    async def create_chapter_from_string(self, html_string, url=None, title=None):
+        """
+        见 ChapterFactory.create_chapter_from_string.
+        """
+        return await self._run(self.factory.create_chapter_from_string, html_string, url, title)
+
+    async def create_chapters_from_urls(self, urls, errors=None):
+        """
+        并发地从多个URL创建chapter对象, 按输入顺序逐个返回. 见 ChapterFactory.create_chapters_from_urls.
+
+        Parameters:
+            urls (iterable): 网页地址, 或 (url, title) 元组.
+            errors (Option[list]): 用于收集失败项的列表, 每个失败项为 (序号, 输入项, 异常).
+                为None时, 在返回所有成功的章节之后触发 ChapterBatchError.
+
+        Yields:
+            Chapter: 按输入顺序排列的chapter对象.
+        """
+        def start(item):
+            if isinstance(item, str):
+                return asyncio.ensure_future(self.create_chapter_from_url(item))
+            return asyncio.ensure_future(self.create_chapter_from_url(*item))
+        pending = collections.deque()
+        batch_errors = []
+        items = iter(enumerate(urls))
+        try:
+            while True:
+                # 保持最多 2 * max_concurrency 个任务, 其余的等待时才开始
+                for index, item in items:
+                    pending.append((index, item, start(item)))
+                    if len(pending) >= self.max_concurrency * 2:
+                        break
+                if not pending:
+                    break
+                index, item, task = pending.popleft()
+                try:
+                    c = await task
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if errors is not None:
+                        errors.append((index, item, e))
+                    else:
+                        batch_errors.append((index, item, e))
+                    continue
+                yield c
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+        if batch_errors:
+            raise chapter.ChapterBatchError(batch_errors)
+
+    def close(self):
+        """
+        关闭线程池.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncEpub():
+    """
+    Epub 的asyncio版本. 下载图片, 写入章节和打包都在线程池中进行, 章节按调用 add_chapter 的顺序写入.
+
+    Parameters:
+        epub (Epub): 实际生成epub的对象.
+    """
+
+    def __init__(self, epub):
+        self.epub = epub
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args))
+
+    async def add_chapter(self, c):
+        """
+        见 Epub.add_chapter. 章节中的图片由 Epub 的线程池并发下载.
+        """
+        return await self._run(self.epub.add_chapter, c)
+
+    async def create_epub(self, output_directory=None, epub_name=None):
+        """
+        见 Epub.create_epub.
+        """
+        try:
+            return await self._run(self.epub.create_epub, output_directory, epub_name)
+        finally:
+            self._executor.shutdown(wait=False)
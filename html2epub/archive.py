@@ -0,0 +1,237 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import copy
+import os
+import shutil
+import time
+import zipfile
+import zlib
+
+# Local modules
+from . import constants
+from . import parallel
+
+
+def _read_chunks(f, size, chunk_size=1024 * 1024):
+    """
+    从文件的当前位置分块读取 size 个字节.
+    """
+    while size > 0:
+        chunk = f.read(min(chunk_size, size))
+        if not chunk:
+            raise EOFError('unexpected end of zip file')
+        size -= len(chunk)
+        yield chunk
+
+
+def compress_type_for(arcname):
+    """
+    Parameters:
+        arcname (str): 文件在epub中的路径.
+
+    Returns:
+        int: 该文件的压缩方式. constants.STORED_EXTENSIONS 中的文件已经压缩过, 不再压缩.
+    """
+    extension = arcname.rsplit('.', 1)[-1].lower() if '.' in arcname else ''
+    if extension in constants.STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _deflate_file(file_name, compress_level):
+    """
+    在线程池中读取并压缩一个文件.
+
+    Returns:
+        int: 原内容的CRC.
+        int: 原内容的字节数.
+        bytes: 压缩后的内容(raw deflate).
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+class EpubArchive():
+    """
+    以zip格式写入epub文件. 创建时首先写入不压缩的 mimetype, 之后的文件按写入顺序直接写入zip,
+    不需要先在临时目录中生成整本书. 每个文件按路径选择压缩方式, 见 compress_type_for.
+
+    Parameters:
+        output (str or file-like): epub文件的路径, 或任何可写的二进制文件对象(例如 io.BytesIO).
+            文件对象不需要支持 seek.
+        compress_level (Option[int]): 压缩文本文件(xhtml, css, opf 等)的级别, 0-9.
+        compress_workers (Option[int]): write_directory 同时压缩文件的最大线程数.
+            write_bytes, write_text, write_chunks 和 write_file 在调用的线程中直接压缩, 不使用线程池.
+    """
+
+    def __init__(self, output, compress_level=constants.DEFAULT_COMPRESS_LEVEL,
+                 compress_workers=constants.DEFAULT_COMPRESS_WORKERS):
+        self.output = output
+        self.compress_level = compress_level
+        self.compress_workers = compress_workers
+        self._zip = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        with open(os.path.join(constants.EPUB_TEMPLATES_DIR, 'mimetype'), 'rb') as f:
+            self.write_bytes('mimetype', f.read(), zipfile.ZIP_STORED)
+
+    def _zip_info(self, arcname, compress_type=None):
+        if compress_type is None:
+            compress_type = compress_type_for(arcname)
+        zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zip_info.compress_type = compress_type
+        zip_info._compresslevel = self.compress_level
+        zip_info.external_attr = 0o644 << 16
+        return zip_info
+
+    def write_bytes(self, arcname, data, compress_type=None):
+        """
+        写入一个文件.
+
+        Parameters:
+            arcname (str): 文件在epub中的路径.
+            data (bytes): 文件内容.
+            compress_type (Option[int]): zipfile 的压缩方式, 为None时按路径选择.
+        """
+        self._zip.writestr(self._zip_info(arcname, compress_type), data)
+
+    def write_text(self, arcname, text):
+        """
+        以utf-8编码写入一个文本文件.
+
+        Parameters:
+            arcname (str): 文件在epub中的路径.
+            text (str): 文件内容.
+        """
+        self.write_bytes(arcname, text.encode('utf-8'))
+
+    def write_chunks(self, arcname, chunks, buffer_size=64 * 1024):
+        """
+        以utf-8编码逐块写入一个文本文件, 例如 jinja2 模板的 generate() 结果.
+
+        Parameters:
+            arcname (str): 文件在epub中的路径.
+            chunks (iterable): 文件内容的字符串块.
+            buffer_size (Option[int]): 积累到这么多字符后才写入一次.
+        """
+        with self._zip.open(self._zip_info(arcname), 'w') as dst:
+            buffer = []
+            buffered = 0
+            for chunk in chunks:
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= buffer_size:
+                    dst.write(''.join(buffer).encode('utf-8'))
+                    buffer = []
+                    buffered = 0
+            if buffer:
+                dst.write(''.join(buffer).encode('utf-8'))
+
+    def write_file(self, file_name, arcname, compress_type=None):
+        """
+        将本地文件写入epub.
+
+        Parameters:
+            file_name (str): 本地文件路径.
+            arcname (str): 文件在epub中的路径.
+            compress_type (Option[int]): zipfile 的压缩方式, 为None时按路径选择.
+        """
+        with open(file_name, 'rb') as src, \
+                self._zip.open(self._zip_info(arcname, compress_type), 'w') as dst:
+            shutil.copyfileobj(src, dst)
+
+    def _list_directory(self, directory):
+        for dir_path, dir_names, file_names in os.walk(directory):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.startswith('.'):
+                    continue
+                full_name = os.path.join(dir_path, file_name)
+                arcname = os.path.relpath(full_name, directory).replace(os.sep, '/')
+                if arcname != 'mimetype':
+                    yield full_name, arcname
+
+    def write_directory(self, directory):
+        """
+        将目录中的所有文件按路径顺序写入epub, 目录中的 mimetype 和以 . 开头的文件(例如未完成的下载)会被跳过.
+        需要压缩的文件在线程池中同时压缩, 按路径顺序写入. 不需要压缩的文件在写入时直接复制.
+
+        Parameters:
+            directory (str): epub的根目录.
+        """
+        def compress(item):
+            full_name, arcname = item
+            if compress_type_for(arcname) == zipfile.ZIP_STORED:
+                return None
+            return _deflate_file(full_name, self.compress_level)
+        for _, (full_name, arcname), result, error in parallel.map_ordered(
+                compress, self._list_directory(directory), self.compress_workers):
+            if error is not None:
+                raise error
+            if result is None or len(result[2]) >= result[1]:
+                # 不需要压缩, 或压缩后反而更大
+                self.write_file(full_name, arcname, zipfile.ZIP_STORED)
+            else:
+                self._write_deflated(arcname, *result)
+
+    def _write_deflated(self, arcname, crc, file_size, compressed):
+        """
+        写入在其它线程中压缩好的文件, CRC和大小已经算好, 直接写入本地文件头和压缩后的数据.
+        """
+        zip_info = self._zip_info(arcname, zipfile.ZIP_DEFLATED)
+        zip_info.CRC = crc
+        zip_info.file_size = file_size
+        zip_info.compress_size = len(compressed)
+        self._write_raw(zip_info, (zip_info.FileHeader(), compressed))
+
+    def _write_raw(self, zip_info, raw_chunks):
+        """
+        写入一个已经编码好的zip条目(本地文件头 + 压缩后的数据 + 可能存在的数据描述符).
+        zipfile 没有提供这样的公开接口, 这里按 ZipFile._open_to_write 的方式维护它的内部状态.
+
+        Parameters:
+            zip_info (zipfile.ZipInfo): 条目的信息, header_offset 会被改为在新文件中的位置.
+            raw_chunks (iterable): 条目的原始字节, 可以分块给出.
+        """
+        zip_file = self._zip
+        with zip_file._lock:
+            if zip_file._seekable:
+                zip_file.fp.seek(zip_file.start_dir)
+            zip_info.header_offset = zip_file.fp.tell()
+            zip_file._writecheck(zip_info)
+            zip_file._didModify = True
+            for chunk in raw_chunks:
+                zip_file.fp.write(chunk)
+            zip_file.start_dir = zip_file.fp.tell()
+            zip_file.filelist.append(zip_info)
+            zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def copy_entries(self, source, exclude=()):
+        """
+        将另一个epub中的条目原样复制过来, 不解压也不重新压缩.
+
+        Parameters:
+            source (str): 源epub文件的路径.
+            exclude (Option[iterable]): 不复制的条目路径.
+        """
+        exclude = set(exclude)
+        with zipfile.ZipFile(source) as source_zip, open(source, 'rb') as f:
+            zip_infos = sorted(source_zip.infolist(),
+                               key=lambda zip_info: zip_info.header_offset)
+            # 每个条目一直延续到下一个条目的文件头(最后一个条目到zip的目录), 包括数据描述符
+            entry_ends = [zip_info.header_offset for zip_info in zip_infos[1:]]
+            entry_ends.append(source_zip.start_dir)
+            for zip_info, entry_end in zip(zip_infos, entry_ends):
+                if zip_info.filename in exclude:
+                    continue
+                f.seek(zip_info.header_offset)
+                self._write_raw(copy.copy(zip_info), _read_chunks(
+                    f, entry_end - zip_info.header_offset))
+
+    def close(self):
+        """
+        写入zip的目录并关闭. 传入的文件对象不会被关闭.
+        """
+        self._zip.close()
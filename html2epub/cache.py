@@ -0,0 +1,375 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Third party modules
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Local modules
+from . import constants
+
+
+# 缓存中保存的响应头. 响应内容保存的是解压后的内容, 所以不能保存 Content-Encoding 和 Content-Length
+_CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control')
+
+
+def _max_age(cache_control):
+    """
+    Parameters:
+        cache_control (Option[str]): 响应的 Cache-Control.
+
+    Returns:
+        Option[float]: 响应允许不重新验证的秒数, no-cache 时为0, 没有限制时为None.
+    """
+    max_age = None
+    for directive in (cache_control or '').lower().split(','):
+        name, _, value = directive.strip().partition('=')
+        if name == 'no-cache':
+            return 0.0
+        if name == 'max-age':
+            try:
+                max_age = max(float(value.strip().strip('"')), 0.0)
+            except ValueError:
+                return 0.0
+    return max_age
+
+
+class _CacheEntry():
+    """
+    缓存中的一条记录.
+
+    Attributes:
+        url (str): 请求的url.
+        headers (dict): 缓存的响应头.
+        stored_at (float): 最近一次从服务器获取或验证的时间.
+        body_path (str): 响应内容所在的文件.
+    """
+
+    def __init__(self, url, headers, stored_at, body_path):
+        self.url = url
+        self.headers = headers
+        self.stored_at = stored_at
+        self.body_path = body_path
+
+    def is_fresh(self, ttl):
+        """
+        Parameters:
+            ttl (Option[float]): 缓存允许不重新验证的最长秒数.
+
+        Returns:
+            bool: 是否可以不重新验证直接使用. 响应的 Cache-Control 更严格时以响应为准.
+        """
+        if not ttl:
+            return False
+        max_age = _max_age(self.headers.get('Cache-Control'))
+        if max_age is not None:
+            ttl = min(ttl, max_age)
+        return time.time() - self.stored_at < ttl
+
+    def validators(self):
+        """
+        Returns:
+            dict: 用于条件请求的请求头.
+        """
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_response(self, stream=False):
+        """
+        Parameters:
+            stream (Option[bool]): 为True时不读取内容, 而是在 iter_content 时从缓存文件中分块读取.
+
+        Returns:
+            requests.Response: 由缓存内容构造的响应, from_cache 属性为True.
+
+        Raises:
+            IOError: 缓存内容已被删除(例如被其它线程淘汰)时触发此 Error.
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        if stream:
+            response.raw = _CachedBody(self.body_path)
+        else:
+            with open(self.body_path, 'rb') as f:
+                response._content = f.read()
+            response._content_consumed = True
+        response.from_cache = True
+        return response
+
+
+class _CachedBody():
+    """
+    流式读取缓存内容的 raw. 读到末尾, 调用 close() 或 release_conn() 时关闭文件.
+    requests 在内容读完后关闭响应时只调用 release_conn(), 所以只打开文件会一直泄漏到垃圾回收.
+    """
+
+    def __init__(self, body_path):
+        self._file = open(body_path, 'rb')
+
+    def read(self, amt=None):
+        data = self._file.read(amt)
+        if not data:
+            self.close()
+        return data
+
+    def close(self):
+        self._file.close()
+
+    release_conn = close
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+
+class _CacheWriter():
+    """
+    分块写入一条缓存记录. 内容先写入临时文件, commit 时才替换为正式记录.
+    """
+
+    def __init__(self, cache, url, headers):
+        self.cache = cache
+        self.url = url
+        self.headers = headers
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self._file.close()
+        self.cache._commit(self)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class _CachingStream():
+    """
+    包装流式响应的 raw. 调用方读取内容的同时写入缓存, 读完时保存记录, 没有读完就关闭时放弃该记录.
+    """
+
+    def __init__(self, raw, writer):
+        self._raw = raw
+        self._writer = writer
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        for chunk in self._raw.stream(amt, decode_content=True):
+            if self._writer is not None:
+                self._writer.write(chunk)
+            yield chunk
+        if self._writer is not None:
+            self._writer.commit()
+            self._writer = None
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.discard()
+            self._writer = None
+        self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class HttpCache():
+    """
+    以url为键的持久化磁盘缓存, 章节网页和图片共用. 记录过期前直接使用缓存,
+    过期后带上 ETag/Last-Modified 发送条件请求, 总大小超过上限时删除最久没有使用的记录.
+
+    Parameters:
+        directory (str): 缓存目录, 不存在时自动创建.
+        max_size (Option[int]): 缓存内容的最大总字节数, 为None时不限制.
+        ttl (Option[float]): 记录在多少秒内不需要重新验证, 为0或None时每次都重新验证.
+            响应的 Cache-Control 中 max-age 更短或有 no-cache 时以响应为准.
+    """
+
+    def __init__(self, directory, max_size=constants.DEFAULT_CACHE_MAX_SIZE,
+                 ttl=constants.DEFAULT_CACHE_TTL):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # 记录的 meta_path -> 内容大小, 按最近使用时间从旧到新排列. 只在启动时扫描一次目录
+        self._entries = collections.OrderedDict()
+        entries = []
+        for meta_path, body_path in self._iter_entries():
+            try:
+                entries.append((os.path.getmtime(meta_path), meta_path,
+                                os.path.getsize(body_path)))
+            except OSError:
+                continue
+        for _, meta_path, size in sorted(entries):
+            self._entries[meta_path] = size
+        self._size = sum(self._entries.values())
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return (os.path.join(self.directory, key + '.json'),
+                os.path.join(self.directory, key + '.body'))
+
+    def _iter_entries(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                meta_path = os.path.join(self.directory, name)
+                yield meta_path, meta_path[:-len('.json')] + '.body'
+
+    def _write_atomic(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def load(self, url):
+        """
+        读取缓存记录, 同时更新其最近使用时间.
+
+        Parameters:
+            url (str): 请求的url.
+
+        Returns:
+            Option[_CacheEntry]: 缓存记录, 没有时为None.
+        """
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        with self._lock:
+            if meta_path in self._entries:
+                self._entries.move_to_end(meta_path)
+        return _CacheEntry(url, meta['headers'], meta['stored_at'], body_path)
+
+    def _open_writer(self, url, response):
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return None
+        headers = {name: response.headers[name]
+                   for name in _CACHED_HEADERS if name in response.headers}
+        return _CacheWriter(self, url, headers)
+
+    def _commit(self, writer):
+        meta_path, body_path = self._paths(writer.url)
+        meta = {'url': writer.url, 'headers': writer.headers, 'stored_at': time.time()}
+        with self._lock:
+            self._size -= self._entries.pop(meta_path, 0)
+            os.replace(writer.temp_path, body_path)
+            self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+            self._entries[meta_path] = writer.size
+            self._size += writer.size
+            self._evict()
+
+    def store(self, url, response):
+        """
+        保存一个状态码为200的响应.
+
+        Parameters:
+            url (str): 请求的url.
+            response (requests.Response): 服务器的响应.
+        """
+        writer = self._open_writer(url, response)
+        if writer is None:
+            return
+        try:
+            writer.write(response.content)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+
+    def wrap_stream(self, url, response):
+        """
+        使流式响应(stream=True)在被读取的同时写入缓存, 不需要把整个响应读入内存.
+        响应被完整读取后才保存该记录.
+
+        Parameters:
+            url (str): 请求的url.
+            response (requests.Response): 状态码为200且还没有读取内容的响应.
+        """
+        writer = self._open_writer(url, response)
+        if writer is not None:
+            response.raw = _CachingStream(response.raw, writer)
+
+    def refresh(self, entry, response):
+        """
+        服务器返回304时更新缓存记录的验证时间和验证信息.
+
+        Parameters:
+            entry (_CacheEntry): 发送条件请求时使用的缓存记录.
+            response (requests.Response): 服务器的304响应.
+        """
+        for name in ('ETag', 'Last-Modified', 'Cache-Control'):
+            if name in response.headers:
+                entry.headers[name] = response.headers[name]
+        entry.stored_at = time.time()
+        meta_path, _ = self._paths(entry.url)
+        meta = {'url': entry.url, 'headers': entry.headers,
+                'stored_at': entry.stored_at}
+        with self._lock:
+            if meta_path not in self._entries:
+                # 验证期间已被淘汰, 不留下没有内容的记录
+                return
+            self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def _evict(self):
+        """
+        删除最久没有使用的记录, 直到总大小不超过 max_size. 调用时必须持有 self._lock.
+        """
+        if self.max_size is None:
+            return
+        while self._size > self.max_size and self._entries:
+            meta_path, size = self._entries.popitem(last=False)
+            body_path = meta_path[:-len('.json')] + '.body'
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size -= size
+
+    def clear(self):
+        """
+        删除所有缓存记录.
+        """
+        with self._lock:
+            for meta_path, body_path in list(self._iter_entries()):
+                for path in (meta_path, body_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self._entries.clear()
+            self._size = 0
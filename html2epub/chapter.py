@@ -4,12 +4,14 @@
 # Included modules
 import html
 import codecs
-import imghdr
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import os
-import shutil
-import tempfile
-import urllib
-from urllib.parse import urljoin
+import threading
+import time
+from urllib.parse import urljoin, urlparse
 import uuid
 
 # Third party modules
@@ -19,6 +21,10 @@ from bs4 import BeautifulSoup
 
 # Local modules
 from . import clean
+from . import constants
+from . import parallel
+from . import session as _session
+from . import stats as _stats
 
 
 class NoUrlError(Exception):
@@ -34,41 +40,304 @@ class ImageErrorException(Exception):
         return 'Error downloading image from ' + self.image_url
 
 
-def get_image_type(url):
+class ChapterBatchError(Exception):
     """
-    获取图片的类型.
+    批量创建章节时, 部分章节创建失败.
+
+    Attributes:
+        errors (list): 由 (序号, 输入项, 异常) 组成的列表, 按输入顺序排列.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def __str__(self):
+        return '%d chapters could not be created: ' % len(self.errors) + ', '.join(
+            '#%d %r (%s)' % (index, item, error) for index, item, error in self.errors)
+
+
+def get_image_type(url, data=None, content_type=None):
+    """
+    获取图片的类型. 依次根据图片内容的文件头, 响应的 Content-Type 和 url 的后缀判断, 不会下载图片.
 
     Parameters:
         url(str): 图片路径.
+        data (Option[bytes]): 图片内容(至少包含文件头).
+        content_type (Option[str]): 响应头中的 Content-Type.
 
     returns:
-        str: 图片的类型名{'jpg', 'jpge', 'gif', 'png', None}
-
-    raises:
-        IOError: 图片类型不在 {'jpg', 'jpge', 'gif', 'png'} 四个类型之中
+        str: 图片的类型名{'jpg', 'jpeg', 'gif', 'png', 'webp', 'bmp', None}
     """
 
-    for ending in ['jpg', 'jpeg', 'gif' 'png']:
-        if url.endswith(ending):
+    if data:
+        for signature, image_type in constants.IMAGE_SIGNATURES:
+            if data.startswith(signature):
+                if image_type == 'webp' and data[8:12] != b'WEBP':
+                    continue
+                return image_type
+    if content_type:
+        mime_type = content_type.split(';')[0].strip().lower()
+        if mime_type in constants.IMAGE_CONTENT_TYPES:
+            return constants.IMAGE_CONTENT_TYPES[mime_type]
+    path = urlparse(url).path.lower()
+    for ending in ['jpg', 'jpeg', 'gif', 'png']:
+        if path.endswith('.' + ending):
             return ending
-    else:
+    return None
+
+
+class ImageBudget():
+    """
+    下载图片的字节数上限. 整本书的上限由所有下载线程共用, 超过上限的图片会被放弃.
+
+    Parameters:
+        max_image_bytes (Option[int]): 单张图片的最大字节数, 为None时不限制.
+        max_book_bytes (Option[int]): 整本书所有图片的最大字节数, 为None时不限制.
+    """
+
+    def __init__(self, max_image_bytes=None, max_book_bytes=None):
+        self.max_image_bytes = max_image_bytes
+        self.max_book_bytes = max_book_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Parameters:
+            size (int): 要占用的字节数.
+
+        Returns:
+            bool: 是否还在整本书的上限之内. 为False时没有占用.
+        """
+        with self._lock:
+            if self.max_book_bytes is not None and self.used + size > self.max_book_bytes:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """
+        归还没有保存到epub中的图片占用的字节数.
+
+        Parameters:
+            size (int): 要归还的字节数.
+        """
+        with self._lock:
+            self.used -= size
+
+
+class _ImageDownload():
+    """
+    一次下载到临时文件的过程. 写入时计算哈希并检查字节数上限.
+    临时文件旁边的 .validator 文件保存第一次响应的 ETag 或 Last-Modified, 继续下载时作为 If-Range 发送,
+    图片在两次下载之间改变时服务器会返回完整的新图片, 而不是把两个版本拼在一起.
+    """
+
+    def __init__(self, image_url, temp_path, budget):
+        self.image_url = image_url
+        self.temp_path = temp_path
+        self.validator_path = temp_path + '.validator'
+        self.budget = budget
+        self.hasher = hashlib.sha1()
+        self.size = 0
+
+    def write(self, f, chunk):
+        size = self.size + len(chunk)
+        if self.budget.max_image_bytes is not None and size > self.budget.max_image_bytes:
+            raise ImageErrorException(self.image_url)
+        if not self.budget.reserve(len(chunk)):
+            raise ImageErrorException(self.image_url)
+        f.write(chunk)
+        self.hasher.update(chunk)
+        self.size = size
+
+    def resume(self):
+        """
+        从上次中断时留下的临时文件继续. 无法继续时从头开始.
+        """
         try:
-            _, temp_file_name = tempfile.mkstemp()
-            urllib.request.urlretrieve(url, temp_file_name)
-            image_type = imghdr.what(temp_file_name)
-            return image_type
+            with open(self.temp_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(constants.IMAGE_CHUNK_SIZE), b''):
+                    if not self.budget.reserve(len(chunk)):
+                        raise ImageErrorException(self.image_url)
+                    self.hasher.update(chunk)
+                    self.size += len(chunk)
+        except (IOError, ImageErrorException):
+            self.reset()
+
+    def reset(self):
+        self.budget.release(self.size)
+        self.hasher = hashlib.sha1()
+        self.size = 0
+
+    def validator(self):
+        """
+        Returns:
+            Option[str]: 临时文件内容对应的 ETag 或 Last-Modified, 没有时为None.
+        """
+        try:
+            with open(self.validator_path, 'r', encoding='utf-8') as f:
+                return f.read() or None
         except IOError:
             return None
 
+    def save_validator(self, response):
+        """
+        记录从头下载的响应的验证信息. 弱 ETag 不能用于 If-Range.
+        """
+        etag = response.headers.get('ETag')
+        validator = etag if etag and not etag.startswith('W/') else \
+            response.headers.get('Last-Modified')
+        if validator:
+            with open(self.validator_path, 'w', encoding='utf-8') as f:
+                f.write(validator)
+        else:
+            self.remove_validator()
+
+    def remove_validator(self):
+        try:
+            os.remove(self.validator_path)
+        except OSError:
+            pass
+
+    def abort(self):
+        self.reset()
+        self.remove_validator()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+def _content_range_start(response):
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _stream_remote_image(download, session, stats):
+    """
+    分块下载在线图片到 download.temp_path. 连接中断时用 Range 和 If-Range 请求从已下载的位置继续,
+    没有记录验证信息时从头下载.
+
+    Returns:
+        Option[str]: 响应头中的 Content-Type.
+    """
+    if session is None:
+        session = _session.get_default_session()
+    failures = 0
+    while True:
+        headers = {}
+        if download.size:
+            validator = download.validator()
+            if validator is None:
+                download.reset()
+            else:
+                headers['Range'] = 'bytes=%d-' % download.size
+                headers['If-Range'] = validator
+        try:
+            response = session.get(download.image_url, headers=headers, stream=True)
+        except (requests.exceptions.RequestException, ValueError):
+            raise ImageErrorException(download.image_url)
+        received = 0
+        try:
+            if response.status_code == 206 and _content_range_start(response) == download.size:
+                mode = 'ab'
+            elif response.status_code == 200:
+                download.reset()
+                mode = 'wb'
+                length = response.headers.get('Content-Length')
+                max_image_bytes = download.budget.max_image_bytes
+                if length and length.isdigit() and max_image_bytes is not None \
+                        and int(length) > max_image_bytes:
+                    raise ImageErrorException(download.image_url)
+                download.save_validator(response)
+            else:
+                raise ImageErrorException(download.image_url)
+            with open(download.temp_path, mode) as f:
+                for chunk in response.iter_content(constants.IMAGE_CHUNK_SIZE):
+                    download.write(f, chunk)
+                    received += len(chunk)
+            return response.headers.get('Content-Type')
+        except requests.exceptions.RequestException:
+            failures += 1
+            if failures > constants.DEFAULT_RETRIES:
+                raise ImageErrorException(download.image_url)
+        finally:
+            response.close()
+            if stats is not None:
+                stats.record_response(response, received)
 
-def save_image(image_url, image_directory, image_name):
+
+def _stream_image(image_url, temp_path, session=None, stats=None, budget=None):
     """
-    保存在线图片到指定的路径, 可自定义文件名.
+    将图片分块写入 temp_path, 同时计算内容的哈希, 不会把整张图片读入内存.
+    temp_path 已存在时(上次下载被中断), 在线图片从中断的位置继续下载.
+
+    Parameters:
+        image_url (str): image路径, 可以是本地文件.
+        temp_path (str): 临时文件路径.
+        session (Option[requests.Session]): 下载图片用的Session, 为None时使用默认Session.
+        stats (Option[BuildStats]): 记录下载字节数和缓存命中的统计.
+        budget (Option[ImageBudget]): 字节数上限.
+
+    Raises:
+        ImageErrorException: 无法获取该图片, 无法判断图片类型或超过字节数上限时触发该 Error.
+            此时临时文件会被删除, 占用的字节数也会被归还.
+
+    Returns:
+        str: 图片内容的sha1.
+        str: 图片的类型.
+        int: 图片的字节数.
+    """
+    if budget is None:
+        budget = ImageBudget()
+    download = _ImageDownload(image_url, temp_path, budget)
+    try:
+        if os.path.exists(image_url):
+            content_type = None
+            try:
+                with open(image_url, 'rb') as src, open(temp_path, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(constants.IMAGE_CHUNK_SIZE), b''):
+                        download.write(dst, chunk)
+            except IOError:
+                raise ImageErrorException(image_url)
+        else:
+            if os.path.exists(temp_path):
+                download.resume()
+            content_type = _stream_remote_image(download, session, stats)
+        with open(temp_path, 'rb') as f:
+            header = f.read(constants.IMAGE_HEADER_SIZE)
+        image_type = get_image_type(image_url, header, content_type)
+        if image_type is None:
+            raise ImageErrorException(image_url)
+    except BaseException:
+        download.abort()
+        raise
+    download.remove_validator()
+    return download.hasher.hexdigest(), image_type, download.size
+
+
+def _part_path(image_directory, image_url):
+    """
+    下载 image_url 用的临时文件. 同一个url总是使用同一个临时文件, 以便中断后继续下载.
+    """
+    return os.path.join(image_directory,
+                        '.part-' + hashlib.sha1(image_url.encode('utf-8')).hexdigest())
+
+
+def save_image(image_url, image_directory, image_name, session=None):
+    """
+    保存在线图片到指定的路径, 可自定义文件名. 每张图片只请求一次, 图片类型根据这一次响应的内容判断.
+    图片先分块写入临时文件, 下载完成后才改名为正式文件, 失败时不会留下不完整的文件.
 
     Parameters:
         image_url (str): image路径.
         image_directory (str): 保存image的路径.
         image_name (str): image的文件名(无后缀).
+        session (Option[requests.Session]): 下载图片用的Session, 为None时使用默认Session.
 
     Raises:
         ImageErrorException: 在无法保存该图片时触发该 Error.
@@ -76,32 +345,93 @@ def save_image(image_url, image_directory, image_name):
     Returns:
         str: 图片的类型.
     """
-    image_type = get_image_type(image_url)
-    if image_type is None:
+    temp_path = _part_path(image_directory, image_url)
+    _, image_type, _ = _stream_image(image_url, temp_path, session)
+    try:
+        os.replace(temp_path, os.path.join(
+            image_directory, image_name + '.' + image_type))
+    except OSError:
         raise ImageErrorException(image_url)
-    full_image_file_name = os.path.join(
-        image_directory, image_name + '.' + image_type)
+    return image_type
 
-    # If the image is present on the local filesystem just copy it
-    if os.path.exists(image_url):
-        shutil.copy(image_url, full_image_file_name)
-        return image_type
 
+def _download_image(image_url, ebook_folder, image_name=None, session=None, stats=None,
+                    optimizer=None, budget=None):
+    """
+    将image下载到 ebook_folder 的 images 文件夹中. 不修改任何tag, 因此可以在线程池中调用.
+    图片分块写入临时文件, 完成后才改名为正式文件.
+
+    Parameters:
+        image_url (str): image的url.
+        ebook_folder (str): 将外部图片保存到本地的地址. 内部一定要包含一个名为 "images" 的文件夹.
+        image_name (Option[str]): 保存到本地的imgae的文件名(不包含后缀).
+            为None时根据图片内容的哈希命名, 内容相同的图片会保存为同一个文件.
+        session (Option[requests.Session]): 下载图片用的Session.
+        stats (Option[BuildStats]): 记录下载字节数和缓存命中的统计.
+        optimizer (Option[callable]): 保存前处理图片的函数, 以 optimizer(content, image_type) 调用,
+            返回新的 (content, image_type), 例如 image.ImageOptimizer.
+        budget (Option[ImageBudget]): 字节数上限, 超过上限的图片视为下载失败.
+
+    Returns:
+        Option[tuple]: (image本地链接地址, image的文件名, image的类型), 下载失败时为None.
+
+    Raises:
+        ValueError: ebook_folder 不存在或不包含 images 文件夹时触发此 Error.
+    """
+    image_full_path = os.path.join(ebook_folder, 'images')
+    if not os.path.exists(image_full_path):
+        raise ValueError(
+            '%s doesn\'t exist or doesn\'t contain a subdirectory images' % ebook_folder)
+    temp_path = _part_path(image_full_path, image_url)
     try:
-        # urllib.urlretrieve(image_url, full_image_file_name)
-        with open(full_image_file_name, 'wb') as f:
-            user_agent = r'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36'
-            request_headers = {'User-Agent': user_agent}
-            requests_object = requests.get(image_url, headers=request_headers)
-            try:
-                content = requests_object.content
-                # Check for empty response
+        digest, image_extension, size = _stream_image(
+            image_url, temp_path, session, stats, budget)
+    except (ImageErrorException, TypeError):
+        return None
+    if image_name is None:
+        # 按原始内容命名, 优化前相同的图片仍然只保存一次
+        image_name = 'img-' + digest
+    try:
+        if optimizer is not None:
+            with open(temp_path, 'rb') as f:
+                content = f.read()
+            start = time.perf_counter()
+            content, image_extension = optimizer(content, image_extension)
+            if stats is not None:
+                stats.record('optimize', time.perf_counter() - start)
+                stats.count('image_bytes_saved', size - len(content))
+            with open(temp_path, 'wb') as f:
                 f.write(content)
-            except AttributeError:
-                raise ImageErrorException(image_url)
+            if budget is not None:
+                budget.release(size - len(content))
+        full_image_file_name = os.path.join(
+            image_full_path, image_name + '.' + image_extension)
+        if os.path.exists(full_image_file_name):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, full_image_file_name)
     except IOError:
-        raise ImageErrorException(image_url)
-    return image_type
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return None
+    image_link = 'images' + '/' + image_name + '.' + image_extension
+    return image_link, image_name, image_extension
+
+
+def _apply_image(image_tag, image_info):
+    """
+    根据下载结果修改 image_tag: 成功时将src修改为本地src, 失败时删除该tag.
+
+    Parameters:
+        image_tag (bs4.element.Tag): bs4中包含image的tag.
+        image_info (Option[tuple]): _download_image 的返回值.
+    """
+    if image_info is None:
+        image_tag.decompose()
+    else:
+        image_tag['src'] = image_info[0]
 
 
 def _replace_image(image_url, image_tag, ebook_folder,
@@ -118,7 +448,7 @@ def _replace_image(image_url, image_tag, ebook_folder,
     Returns:
         str: image本地链接地址
         str: image的文件名(不包含后缀)
-        str: image的类型 {'jpg', 'jpge', 'gif', 'png'} .
+        str: image的类型 {'jpg', 'jpeg', 'gif', 'png', 'webp', 'bmp'} .
     """
     try:
         assert isinstance(image_tag, bs4.element.Tag)
@@ -126,21 +456,107 @@ def _replace_image(image_url, image_tag, ebook_folder,
         raise TypeError("image_tag cannot be of type " + str(type(image_tag)))
     if image_name is None:
         image_name = str(uuid.uuid4())
-    try:
-        image_full_path = os.path.join(ebook_folder, 'images')
-        assert os.path.exists(image_full_path)
-        image_extension = save_image(image_url, image_full_path,
-                                     image_name)
-        image_link = 'images' + '/' + image_name + '.' + image_extension
-        image_tag['src'] = image_link
-        return image_link, image_name, image_extension
-    except ImageErrorException:
-        image_tag.decompose()
-    except AssertionError:
-        raise ValueError(
-            '%s doesn\'t exist or doesn\'t contain a subdirectory images' % ebook_folder)
-    except TypeError:
-        image_tag.decompose()
+    image_info = _download_image(image_url, ebook_folder, image_name)
+    _apply_image(image_tag, image_info)
+    return image_info
+
+
+class ImageIndex():
+    """
+    记录一本书中已经保存的图片. 下载前按url查找, 下载后按内容(文件名中的哈希)查找,
+    同一张图片在整本书中只下载和保存一次, 在 content.opf 中也只列出一次.
+    """
+
+    def __init__(self):
+        self._by_url = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+
+    def get(self, image_url):
+        """
+        Parameters:
+            image_url (str): image的url.
+
+        Returns:
+            Option[tuple]: 已保存的 (image本地链接地址, image的文件名, image的类型), 没有时为None.
+        """
+        with self._lock:
+            return self._by_url.get(image_url)
+
+    def register(self, image_info):
+        """
+        记录一张已经在epub中的图片(例如追加章节时原有的图片), 内容相同的图片不会再次保存.
+
+        Parameters:
+            image_info (tuple): (image本地链接地址, image的文件名, image的类型).
+        """
+        with self._lock:
+            self._by_name[image_info[1]] = image_info
+
+    def add(self, image_url, image_info):
+        """
+        记录一张已保存的图片.
+
+        Parameters:
+            image_url (str): image的url.
+            image_info (tuple): _download_image 的返回值.
+
+        Returns:
+            bool: 该图片内容是否第一次出现.
+        """
+        with self._lock:
+            self._by_url[image_url] = image_info
+            if image_info[1] in self._by_name:
+                return False
+            self._by_name[image_info[1]] = image_info
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_url)
+
+    def items(self, start=0):
+        """
+        Parameters:
+            start (Option[int]): 跳过最早记录的 start 个url.
+
+        Returns:
+            list: 按记录顺序排列的 (image_url, image_info).
+        """
+        with self._lock:
+            return list(itertools.islice(self._by_url.items(), start, None))
+
+
+def get_title(root):
+    """
+    获取已解析网页中 title标签 的内容.
+
+    Parameters:
+        root (bs4.BeautifulSoup): 原始网页解析后的树.
+
+    Returns:
+        str: 网页的标题, 没有 title标签 时为 'Ebook Chapter'.
+    """
+    title_node = root.title
+    if title_node is not None:
+        return title_node.string
+    return 'Ebook Chapter'
+
+
+def _get_lxml_title(root):
+    """
+    get_title 的lxml版本.
+
+    Parameters:
+        root (lxml.html.HtmlElement): 原始网页解析后的树.
+
+    Returns:
+        str: 网页的标题, 没有 title标签 时为 'Ebook Chapter'.
+    """
+    title_node = root.find('.//title')
+    if title_node is not None:
+        return title_node.text
+    return 'Ebook Chapter'
 
 
 class Chapter():
@@ -151,23 +567,57 @@ class Chapter():
         content (str): 章节内容. 必须为xhtml格式.
         title (str): 章节标题.
         url (Option[str]): 章节所在网页的URL(如果适用), 默认情况下为None.
+        content_tree (Option[bs4.BeautifulSoup]): 已解析好的xhtml树. 提供时 content 可以为None,
+            章节内容会在第一次用到时才从该树序列化, 避免重复解析.
+        compact (Option[bool]): 从树序列化时是否使用紧凑格式, 见 clean.serialize_xhtml.
 
     Attributes:
         content (str): 章节内容.
         title (str): 章节标题.
         url (str): 章节所在网页的URL(如果适用).
+        base_url (str): 解析图片相对地址时的基准URL, 默认与 url 相同. 网页被重定向时为最终的地址.
         html_title (str): 将特殊字符替换为html安全序列的标题字符串.
     """
 
-    def __init__(self, content, title, url=None):
-        self._validate_input_types(content, title)
+    def __init__(self, content, title, url=None, content_tree=None, compact=False):
+        if content_tree is None:
+            self._validate_input_types(content, title)
+        else:
+            self._validate_title(title)
         self.title = title
-        self.content = content
-        self._content_tree = BeautifulSoup(self.content, 'html.parser')
+        self._content = content
+        self._content_tree = content_tree
+        self.compact = compact
         self.url = url
+        self.base_url = url
         self.html_title = html.escape(self.title, quote=True)
         self.imgs = []
 
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = clean.serialize_xhtml(self._content_tree, self.compact)
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        self._content_tree = None
+
+    def _get_content_tree(self):
+        if self._content_tree is None:
+            self._content_tree = BeautifulSoup(self._content, 'html.parser')
+        return self._content_tree
+
+    def _release_content_tree(self):
+        """
+        序列化章节内容后释放解析树. 之后需要时会重新从 content 解析.
+        """
+        if self._content_tree is not None:
+            if self._content is None:
+                self._content = clean.serialize_xhtml(self._content_tree, self.compact)
+            self._content_tree = None
+
     def write(self, file_name):
         """
         将chapter内容写入 xhtml文件.
@@ -187,6 +637,13 @@ class Chapter():
             assert isinstance(content, str)
         except AssertionError:
             raise TypeError('content must be a string')
+        self._validate_title(title)
+        try:
+            assert content != ''
+        except AssertionError:
+            raise ValueError('content cannot be empty string')
+
+    def _validate_title(self, title):
         try:
             assert isinstance(title, str)
         except AssertionError:
@@ -195,10 +652,6 @@ class Chapter():
             assert title != ''
         except AssertionError:
             raise ValueError('title cannot be empty string')
-        try:
-            assert content != ''
-        except AssertionError:
-            raise ValueError('content cannot be empty string')
 
     def get_url(self):
         if self.url is not None:
@@ -207,28 +660,82 @@ class Chapter():
             raise NoUrlError()
 
     def _get_image_urls(self):
-        image_nodes = self._content_tree.find_all('img')
+        image_nodes = self._get_content_tree().find_all('img')
         raw_image_urls = [node['src']
                           for node in image_nodes if node.has_attr('src')]
         full_image_urls = [urljoin(
-            self.url, image_url) for image_url in raw_image_urls]
+            self.base_url, image_url) for image_url in raw_image_urls]
         image_nodes_filtered = [
             node for node in image_nodes if node.has_attr('src')]
         return zip(image_nodes_filtered, full_image_urls)
 
-    def _replace_images_in_chapter(self, ebook_folder):
-        image_url_list = self._get_image_urls()
-        for image_tag, image_url in image_url_list:
-            imgInfo = _replace_image(
-                image_url, image_tag, ebook_folder)
-            if imgInfo != None:
+    def _replace_images_in_chapter(self, ebook_folder, executor=None, session=None,
+                                   image_index=None, stats=None, optimizer=None, budget=None):
+        """
+        下载章节中的所有图片, 并将img的src修改为本地src.
+        图片按内容命名, 同一个url只下载一次, 内容相同的图片只保存一次.
+
+        Parameters:
+            ebook_folder (str): 保存图片的地址. 内部一定要包含一个名为 "images" 的文件夹.
+            executor (Option[concurrent.futures.Executor]): 用于并发下载图片的线程池.
+                为None时逐个下载. 无论是否并发, tag的修改和 imgs 的顺序都与图片在章节中的顺序一致.
+            session (Option[requests.Session]): 下载图片用的Session.
+            image_index (Option[ImageIndex]): 整本书共用的图片索引. 为None时只在本章节内去重.
+                imgs 中只记录在该索引中第一次出现的图片.
+            stats (Option[BuildStats]): 记录下载, 去重和失败的图片数.
+            optimizer (Option[callable]): 保存前处理图片的函数, 见 _download_image.
+                与下载一起在 executor 中执行.
+            budget (Option[ImageBudget]): 图片的字节数上限, 超过上限的图片会被删除.
+        """
+        if self._content_tree is None and '<img' not in self._content:
+            # 没有图片时不必解析章节内容
+            return
+        if image_index is None:
+            image_index = ImageIndex()
+        image_url_list = list(self._get_image_urls())
+        # 每个url只下载一次, 已经保存过的url不再下载
+        image_infos = {}
+        for _, image_url in image_url_list:
+            if image_url not in image_infos:
+                image_infos[image_url] = image_index.get(image_url)
+        pending_urls = [image_url for image_url, image_info in image_infos.items()
+                        if image_info is None]
+        if executor is None:
+            for image_url in pending_urls:
+                image_infos[image_url] = _download_image(
+                    image_url, ebook_folder, session=session, stats=stats, optimizer=optimizer,
+                    budget=budget)
+        else:
+            futures = [executor.submit(_download_image, image_url, ebook_folder,
+                                       session=session, stats=stats, optimizer=optimizer,
+                                       budget=budget)
+                       for image_url in pending_urls]
+            for image_url, future in zip(pending_urls, futures):
+                image_infos[image_url] = future.result()
+        # 只在当前线程中修改树和索引
+        new_image_count = len(self.imgs)
+        for image_url in pending_urls:
+            imgInfo = image_infos[image_url]
+            if imgInfo != None and image_index.add(image_url, imgInfo):
                 img_link, img_id, img_type = imgInfo
                 img = {'link': img_link, 'id': img_id, 'type': img_type}
                 self.imgs.append(img)
-        unformatted_html_unicode_string = self._content_tree.prettify()
-        unformatted_html_unicode_string = unformatted_html_unicode_string.replace(
-            '<br>', '<br/>')
-        self.content = unformatted_html_unicode_string
+            elif imgInfo != None and budget is not None:
+                # 与已保存的图片内容相同, 不占用整本书的字节数
+                budget.release(os.path.getsize(os.path.join(ebook_folder, imgInfo[0])))
+        for image_tag, image_url in image_url_list:
+            _apply_image(image_tag, image_infos[image_url])
+        if stats is not None:
+            failed = [image_url for image_url in pending_urls if image_infos[image_url] is None]
+            saved_tags = sum(1 for _, image_url in image_url_list
+                             if image_infos[image_url] is not None)
+            new_image_count = len(self.imgs) - new_image_count
+            stats.count('images_downloaded', len(pending_urls) - len(failed))
+            stats.count('images_failed', len(failed))
+            stats.count('images_deduped', saved_tags - new_image_count)
+        if image_url_list:
+            # 树已被修改, 下次读取 content 时重新序列化
+            self._content = None
 
 
 class ChapterFactory():
@@ -237,18 +744,54 @@ class ChapterFactory():
 
     Parameters:
         clean_function (Option[function]): 用于清扫要在epub中使用的原始html 的函数. 默认情况下, 这是html2epub.clean函数.
+        engine (Option[str]): 默认清理函数所用的解析引擎, 'bs4' 或 'lxml'. 'lxml' 引擎速度更快, 需要安装lxml.
+        session (Option[requests.Session]): 获取网页用的Session, 可以与 Epub 共用. 为None时使用默认Session.
+        processes (Option[int]): 设置后, 清理html和转换xhtml会在这么多个子进程中进行, 适合与批量创建章节一起使用.
+            此时 clean_function 必须可以被 pickle, 例如模块级函数或 clean.SanitizerPolicy.
+        stats (Option[BuildStats]): 记录各阶段耗时的统计, 可以与 Epub 共用. 为None时创建一个新的.
+        executor (Option[concurrent.futures.Executor]): 批量创建章节时共用的线程池, 例如同时生成多本书时.
+            为None时每次批量创建都使用自己的线程池.
+        compact (Option[bool]): 是否以紧凑格式序列化章节, 不缩进也不换行, 章节更小, 序列化更快.
+            'lxml' 引擎的输出本来就是紧凑的.
+
+    Attributes:
+        stats (BuildStats): 该工厂的统计.
+
+    Raises:
+        ValueError: engine 不是 'bs4' 或 'lxml' 时触发此 Error.
+        NotImplementedError: 选择 'lxml' 引擎但没有安装lxml时触发此 Error.
     """
 
-    def __init__(self, clean_function=clean.clean):
+    def __init__(self, clean_function=clean.clean, engine='bs4', session=None, processes=None,
+                 stats=None, executor=None, compact=False):
+        if engine not in ('bs4', 'lxml'):
+            raise ValueError("engine must be 'bs4' or 'lxml' not %s" % engine)
+        if engine == 'lxml' and not clean.lxml_module_exists:
+            raise NotImplementedError('the lxml engine requires lxml')
         self.clean_function = clean_function
-        user_agent = r'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
-        self.request_headers = {'User-Agent': user_agent}
+        self.engine = engine
+        self.compact = compact
+        self._session = session
+        self.processes = processes
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        if stats is None:
+            stats = _stats.BuildStats()
+        self.stats = stats
+        self.executor = executor
+
+    @property
+    def session(self):
+        if self._session is None:
+            return _session.get_default_session()
+        return self._session
 
     def create_chapter_from_url(self, url, title=None):
         """
         从URL创建chapter对象. 
         从给定的url中提取网页, 使用clean_function方法对其进行清理, 并将其另存为创建的chpter的内容.
-        在执行任何javascript之前加载的基本网页.
+        在执行任何javascript之前加载的基本网页. 会跟随重定向, chapter.url 仍为给定的url,
+        图片的相对地址按重定向后的地址解析.
 
         Parameters:
             url (string): 获取chapter对象的网页地址.
@@ -258,19 +801,101 @@ class ChapterFactory():
             Chapter: 一个Chapter对象, 其内容是给定url的网页. 
 
         Raises:
-            ValueError: 如果无法连接该url则触发此 Error.
+            ValueError: 如果无法连接该url, 或者(跟随重定向后)响应的状态码不是 2xx (包括限流后放弃的 429/503)
+                则触发此 Error.
         """
+        start = time.perf_counter()
         try:
-            request_object = requests.get(
-                url, headers=self.request_headers, allow_redirects=False)
+            with self.stats.timer('fetch'):
+                request_object = self.session.get(url)
         except requests.exceptions.SSLError:
             raise ValueError("Url %s doesn't have valid SSL certificate" % url)
         except (requests.exceptions.MissingSchema,
-                requests.exceptions.ConnectionError):
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
             raise ValueError(
                 "%s is an invalid url or no network connection" % url)
+        except requests.exceptions.RequestException as e:
+            # 例如 5xx 重试用完后的 RetryError, 读取响应内容时的 ChunkedEncodingError
+            raise ValueError('%s could not be fetched: %s' % (url, e))
+        self.stats.record_response(request_object)
+        if not 200 <= request_object.status_code < 300:
+            # 错误页不能作为章节内容
+            raise ValueError('%s returned status %d' % (url, request_object.status_code))
         unicode_string = request_object.text
-        return self.create_chapter_from_string(unicode_string, url, title)
+        c = self._create_chapter(unicode_string, url, title)
+        c.base_url = request_object.url
+        return self._chapter_created(c, start)
+
+    def _create_chapters(self, create_function, items, max_workers, errors):
+        """
+        批量创建章节. 见 create_chapters_from_urls.
+        """
+        def create(item):
+            if isinstance(item, str):
+                return create_function(item)
+            return create_function(*item)
+        batch_errors = []
+        for index, item, c, error in parallel.map_ordered(
+                create, items, max_workers, self.executor):
+            if error is None:
+                yield c
+            elif errors is not None:
+                errors.append((index, item, error))
+            else:
+                batch_errors.append((index, item, error))
+        if batch_errors:
+            raise ChapterBatchError(batch_errors)
+
+    def create_chapters_from_urls(self, urls, max_workers=constants.DEFAULT_CHAPTER_WORKERS,
+                                  errors=None):
+        """
+        从多个URL并发地创建chapter对象, 按输入顺序逐个返回.
+        某个章节失败不会中断其它章节, 所有失败都会被记录下来.
+
+        Parameters:
+            urls (iterable): 网页地址, 或 (url, title) 元组. 可以是生成器.
+            max_workers (Option[int]): 同时获取和处理章节的最大线程数.
+            errors (Option[list]): 用于收集失败项的列表, 每个失败项为 (序号, 输入项, 异常).
+                为None时, 在返回所有成功的章节之后触发 ChapterBatchError.
+
+        Yields:
+            Chapter: 按输入顺序排列的chapter对象, 失败的章节会被跳过.
+
+        Raises:
+            ChapterBatchError: errors 为None且有章节创建失败时触发此 Error.
+        """
+        return self._create_chapters(self.create_chapter_from_url, urls, max_workers, errors)
+
+    def create_chapters_from_files(self, file_names, max_workers=constants.DEFAULT_CHAPTER_WORKERS,
+                                   errors=None):
+        """
+        从多个html或xhtml文件并发地创建chapter对象, 按输入顺序逐个返回.
+
+        Parameters:
+            file_names (iterable): 文件名, 或 (file_name, url, title) 元组.
+            max_workers (Option[int]): 最大线程数.
+            errors (Option[list]): 用于收集失败项的列表, 见 create_chapters_from_urls.
+
+        Yields:
+            Chapter: 按输入顺序排列的chapter对象.
+        """
+        return self._create_chapters(self.create_chapter_from_file, file_names, max_workers, errors)
+
+    def create_chapters_from_strings(self, html_strings, max_workers=constants.DEFAULT_CHAPTER_WORKERS,
+                                     errors=None):
+        """
+        从多个字符串创建chapter对象, 按输入顺序逐个返回.
+
+        Parameters:
+            html_strings (iterable): html字符串, 或 (html_string, url, title) 元组.
+            max_workers (Option[int]): 最大线程数.
+            errors (Option[list]): 用于收集失败项的列表, 见 create_chapters_from_urls.
+
+        Yields:
+            Chapter: 按输入顺序排列的chapter对象.
+        """
+        return self._create_chapters(self.create_chapter_from_string, html_strings, max_workers, errors)
 
     def create_chapter_from_file(self, file_name, url=None, title=None):
         """
@@ -285,9 +910,11 @@ class ChapterFactory():
         Returns:
             Chapter: 一个Chapter对象, 其内容是给定html或xhtml文件的内容.
         """
-        with codecs.open(file_name, 'r', encoding='utf-8') as f:
-            content_string = f.read()
-        return self.create_chapter_from_string(content_string, url, title)
+        start = time.perf_counter()
+        with self.stats.timer('read'):
+            with codecs.open(file_name, 'r', encoding='utf-8') as f:
+                content_string = f.read()
+        return self._chapter_created(self._create_chapter(content_string, url, title), start)
 
     def create_chapter_from_string(self, html_string, url=None, title=None):
         """
@@ -302,24 +929,102 @@ class ChapterFactory():
         Returns:
             Chapter: 一个Chapter对象, 其内容是给定文本的内容.
         """
-        clean_html_string = self.clean_function(html_string)
-        clean_xhtml_string = clean.html_to_xhtml(clean_html_string)
+        start = time.perf_counter()
+        return self._chapter_created(self._create_chapter(html_string, url, title), start)
 
-        if title:
-            pass
+    def _create_chapter(self, html_string, url, title):
+        if self.processes:
+            payload = self._get_process_pool().submit(
+                _build_chapter_payload, html_string, url, title,
+                self.clean_function, self.engine, self.compact).result()
+            for stage, seconds in payload.timings:
+                self.stats.record(stage, seconds)
+            return Chapter(payload.content, payload.title, payload.url, compact=self.compact)
+        return _build_chapter(html_string, url, title, self.clean_function, self.engine,
+                              self.stats, self.compact)
+
+    def _chapter_created(self, c, start):
+        """
+        记录创建一个章节的总耗时, 并产生 'chapter_created' 事件.
+        """
+        seconds = time.perf_counter() - start
+        self.stats.record('chapter', seconds)
+        self.stats.count('chapters_created')
+        self.stats.emit('chapter_created', title=c.title, url=c.url, seconds=seconds)
+        return c
+
+    def _get_process_pool(self):
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes)
+            return self._process_pool
+
+    def close(self):
+        """
+        关闭清理章节用的进程池(如果有).
+        """
+        with self._process_pool_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
+
+_ChapterPayload = collections.namedtuple(
+    '_ChapterPayload', ['content', 'title', 'url', 'timings'])
+
+
+def _build_chapter(html_string, url, title, clean_function, engine, stats, compact=False):
+    """
+    清理html并创建chapter对象, 见 ChapterFactory.create_chapter_from_string.
+    清理和转换xhtml的耗时分别记录为 stats 中的 'sanitize' 和 'xhtml' 阶段.
+    """
+    if isinstance(clean_function, clean.SanitizerPolicy):
+        policy = clean_function
+    elif clean_function is clean.clean:
+        policy = clean._default_policy
+    else:
+        policy = None
+    if policy is not None and engine == 'lxml':
+        with stats.timer('sanitize'):
+            root = clean.parse_lxml(html_string)
+            if not title:
+                title = _get_lxml_title(root)
+            root = policy.clean_lxml_tree(root)
+        with stats.timer('xhtml'):
+            content = clean.serialize_lxml_xhtml(root)
+        return Chapter(content, title, url, compact=compact)
+    with stats.timer('sanitize'):
+        if policy is not None:
+            # 默认清理函数: 只解析一次, 之后所有步骤都在同一棵树上进行
+            root = BeautifulSoup(html_string, 'html.parser')
+            if not title:
+                title = get_title(root)
+            root = policy.clean_tree(root)
         else:
-            try:
-                root = BeautifulSoup(html_string, 'html.parser')
-                title_node = root.title
-                if title_node is not None:
-                    title = title_node.string
-                else:
-                    raise ValueError
-            except (IndexError, ValueError):
-                title = 'Ebook Chapter'
-        return Chapter(clean_xhtml_string, title, url)
-
-
-create_chapter_from_url = ChapterFactory().create_chapter_from_url
-create_chapter_from_file = ChapterFactory().create_chapter_from_file
-create_chapter_from_string = ChapterFactory().create_chapter_from_string
+            clean_html_string = clean_function(html_string)
+            if not title:
+                title = get_title(BeautifulSoup(html_string, 'html.parser'))
+            root = BeautifulSoup(clean_html_string, 'html.parser')
+    with stats.timer('xhtml'):
+        root = clean.html_tree_to_xhtml(root)
+    return Chapter(None, title, url, content_tree=root, compact=compact)
+
+
+def _build_chapter_payload(html_string, url, title, clean_function, engine, compact=False):
+    """
+    在子进程中清理html. 返回只包含字符串的 _ChapterPayload, 而不是带有解析树的 Chapter,
+    这样传回主进程的数据量最小. 各阶段的耗时随结果一起传回.
+    """
+    stats = _stats.BuildStats()
+    c = _build_chapter(html_string, url, title, clean_function, engine, stats, compact)
+    with stats.timer('xhtml'):
+        content = c.content
+    timings = [(name, stage.total) for name, stage in stats.stages.items()]
+    return _ChapterPayload(content, c.title, c.url, timings)
+
+
+_default_factory = ChapterFactory()
+create_chapter_from_url = _default_factory.create_chapter_from_url
+create_chapter_from_file = _default_factory.create_chapter_from_file
+create_chapter_from_string = _default_factory.create_chapter_from_string
@@ -8,11 +8,245 @@ import re
 import bs4
 from bs4 import BeautifulSoup
 from bs4.dammit import EntitySubstitution
+from bs4.formatter import HTMLFormatter
+import soupsieve
+try:
+    import lxml.etree
+    import lxml.html
+    lxml_module_exists = True
+except ImportError:
+    lxml_module_exists = False
+try:
+    from cssselect import HTMLTranslator
+    cssselect_module_exists = True
+except ImportError:
+    cssselect_module_exists = False
 
 # Local modules
 from . import constants
 
 
+class SanitizerPolicy():
+    """
+    A compiled, picklable sanitizer. The whitelist is compiled into frozensets
+    once, and each document is cleaned in a single pass over its elements:
+
+    * tags in drop_tags, and elements matching drop_selectors, are removed
+      together with everything inside them, without visiting their contents;
+    * other tags missing from the whitelist are unwrapped in place, keeping
+      their text and children where they were;
+    * attributes missing from the whitelist are removed, and so are img tags
+      left without a src.
+
+    Unlike an arbitrary clean_function, a policy can be sent to worker
+    processes, and ChapterFactory runs it on the single-parse tree pipeline.
+
+    Parameters:
+        tag_dictionary (Option[dict]): The tag and attribute whitelist, see clean.
+        drop_tags (Option[iterable]): Tags removed with their whole subtree.
+        drop_selectors (Option[iterable]): CSS selectors of further regions to
+            remove with their whole subtree, e.g. ['nav', '.ad', '#comments'].
+            The lxml engine needs the cssselect package for these.
+    """
+
+    def __init__(self, tag_dictionary=constants.SUPPORTED_TAGS,
+                 drop_tags=constants.DROPPED_TAGS, drop_selectors=()):
+        self.tag_dictionary = tag_dictionary
+        self.allowed_attributes = {tag: frozenset(attributes)
+                                   for tag, attributes in tag_dictionary.items()}
+        self.drop_tags = frozenset(drop_tags)
+        self.drop_selectors = tuple(drop_selectors)
+        self._compiled_selectors = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_compiled_selectors'] = {}
+        return state
+
+    def __call__(self, input_string):
+        return clean(input_string, policy=self)
+
+    def _bs4_selector(self):
+        if not self.drop_selectors:
+            return None
+        if 'bs4' not in self._compiled_selectors:
+            self._compiled_selectors['bs4'] = soupsieve.compile(
+                ', '.join(self.drop_selectors))
+        return self._compiled_selectors['bs4']
+
+    def _lxml_selector(self):
+        if not self.drop_selectors:
+            return None
+        if 'lxml' not in self._compiled_selectors:
+            if not cssselect_module_exists:
+                raise NotImplementedError(
+                    'drop_selectors with the lxml engine require cssselect')
+            translator = HTMLTranslator()
+            self._compiled_selectors['lxml'] = lxml.etree.XPath(' | '.join(
+                translator.css_to_xpath(selector, prefix='self::')
+                for selector in self.drop_selectors))
+        return self._compiled_selectors['lxml']
+
+    def clean_tree(self, root):
+        """
+        Sanitizes a tree parsed with bs4, see clean_tree.
+        """
+        allowed_attributes = self.allowed_attributes
+        drop_tags = self.drop_tags
+        selector = self._bs4_selector()
+        article_tag = root.find('article')
+        if article_tag is not None:
+            root = article_tag
+        seen_html = False
+        stack = [n for n in root.contents if isinstance(n, bs4.element.Tag)]
+        while stack:
+            current_node = stack.pop()
+            name = current_node.name
+            if name in drop_tags or (selector is not None and selector.match(current_node)):
+                _bs4_remove(current_node, keep_contents=False)
+                continue
+            attributes = allowed_attributes.get(name)
+            if attributes is None:
+                child_node_list = [n for n in current_node.contents
+                                   if isinstance(n, bs4.element.Tag)]
+                _bs4_remove(current_node, keep_contents=True)
+                stack.extend(child_node_list)
+                continue
+            attribute_dict = current_node.attrs
+            if attribute_dict:
+                for attribute in [a for a in attribute_dict if a not in attributes]:
+                    del attribute_dict[attribute]
+            if name == 'img' and 'src' not in attribute_dict:
+                _bs4_remove(current_node, keep_contents=False)
+                continue
+            if name == 'html':
+                seen_html = True
+            stack.extend(n for n in current_node.contents
+                         if isinstance(n, bs4.element.Tag))
+        # wrap partial tree if necessary
+        if not seen_html:
+            root = create_html_from_fragment(root)
+        return root
+
+    def clean_lxml_tree(self, root):
+        """
+        Sanitizes a tree parsed with parse_lxml, see clean_lxml_tree.
+        """
+        allowed_attributes = self.allowed_attributes
+        drop_tags = self.drop_tags
+        selector = self._lxml_selector()
+        article_tag = root.find('.//article')
+        if article_tag is not None:
+            root = article_tag
+            stack = [n for n in root if isinstance(n.tag, str)]
+        else:
+            stack = [root]
+        while stack:
+            current_node = stack.pop()
+            name = current_node.tag
+            if name in drop_tags or (selector is not None and selector(current_node)):
+                current_node.drop_tree()
+                continue
+            child_node_list = [n for n in current_node if isinstance(n.tag, str)]
+            attributes = allowed_attributes.get(name)
+            if attributes is None:
+                # keeps the text, the tail and the children in place
+                current_node.drop_tag()
+                stack.extend(child_node_list)
+                continue
+            attribute_dict = current_node.attrib
+            if attribute_dict:
+                for attribute in [a for a in attribute_dict if a not in attributes]:
+                    del attribute_dict[attribute]
+            if name == 'img' and 'src' not in attribute_dict:
+                current_node.drop_tree()
+                continue
+            stack.extend(child_node_list)
+        # wrap partial tree if necessary
+        if root.tag != 'html':
+            root.tail = None
+            fragment = root
+            root = lxml.html.document_fromstring(
+                '<html><head></head><body></body></html>')
+            root.find('body').append(fragment)
+        elif root.find('head') is None:
+            root.insert(0, lxml.html.Element('head'))
+        return root
+
+
+def _bs4_remove(node, keep_contents):
+    """
+    Removes a bs4 tag, either with everything inside it or keeping its
+    contents in its place. Strings that end up next to each other are merged,
+    so that prettify does not put a line break, and thus a space, between
+    them.
+    """
+    parent = node.parent
+    index = parent.index(node)
+    if keep_contents:
+        count = len(node.contents)
+        node.unwrap()
+    else:
+        count = 0
+        node.decompose()
+    contents = parent.contents
+    for boundary in sorted({index, index + count}, reverse=True):
+        if 0 < boundary < len(contents):
+            before, after = contents[boundary - 1], contents[boundary]
+            if type(before) is bs4.element.NavigableString \
+                    and type(after) is bs4.element.NavigableString:
+                after.extract()
+                before.replace_with(before + after)
+
+
+_default_policy = SanitizerPolicy()
+
+
+def _get_policy(tag_dictionary):
+    if tag_dictionary is constants.SUPPORTED_TAGS:
+        return _default_policy
+    return SanitizerPolicy(tag_dictionary)
+
+
+class _XHTMLFormatter(HTMLFormatter):
+    """
+    Writes singleton tags as <br /> while the tree is serialized, so the
+    output needs no string fixups afterwards. In compact mode, runs of
+    whitespace in text are also collapsed to a single space, except inside
+    preformatted tags, and whitespace between the declaration, the doctype
+    and the html element is dropped.
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r\f]+')
+
+    def __init__(self, compact=False):
+        super().__init__(entity_substitution=EntitySubstitution.substitute_xml,
+                         void_element_close_prefix=' /')
+        self.compact = compact
+
+    def substitute(self, ns):
+        if self.compact and type(ns) is bs4.element.NavigableString \
+                and ('\n' in ns or '  ' in ns or '\t' in ns or '\r' in ns) \
+                and not _in_preformatted(ns):
+            if isinstance(ns.parent, BeautifulSoup) and not ns.strip():
+                return ''
+            ns = self._whitespace.sub(' ', ns)
+        return super().substitute(ns)
+
+
+def _in_preformatted(node):
+    parent = node.parent
+    while parent is not None:
+        if parent.name in constants.PREFORMATTED_TAGS:
+            return True
+        parent = parent.parent
+    return False
+
+
+_pretty_formatter = _XHTMLFormatter()
+_compact_formatter = _XHTMLFormatter(compact=True)
+
+
 def create_html_from_fragment(tag):
     """
     Creates full html tree from a fragment. Assumes that tag should be wrapped in a body and is currently not
@@ -40,12 +274,13 @@ def create_html_from_fragment(tag):
 
 
 def clean(input_string,
-          tag_dictionary=constants.SUPPORTED_TAGS):
+          tag_dictionary=constants.SUPPORTED_TAGS, policy=None, compact=False):
     """
     Sanitizes HTML. Tags not contained as keys in the tag_dictionary input are
-    removed, and child nodes are recursively moved to parent of removed node.
-    Attributes not contained as arguments in tag_dictionary are removed.
-    Doctype is set to <!DOCTYPE html>.
+    removed, and their text and child nodes are kept in their place. Tags in
+    constants.DROPPED_TAGS, such as script and style, are removed together
+    with their contents. Attributes not contained as arguments in
+    tag_dictionary are removed. Doctype is set to <!DOCTYPE html>.
 
     Parameters:
         input_string (basestring): A (possibly unicode) string representing HTML.
@@ -54,6 +289,10 @@ def clean(input_string,
             isn't contained, it will be removed. By default, this is set to
             use the supported tags and attributes for the Amazon Kindle,
             as found at https://kdp.amazon.com/help?topicId=A1JPUWCSD6F59O
+        policy (Option[SanitizerPolicy]): A compiled policy to use instead of
+            tag_dictionary.
+        compact (Option[bool]): Serialize without indentation, see
+            serialize_xhtml.
 
     Returns:
         str: A (possibly unicode) string representing HTML.
@@ -65,41 +304,28 @@ def clean(input_string,
         assert isinstance(input_string, str)
     except AssertionError:
         raise TypeError
+    if policy is None:
+        policy = _get_policy(tag_dictionary)
     root = BeautifulSoup(input_string, 'html.parser')
-    article_tag = root.find_all('article')
-    if article_tag:
-        root = article_tag[0]
-    stack = root.findAll(True, recursive=False)
-    while stack:
-        current_node = stack.pop()
-        child_node_list = current_node.findAll(True, recursive=False)
-        if current_node.name not in tag_dictionary.keys():
-            parent_node = current_node.parent
-            current_node.extract()
-            for n in child_node_list:
-                parent_node.append(n)
-        else:
-            attribute_dict = current_node.attrs
-            for attribute in list(attribute_dict.keys()):
-                if attribute not in tag_dictionary[current_node.name]:
-                    attribute_dict.pop(attribute)
-        stack.extend(child_node_list)
-    # wrap partial tree if necessary
-    if root.find_all('html') == []:
-        root = create_html_from_fragment(root)
-    # Remove img tags without src attribute
-    image_node_list = root.find_all('img')
-    for node in image_node_list:
-        if not node.has_attr('src'):
-            node.extract()
-    unformatted_html_unicode_string = root.prettify()
-    # fix <br> tags since not handled well by default by bs4
-    unformatted_html_unicode_string = unformatted_html_unicode_string.replace(
-        '<br>', '<br/>')
-    # remove &nbsp; and replace with space since not handled well by certain e-readers
-    unformatted_html_unicode_string = unformatted_html_unicode_string.replace(
-        '&nbsp;', ' ')
-    return unformatted_html_unicode_string
+    root = policy.clean_tree(root)
+    return serialize_xhtml(root, compact)
+
+
+def clean_tree(root,
+               tag_dictionary=constants.SUPPORTED_TAGS):
+    """
+    Sanitizes an already parsed HTML tree. Same rules as clean, but operates
+    on the tree so that callers can chain further tree stages without
+    serializing and parsing the document again.
+
+    Parameters:
+        root (bs4.BeautifulSoup): A parsed HTML document. May be modified in place.
+        tag_dictionary (Option[dict]): The tag and attribute whitelist, see clean.
+
+    Returns:
+        bs4.BeautifulSoup: A tree representing a full html document.
+    """
+    return _get_policy(tag_dictionary).clean_tree(root)
 
 
 def condense(input_string):
@@ -125,12 +351,14 @@ def condense(input_string):
     return removed_trailing_whitespace
 
 
-def html_to_xhtml(html_unicode_string):
+def html_to_xhtml(html_unicode_string, compact=False):
     """
     Converts html to xhtml
 
     Parameters:
         html_unicode_string: A (possible unicode) string representing HTML.
+        compact (Option[bool]): Serialize without indentation, see
+            serialize_xhtml.
 
     Returns:
         A (possibly unicode) string representing XHTML.
@@ -143,18 +371,144 @@ def html_to_xhtml(html_unicode_string):
     except AssertionError:
         raise TypeError
     root = BeautifulSoup(html_unicode_string, 'html.parser')
+    root = html_tree_to_xhtml(root)
+    return serialize_xhtml(root, compact)
+
+
+def html_tree_to_xhtml(root):
+    """
+    Converts a parsed html tree to xhtml in place
+
+    Parameters:
+        root: A bs4.BeautifulSoup representing a full html document.
+
+    Returns:
+        The same bs4.BeautifulSoup, ready to be serialized as XHTML.
+
+    Raises:
+        ValueError: Raised if root is a fragment.
+    """
     # Confirm root node is html
     try:
         assert root.html is not None
     except AssertionError:
         raise ValueError(''.join(['html_unicode_string cannot be a fragment.',
-                                  'string is the following: %s', root]))
+                                  'string is the following: %s', str(root)]))
     # Add xmlns attribute to html node
     root.html['xmlns'] = 'http://www.w3.org/1999/xhtml'
-    unicode_string = root.prettify()
-    # Close singleton tag_dictionary
-    for tag in constants.SINGLETON_TAG_LIST:
-        unicode_string = unicode_string.replace(
-            '<' + tag + '/>',
-            '<' + tag + ' />')
-    return unicode_string
+    return root
+
+
+def serialize_xhtml(root, compact=False):
+    """
+    Serializes a tree produced by clean_tree and html_tree_to_xhtml in a
+    single pass. Singleton tags are self-closed by the formatter as they are
+    written, so the result needs no further string fixups.
+
+    Parameters:
+        root: A bs4.BeautifulSoup representing a full xhtml document.
+        compact (Option[bool]): If True, the tree is written without the
+            indentation and line breaks added by prettify, and runs of
+            whitespace in text are collapsed to a single space outside of
+            preformatted tags. The rendered text is the same, but chapters
+            are smaller and serialize faster.
+
+    Returns:
+        str: A unicode string representing XHTML.
+    """
+    if compact:
+        return root.decode(formatter=_compact_formatter)
+    return root.prettify(formatter=_pretty_formatter)
+
+
+# lxml does not accept unicode strings that start with an encoding declaration
+_XML_DECLARATION = re.compile(r'^\ufeff?\s*<\?xml[^>]*\?>')
+
+
+def parse_lxml(input_string):
+    """
+    Parses HTML into an lxml tree. Empty documents yield an empty html tree
+    instead of raising, matching the behaviour of the bs4 engine.
+
+    Parameters:
+        input_string (str): A unicode string representing HTML.
+
+    Returns:
+        lxml.html.HtmlElement: The html element of the parsed document.
+
+    Raises:
+        TypeError: Raised if input_string isn't a unicode string or string.
+        NotImplementedError: Raised if lxml is not installed.
+    """
+    try:
+        assert isinstance(input_string, str)
+    except AssertionError:
+        raise TypeError
+    if not lxml_module_exists:
+        raise NotImplementedError('the lxml engine requires lxml')
+    # the string is already decoded, so the declaration carries no information
+    input_string = _XML_DECLARATION.sub('', input_string, count=1)
+    try:
+        return lxml.html.document_fromstring(input_string)
+    except lxml.etree.ParserError:
+        return lxml.html.document_fromstring('<html><head></head><body></body></html>')
+
+
+def clean_lxml_tree(root,
+                    tag_dictionary=constants.SUPPORTED_TAGS):
+    """
+    lxml counterpart of clean_tree. Applies exactly the same whitelist rules,
+    so documents sanitized by either engine are equivalent.
+
+    Parameters:
+        root (lxml.html.HtmlElement): The html element returned by parse_lxml.
+            May be modified in place.
+        tag_dictionary (Option[dict]): The tag and attribute whitelist, see clean.
+
+    Returns:
+        lxml.html.HtmlElement: The html element of a full html document.
+    """
+    return _get_policy(tag_dictionary).clean_lxml_tree(root)
+
+
+def serialize_lxml_xhtml(root):
+    """
+    Serializes a tree produced by clean_lxml_tree as XHTML. Singleton tags are
+    self-closed by the serializer, other empty elements get an explicit end tag.
+
+    Parameters:
+        root (lxml.html.HtmlElement): The html element of a full html document.
+
+    Returns:
+        str: A unicode string representing XHTML.
+    """
+    singleton_tags = set(constants.SINGLETON_TAG_LIST)
+    for node in root.iter():
+        if (isinstance(node.tag, str) and node.text is None
+                and len(node) == 0 and node.tag not in singleton_tags):
+            node.text = ''
+    root.set('xmlns', 'http://www.w3.org/1999/xhtml')
+    return lxml.etree.tostring(root, encoding='unicode', method='xml')
+
+
+def clean_lxml(input_string,
+               tag_dictionary=constants.SUPPORTED_TAGS):
+    """
+    Sanitizes HTML with lxml and returns XHTML. This is a drop-in alternative
+    to running clean and html_to_xhtml one after the other, and is much faster
+    on large documents since parsing and serializing happen in C.
+
+    Parameters:
+        input_string (str): A unicode string representing HTML.
+        tag_dictionary (Option[dict]): The tag and attribute whitelist, see clean.
+
+    Returns:
+        str: A unicode string representing XHTML.
+
+    Raises:
+        TypeError: Raised if input_string isn't a unicode string or string.
+        NotImplementedError: Raised if lxml is not installed.
+    """
+    root = parse_lxml(input_string)
+    root = clean_lxml_tree(root, tag_dictionary)
+    return serialize_lxml_xhtml(root)
@@ -0,0 +1,285 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+html2epub 的命令行入口.
+
+从网页或文件生成一本书:
+    html2epub build -t TITLE [-o OUTPUT_DIRECTORY] SOURCE [SOURCE ...]
+
+按清单同时生成多本书:
+    html2epub batch MANIFEST [-o OUTPUT_DIRECTORY] [--jobs N]
+
+清单是一个json文件, 可以是书的列表, 也可以是 {"output_directory": ..., "books": [...]}. 每本书为:
+    {"title": "书名", "creator": "作者", "language": "zh", "name": "文件名(不含.epub)",
+     "chapters": ["https://...", "chapter.html", {"url": "https://...", "title": "章节名"}, {"file": "..."}]}
+除 title 和 chapters 外都可以省略. 以 http:// 或 https:// 开头的章节是网页, 其它的是本地文件.
+
+使用 --build-dir 时每本书的章节和图片先写入其中的子目录, 并记录已完成的章节. 构建中断后重新运行
+同样的命令会从第一个未完成的章节继续, 成功后删除该子目录.
+
+所有书共用一个Session(以及 --cache-dir 指定的缓存), 一个获取章节的线程池和一个下载图片的线程池.
+章节和图片的请求都经过同一个按站点限速的调度器, 见 --rate, --burst 和 --max-in-flight.
+结束时在标准输出打印json格式的结果, 包含每本书的路径, 耗时, 统计和失败的章节.
+全部成功时返回0, 有失败的书或章节时返回1.
+"""
+
+# Included modules
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import time
+
+# Local modules
+from . import cache as _cache
+from . import chapter
+from . import constants
+from . import epub as _epub
+from . import image
+from . import scheduler as _scheduler
+from . import session as _session
+from . import stats as _stats
+
+
+def _source_kind(source):
+    """
+    Returns:
+        tuple: (类型, 网址或文件名, 章节名), 类型为 'url' 或 'file'.
+    """
+    if isinstance(source, dict):
+        if 'url' in source:
+            return 'url', source['url'], source.get('title')
+        if 'file' in source:
+            return 'file', source['file'], source.get('title')
+        raise ValueError('chapter must have a url or a file: %r' % source)
+    if source.startswith('http://') or source.startswith('https://'):
+        return 'url', source, None
+    return 'file', source, None
+
+
+def _chapter_key(index, source):
+    """
+    Returns:
+        str: 章节在构建日志中的标识, 由章节在清单中的序号和来源组成.
+    """
+    return '%d %s' % (index, source)
+
+
+class _Builder():
+    """
+    共用的Session, 线程池和设置, 用来生成一本或多本书.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        cache = None
+        if options.cache_dir:
+            cache = _cache.HttpCache(options.cache_dir, ttl=options.cache_ttl)
+        self.scheduler = _scheduler.FetchScheduler(
+            rate=options.rate, burst=options.burst, max_in_flight=options.max_in_flight)
+        self.session = _session.Session(
+            pool_size=max(options.workers + options.image_workers, constants.DEFAULT_POOL_SIZE),
+            cache=cache, scheduler=self.scheduler)
+        self.chapter_executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.workers)
+        self.image_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=options.image_workers)
+        self.optimizer = None
+        if options.max_image_dimension or options.image_quality or options.convert_images:
+            convert = dict(pair.split(':') for pair in options.convert_images or [])
+            self.optimizer = image.ImageOptimizer(
+                options.max_image_dimension,
+                options.image_quality or constants.DEFAULT_IMAGE_QUALITY, convert)
+
+    def _callback(self, title):
+        if not self.options.verbose:
+            return None
+
+        def callback(event, fields):
+            fields = dict(fields, event=event, book=title)
+            sys.stderr.write(json.dumps(fields, ensure_ascii=False, default=str) + '\n')
+        return callback
+
+    def build(self, book, output_directory):
+        """
+        生成一本书.
+
+        Parameters:
+            book (dict): 清单中的一本书.
+            output_directory (str): 默认的输出目录.
+
+        Returns:
+            dict: 这本书的结果.
+        """
+        start = time.perf_counter()
+        title = book.get('title')
+        result = {'title': title, 'path': None, 'chapters': 0, 'failed_chapters': []}
+        epub = None
+        build_dir = None
+        try:
+            if not title:
+                raise ValueError('book must have a title')
+            output_directory = book.get('output_directory', output_directory)
+            os.makedirs(output_directory, exist_ok=True)
+            stats = _stats.BuildStats(self._callback(title))
+            if self.options.build_dir:
+                build_dir = os.path.join(self.options.build_dir,
+                                         _epub._file_name(book.get('name') or title))
+            factory = chapter.ChapterFactory(
+                engine=self.options.engine, session=self.session, stats=stats,
+                executor=self.chapter_executor, compact=self.options.compact)
+            epub = _epub.Epub(
+                title, book.get('creator', 'zzZ5'), book.get('language', 'en'),
+                book.get('rights', ''), book.get('publisher', 'zzZ5'),
+                session=self.session, stats=stats, image_optimizer=self.optimizer,
+                max_image_bytes=self.options.max_image_bytes,
+                max_book_image_bytes=self.options.max_book_image_bytes,
+                image_executor=self.image_executor, build_dir=build_dir,
+                compress_level=self.options.compress_level)
+
+            def create(index, kind, source, chapter_title):
+                if kind == 'url':
+                    c = factory.create_chapter_from_url(source, chapter_title)
+                else:
+                    c = factory.create_chapter_from_file(source, title=chapter_title)
+                return _chapter_key(index, source), c
+            errors = []
+            # 恢复中断的构建时跳过已经完成的章节
+            sources = [(index,) + _source_kind(source)
+                       for index, source in enumerate(book.get('chapters', []))]
+            sources = [item for item in sources
+                       if not epub.has_chapter(_chapter_key(item[0], item[2]))]
+            for key, c in factory._create_chapters(create, sources, self.options.workers, errors):
+                epub.add_chapter(c, key)
+            result['failed_chapters'] = [
+                {'index': item[0], 'source': item[2], 'error': str(error)}
+                for _, item, error in errors]
+            result['chapters'] = len(epub.chapters)
+            if not epub.chapters:
+                raise ValueError('no chapters could be created')
+            result['path'] = epub.create_epub(output_directory, book.get('name'))
+            result['stats'] = stats.as_dict()
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        finally:
+            # 失败的书不会调用 create_epub, 临时目录和下载的图片要在这里删除. 构建目录保留, 用于恢复
+            if epub is not None and build_dir is None:
+                shutil.rmtree(epub.EPUB_DIR, ignore_errors=True)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    def close(self):
+        self.chapter_executor.shutdown()
+        self.image_executor.shutdown()
+        self.session.close()
+
+
+def _load_manifest(manifest_path):
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        return manifest, None
+    return manifest['books'], manifest.get('output_directory')
+
+
+def _run(books, options):
+    start = time.perf_counter()
+    builder = _Builder(options)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            results = list(executor.map(
+                lambda book: builder.build(book, options.output_dir), books))
+    finally:
+        builder.close()
+    summary = {
+        'books': results,
+        'built': sum(1 for result in results if result['path'] is not None),
+        'failed': sum(1 for result in results if result['path'] is None),
+        'failed_chapters': sum(len(result['failed_chapters']) for result in results),
+        'throttled': dict(builder.scheduler.throttled),
+        'seconds': time.perf_counter() - start,
+    }
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if options.summary:
+        with open(options.summary, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+    return 1 if summary['failed'] or summary['failed_chapters'] else 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='html2epub', description='将 html链接, html文件 或 html文本 转换成 epub文件.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-o', '--output-dir', default='.', help='epub文件的输出目录')
+    common.add_argument('--cache-dir', help='http缓存目录, 所有书共用')
+    common.add_argument('--cache-ttl', type=float, default=constants.DEFAULT_CACHE_TTL,
+                        help='缓存记录在多少秒内不需要重新验证, 默认每次都向服务器验证')
+    common.add_argument('--engine', choices=('bs4', 'lxml'), default='bs4', help='清理html的解析引擎')
+    common.add_argument('--workers', type=int, default=constants.DEFAULT_CHAPTER_WORKERS,
+                        help='获取章节的线程数')
+    common.add_argument('--image-workers', type=int, default=constants.DEFAULT_IMAGE_WORKERS,
+                        help='下载图片的线程数')
+    common.add_argument('--rate', type=float, help='每个站点每秒最多发起的请求数, 默认不限制')
+    common.add_argument('--burst', type=int, default=1, help='每个站点空闲后最多可以连续发起的请求数')
+    common.add_argument('--max-in-flight', type=int, default=constants.DEFAULT_HOST_MAX_IN_FLIGHT,
+                        help='每个站点同时进行的最大请求数, 从较小的值开始按延迟逐渐提高')
+    common.add_argument('--max-image-bytes', type=int, help='单张图片的最大字节数')
+    common.add_argument('--max-book-image-bytes', type=int, help='每本书图片的最大总字节数')
+    common.add_argument('--max-image-dimension', type=int, help='缩小图片到最长边不超过该像素数(需要Pillow)')
+    common.add_argument('--image-quality', type=int, help='重新压缩图片的质量(需要Pillow)')
+    common.add_argument('--convert-images', nargs='*', metavar='FROM:TO',
+                        help='转换图片格式, 例如 png:jpeg (需要Pillow)')
+    common.add_argument('--build-dir',
+                        help='可恢复的构建目录, 每本书一个子目录. 中断后重新运行同样的命令会跳过已完成的章节')
+    common.add_argument('--compact', action='store_true', help='章节不缩进也不换行, 文件更小')
+    common.add_argument('--compress-level', type=int, choices=range(10),
+                        default=constants.DEFAULT_COMPRESS_LEVEL, metavar='0-9',
+                        help='压缩章节等文本文件的级别, 图片不再压缩')
+    common.add_argument('--summary', help='同时将结果写入该json文件')
+    common.add_argument('-v', '--verbose', action='store_true', help='在标准错误输出中打印进度事件')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', parents=[common], help='从网页或文件生成一本书')
+    build.add_argument('sources', nargs='+', metavar='SOURCE', help='章节的网址或文件, 按章节顺序')
+    build.add_argument('-t', '--title', required=True)
+    build.add_argument('--creator', default='zzZ5')
+    build.add_argument('--language', default='en')
+    build.add_argument('--publisher', default='zzZ5')
+    build.add_argument('--rights', default='')
+    build.add_argument('--name', help='epub的文件名(不含.epub), 默认为书名')
+
+    batch = subparsers.add_parser('batch', parents=[common], help='按json清单同时生成多本书')
+    batch.add_argument('manifest')
+    batch.add_argument('-j', '--jobs', type=int, default=4, help='同时生成的书的数量')
+    return parser
+
+
+def main(argv=None):
+    """
+    命令行入口.
+
+    Parameters:
+        argv (Option[list]): 命令行参数, 为None时使用 sys.argv.
+
+    Returns:
+        int: 退出码.
+    """
+    options = _parser().parse_args(argv)
+    if options.command == 'build':
+        book = {'title': options.title, 'creator': options.creator,
+                'language': options.language, 'publisher': options.publisher,
+                'rights': options.rights, 'chapters': options.sources}
+        if options.name:
+            book['name'] = options.name
+        options.jobs = 1
+        return _run([book], options)
+    books, output_directory = _load_manifest(options.manifest)
+    if output_directory is not None and options.output_dir == '.':
+        options.output_dir = output_directory
+    return _run(books, options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
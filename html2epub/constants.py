@@ -51,6 +51,22 @@ SUPPORTED_TAGS = {
     'ul': ['class', 'id'],
     'var': []
 }
+# 清理html时连同其内容整个删除的标签. 其它不在 SUPPORTED_TAGS 中的标签只删除标签本身, 保留其中的文字和子标签
+DROPPED_TAGS = [
+    'button',
+    'canvas',
+    'embed',
+    'iframe',
+    'noscript',
+    'object',
+    'script',
+    'select',
+    'style',
+    'svg',
+    'template',
+    'textarea',
+    'title',
+]
 SINGLETON_TAG_LIST = [
     'area',
     'base',
@@ -66,6 +82,69 @@ SINGLETON_TAG_LIST = [
     'param',
     'source',
 ]
+# 紧凑序列化时保留空白的标签
+PREFORMATTED_TAGS = frozenset(['pre', 'textarea'])
+# 图片文件头与图片类型的对应关系, 用于从下载的内容判断图片类型
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'RIFF', 'webp'),
+    (b'BM', 'bmp'),
+]
+IMAGE_HEADER_SIZE = 32
+# 分块下载和复制图片时每块的字节数
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_CONTENT_TYPES = {
+    'image/jpeg': 'jpeg',
+    'image/jpg': 'jpeg',
+    'image/pjpeg': 'jpeg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+    'image/bmp': 'bmp',
+}
+# 所有请求共用的 User-Agent
+USER_AGENT = r'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36'
+# Session 的默认连接池大小, 重试次数, 退避系数和超时(秒)
+DEFAULT_POOL_SIZE = 16
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 30
+# FetchScheduler 的默认设置: 每个站点开始时和最大的并发请求数, 健康的请求延迟(秒), 最长的退避时间(秒),
+# 以及表示请求过多需要退避的状态码
+DEFAULT_HOST_INITIAL_IN_FLIGHT = 2
+DEFAULT_HOST_MAX_IN_FLIGHT = 8
+DEFAULT_TARGET_LATENCY = 2.0
+DEFAULT_MAX_BACKOFF = 120
+THROTTLE_STATUS_CODES = (429, 503)
+# HttpCache 的默认大小上限(字节)和记录不需要重新验证的时间(秒). 目录页和章节会更新, 默认每次都重新验证
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_CACHE_TTL = 0
+# ChapterFactory 批量创建章节时的默认线程数
+DEFAULT_CHAPTER_WORKERS = 8
+# 每个Epub并发下载图片的默认线程数
+DEFAULT_IMAGE_WORKERS = 8
+# 打包epub时不再压缩的文件后缀(本身已经压缩过的图片, 音视频和字体), 其余文件的默认压缩级别(0-9),
+# 以及同时压缩文件的默认线程数. zlib 压缩时会释放GIL
+STORED_EXTENSIONS = frozenset(['jpg', 'jpeg', 'png', 'gif', 'webp', 'mp3', 'mp4', 'm4a', 'woff', 'woff2'])
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_WORKERS = min(os.cpu_count() or 1, 8)
+# 可恢复构建的日志文件名, 以 . 开头, 不会被打包进epub
+BUILD_JOURNAL_NAME = '.html2epub-journal'
+# 图片类型与 Pillow 格式名的对应关系, 以及 ImageOptimizer 的默认压缩质量
+IMAGE_PIL_FORMATS = {
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+    'bmp': 'BMP',
+}
+DEFAULT_IMAGE_QUALITY = 85
+# BuildStats 中耗时直方图各个桶的上限(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 xhtml_doctype_string = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">'
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 EPUB_TEMPLATES_DIR = os.path.join(BASE_DIR, 'epub_templates')
@@ -0,0 +1,258 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import collections
+import re
+from urllib.parse import parse_qsl, urldefrag, urlencode, urljoin, urlparse, urlunparse
+
+# Third party modules
+import requests
+from bs4 import BeautifulSoup
+
+# Local modules
+from . import chapter
+from . import constants
+from . import parallel
+from . import session as _session
+
+
+ChapterLink = collections.namedtuple('ChapterLink', ['url', 'title'])
+ChapterLink.__doc__ = """
+目录中的一个章节. 是 (url, title) 元组, 可以直接传给 ChapterFactory.create_chapters_from_urls.
+"""
+
+
+class SiteAdapter():
+    """
+    站点适配器, 描述如何从一个站点的目录页找到所有章节. 子类至少要实现 chapter_links.
+
+    Attributes:
+        reverse (bool): 目录页和页内链接是否按从新到旧排列. 为True时从最后一页开始, 每页内的链接也反过来.
+        sort_key (Option[function]): 对所有 ChapterLink 排序的键. 设置后要等所有目录页都获取完才能排序,
+            不能一边获取一边返回章节.
+    """
+
+    reverse = False
+    sort_key = None
+
+    def book_title(self, root):
+        """
+        Parameters:
+            root (bs4.BeautifulSoup): 第一页目录.
+
+        Returns:
+            str: 书名, 默认为 title标签 的内容.
+        """
+        return chapter.get_title(root)
+
+    def page_count(self, root):
+        """
+        Parameters:
+            root (bs4.BeautifulSoup): 第一页目录.
+
+        Returns:
+            int: 目录的总页数, 默认为1.
+        """
+        return 1
+
+    def page_url(self, index_url, page_number):
+        """
+        Parameters:
+            index_url (str): 第一页目录的地址.
+            page_number (int): 页码, 从1开始.
+
+        Returns:
+            str: 该页目录的地址, 默认在 index_url 上设置 page 参数.
+        """
+        if page_number == 1:
+            return index_url
+        parts = urlparse(index_url)
+        query = [(name, value) for name, value in parse_qsl(parts.query) if name != 'page']
+        query.append(('page', str(page_number)))
+        return urlunparse(parts._replace(query=urlencode(query)))
+
+    def chapter_links(self, root, page_url):
+        """
+        Parameters:
+            root (bs4.BeautifulSoup): 一页目录.
+            page_url (str): 该页的地址, 用于补全相对链接.
+
+        Returns:
+            list: 该页中按页面顺序排列的 ChapterLink 或章节地址.
+        """
+        raise NotImplementedError
+
+
+class SelectorAdapter(SiteAdapter):
+    """
+    用css选择器描述的站点适配器, 适合大多数论坛和小说站点.
+
+    Parameters:
+        link_selector (str): 选择章节链接(a标签)的css选择器.
+        link_text_pattern (Option[str]): 只保留链接文字匹配该正则表达式的链接.
+        page_count_selector (Option[str]): 选择包含总页数的标签的css选择器, 为None时只有一页.
+        page_count_pattern (Option[str]): 从该标签的文字和 title 属性中提取总页数的正则表达式, 第一个分组为页数.
+        reverse (Option[bool]): 见 SiteAdapter.reverse.
+    """
+
+    def __init__(self, link_selector, link_text_pattern=None, page_count_selector=None,
+                 page_count_pattern=r'(\d+)', reverse=False):
+        self.link_selector = link_selector
+        self.link_text_pattern = re.compile(link_text_pattern) if link_text_pattern else None
+        self.page_count_selector = page_count_selector
+        self.page_count_pattern = re.compile(page_count_pattern)
+        self.reverse = reverse
+
+    def page_count(self, root):
+        if self.page_count_selector is None:
+            return 1
+        tag = root.select_one(self.page_count_selector)
+        if tag is None:
+            return 1
+        match = self.page_count_pattern.search(tag.get('title', '') + ' ' + tag.get_text())
+        return int(match.group(1)) if match else 1
+
+    def chapter_links(self, root, page_url):
+        links = []
+        for tag in root.select(self.link_selector):
+            text = tag.get_text().strip()
+            if not tag.get('href'):
+                continue
+            if self.link_text_pattern is not None and not self.link_text_pattern.search(text):
+                continue
+            links.append(ChapterLink(urljoin(page_url, tag['href']), text or None))
+        return links
+
+
+class BookIndex():
+    """
+    一本书的目录. 由 Crawler.open 创建, 此时只获取了第一页.
+    迭代时并发获取其余目录页, 按阅读顺序逐个返回去重后的 ChapterLink.
+
+    Attributes:
+        index_url (str): 第一页目录的地址.
+        title (str): 书名.
+        page_count (int): 目录的总页数.
+    """
+
+    def __init__(self, crawler, index_url, first_page):
+        self.crawler = crawler
+        self.index_url = index_url
+        self._first_page = first_page
+        adapter = crawler.adapter
+        self.title = adapter.book_title(first_page)
+        self.page_count = max(adapter.page_count(first_page), 1)
+
+    def _pages(self):
+        """
+        按阅读顺序返回每一页的链接. 第一页已经获取过, 不会重复请求.
+        """
+        adapter = self.crawler.adapter
+        page_numbers = range(1, self.page_count + 1)
+        if adapter.reverse:
+            page_numbers = reversed(page_numbers)
+
+        def fetch(page_number):
+            page_url = adapter.page_url(self.index_url, page_number)
+            if page_number == 1:
+                root = self._first_page
+            else:
+                root = self.crawler._fetch_page(page_url)
+            return adapter.chapter_links(root, page_url)
+        for _, page_number, links, error in parallel.map_ordered(
+                fetch, page_numbers, self.crawler.max_workers):
+            if error is not None:
+                raise error
+            if adapter.reverse:
+                links = links[::-1]
+            yield links
+
+    def __iter__(self):
+        adapter = self.crawler.adapter
+        seen = set()
+
+        def unique(links):
+            for link in links:
+                if isinstance(link, str):
+                    link = ChapterLink(link, None)
+                url = urldefrag(link.url)[0]
+                if url in seen:
+                    continue
+                seen.add(url)
+                yield link._replace(url=url)
+        if adapter.sort_key is not None:
+            links = [link for page in self._pages() for link in unique(page)]
+            yield from sorted(links, key=adapter.sort_key)
+            return
+        for page in self._pages():
+            yield from unique(page)
+
+
+class Crawler():
+    """
+    根据站点适配器获取一本书的所有章节地址. 目录页在线程池中并发获取,
+    章节按阅读顺序一边获取一边返回, 可以直接交给 ChapterFactory.create_chapters_from_urls.
+
+    Parameters:
+        adapter (SiteAdapter): 站点适配器.
+        session (Option[requests.Session]): 获取目录页用的Session, 可以与 ChapterFactory 共用.
+            为None时使用默认Session.
+        max_workers (Option[int]): 同时获取目录页的最大线程数.
+    """
+
+    def __init__(self, adapter, session=None, max_workers=constants.DEFAULT_CHAPTER_WORKERS):
+        self.adapter = adapter
+        self._session = session
+        self.max_workers = max_workers
+
+    @property
+    def session(self):
+        if self._session is None:
+            return _session.get_default_session()
+        return self._session
+
+    def _fetch_page(self, page_url):
+        try:
+            response = self.session.get(page_url)
+        except requests.exceptions.RequestException:
+            raise ValueError('%s is an invalid url or no network connection' % page_url)
+        if not response.ok:
+            raise ValueError('%s returned status %d' % (page_url, response.status_code))
+        # 由bs4根据 meta 标签或内容判断编码, 没有声明编码时 response.text 会按 ISO-8859-1 解码
+        return BeautifulSoup(response.content, 'html.parser')
+
+    def open(self, index_url):
+        """
+        获取第一页目录.
+
+        Parameters:
+            index_url (str): 第一页目录的地址.
+
+        Returns:
+            BookIndex: 这本书的目录.
+
+        Raises:
+            ValueError: 无法获取目录页时触发此 Error.
+        """
+        return BookIndex(self, index_url, self._fetch_page(index_url))
+
+    def chapters(self, index_url, factory=None, max_workers=constants.DEFAULT_CHAPTER_WORKERS,
+                 errors=None):
+        """
+        获取目录并创建所有章节. 章节在目录页还没有全部获取时就开始创建.
+
+        Parameters:
+            index_url (str): 第一页目录的地址.
+            factory (Option[ChapterFactory]): 创建章节用的工厂, 为None时创建一个与本对象共用Session的工厂.
+            max_workers (Option[int]): 同时创建章节的最大线程数.
+            errors (Option[list]): 见 ChapterFactory.create_chapters_from_urls.
+
+        Returns:
+            str: 书名.
+            generator: 按阅读顺序排列的chapter对象.
+        """
+        if factory is None:
+            factory = chapter.ChapterFactory(session=self._session)
+        index = self.open(index_url)
+        return index.title, factory.create_chapters_from_urls(index, max_workers, errors)
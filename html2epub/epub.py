@@ -2,13 +2,20 @@
 # -*- coding: utf-8 -*-
 
 # Included modules
+import concurrent.futures
+import functools
+import json
+import operator
 import os
+import zipfile
 import shutil
 import collections
 import random
+import re
 import string
 import time
 import tempfile
+import xml.etree.ElementTree
 import imp
 try:
     imp.find_module('lxml')
@@ -23,8 +30,11 @@ except ImportError:
 import jinja2
 
 # Local modules
+from . import archive
 from . import chapter
 from . import constants
+from . import session as _session
+from . import stats as _stats
 
 
 class _Mimetype():
@@ -51,30 +61,94 @@ class _ContainerFile():
                     os.path.join(parent_directory, 'container.xml'))
 
 
+def _chapter_link(chapter_number):
+    return str(chapter_number) + '.xhtml'
+
+
+def _file_name(epub_name):
+    """
+    去掉书名中不能用于文件名的字符.
+    """
+    return ''.join([c for c in epub_name if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
+
+
+# 所有模板共用一个 jinja2 环境, 每个模板文件在进程中只编译一次.
+# 模板都是xml, 标题等变量需要转义, 否则 Epub.open 无法解析生成的文件
+_template_environment = jinja2.Environment(autoescape=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_template(template_file):
+    with open(template_file, 'r', encoding="utf-8") as f:
+        return _template_environment.from_string(f.read())
+
+
+class _LazyList():
+    """
+    按需计算元素的只读序列, 不会为每个章节预先生成数据.
+    """
+
+    def __init__(self, function, sequence):
+        self._function = function
+        self._sequence = sequence
+
+    def __len__(self):
+        return len(self._sequence)
+
+    def __iter__(self):
+        return map(self._function, self._sequence)
+
+
+class _TemplateChapters():
+    """
+    模板中的 chapters 变量. 可以多次遍历, 每次遍历时才逐个生成章节.
+    """
+
+    def __init__(self, parameter_lists):
+        self._type = collections.namedtuple('template_chapter',
+                                            parameter_lists.keys())
+        self._columns = list(parameter_lists.values())
+
+    def __len__(self):
+        return len(self._columns[0]) if self._columns else 0
+
+    def __iter__(self):
+        return map(self._type._make, zip(*self._columns))
+
+
 class _EpubFile():
     """
-    用于将chapters写入Epub的类
+    用于将chapters写入Epub的类. 模板只在写入时逐块渲染, 不会在内存中生成整个文件.
     """
 
     def __init__(self, template_file, **non_chapter_parameters):
-        self.content = ''
         self.file_name = ''
         self.template_file = template_file
         self.non_chapter_parameters = non_chapter_parameters
+        self._variables = None
+
+    @property
+    def content(self):
+        return ''.join(self.generate())
+
+    def generate(self):
+        """
+        逐块渲染模板.
+
+        Returns:
+            iterator: 渲染结果的字符串块.
+        """
+        if self._variables is None:
+            return iter(())
+        return _get_template(self.template_file).generate(self._variables)
 
     def write(self, file_name):
         self.file_name = file_name
         with open(file_name, 'w', encoding="utf-8") as f:
-            f.write(self.content)
+            f.writelines(self.generate())
 
     def _render_template(self, **variable_value_pairs):
-        def read_template():
-            with open(self.template_file, 'r', encoding="utf-8") as f:
-                template = f.read()
-            return jinja2.Template(template)
-        template = read_template()
-        rendered_template = template.render(variable_value_pairs)
-        self.content = rendered_template
+        self._variables = variable_value_pairs
 
     def add_chapters(self, **parameter_lists):
         def check_list_lengths(lists):
@@ -86,10 +160,7 @@ class _EpubFile():
                 else:
                     assert len(value) == list_length
         check_list_lengths(parameter_lists)
-        template_chapter = collections.namedtuple('template_chapter',
-                                                  parameter_lists.keys())
-        chapters = [template_chapter(*items)
-                    for items in zip(*parameter_lists.values())]
+        chapters = _TemplateChapters(parameter_lists)
         self._render_template(chapters=chapters, **self.non_chapter_parameters)
 
     def get_content(self):
@@ -106,15 +177,15 @@ class TocHtml(_EpubFile):
 
     def add_chapters(self, chapter_list):
         chapter_numbers = range(len(chapter_list))
-        link_list = [str(n) + '.xhtml' for n in chapter_numbers]
+        link_list = _LazyList(_chapter_link, chapter_numbers)
         try:
             for c in chapter_list:
                 t = type(c)
-                assert type(c) == chapter.Chapter
+                assert type(c) in (chapter.Chapter, _ChapterRecord)
         except AssertionError:
             raise TypeError('chapter_list items must be Chapter not %s',
                             str(t))
-        chapter_titles = [c.title for c in chapter_list]
+        chapter_titles = _LazyList(operator.attrgetter('title'), chapter_list)
         super(TocHtml, self).add_chapters(title=chapter_titles,
                                           link=link_list)
 
@@ -139,9 +210,9 @@ class TocNcx(_EpubFile):
 
     def add_chapters(self, chapter_list):
         id_list = range(len(chapter_list))
-        play_order_list = [n + 1 for n in id_list]
-        title_list = [c.title for c in chapter_list]
-        link_list = [str(n) + '.xhtml' for n in id_list]
+        play_order_list = range(1, len(chapter_list) + 1)
+        title_list = _LazyList(operator.attrgetter('title'), chapter_list)
+        link_list = _LazyList(_chapter_link, id_list)
         super(TocNcx, self).add_chapters(**{'id': id_list,
                                             'play_order': play_order_list,
                                             'title': title_list,
@@ -173,8 +244,8 @@ class ContentOpf(_EpubFile):
 
     def add_chapters(self, chapter_list):
         id_list = range(len(chapter_list))
-        link_list = [str(n) + '.xhtml' for n in id_list]
-        imgs_list = [c.imgs for c in chapter_list]
+        link_list = _LazyList(_chapter_link, id_list)
+        imgs_list = _LazyList(operator.attrgetter('imgs'), chapter_list)
         super(ContentOpf, self).add_chapters(
             **{'id': id_list, 'link': link_list, "imgs": imgs_list})
 
@@ -186,6 +257,179 @@ class ContentOpf(_EpubFile):
             raise NotImplementedError()
 
 
+_ImageRecord = collections.namedtuple('_ImageRecord', ['link', 'id', 'type'])
+
+
+class _ChapterRecord():
+    """
+    已经写入epub的章节, 只保留生成目录和opf所需的信息, 不保留章节内容和解析树.
+
+    Attributes:
+        title (str): 章节标题.
+        link (str): 章节文件在epub中的相对路径.
+        id (str): 章节在 content.opf 中的id.
+        imgs (tuple): 该章节新增的图片, 每个图片都有 link, id 和 type 属性.
+    """
+
+    __slots__ = ('title', 'link', 'id', 'imgs')
+
+    def __init__(self, title, link, id, imgs):
+        self.title = title
+        self.link = link
+        self.id = id
+        self.imgs = tuple(_ImageRecord(img['link'], img['id'], img['type'])
+                          for img in imgs)
+
+
+# 读取 content.opf 和 toc.html 用到的命名空间
+_NAMESPACES = {'opf': 'http://www.idpf.org/2007/opf',
+               'dc': 'http://purl.org/dc/elements/1.1/',
+               'xhtml': 'http://www.w3.org/1999/xhtml'}
+
+
+# 不是xml预定义实体或字符引用的 &. 旧版本生成的文件没有转义标题等变量, 其中的 & 是原文
+_BARE_AMPERSAND = re.compile(rb'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)')
+
+
+def _parse_xml(data):
+    """
+    Parameters:
+        data (bytes): xml文件的内容. 其中没有转义的 & 按原文读取.
+
+    Returns:
+        xml.etree.ElementTree.Element: 根元素.
+
+    Raises:
+        ValueError: 无法解析时触发此 Error. 不会用恢复模式读取, 以免改变标题等文本.
+    """
+    try:
+        return xml.etree.ElementTree.fromstring(_BARE_AMPERSAND.sub(b'&amp;', data))
+    except xml.etree.ElementTree.ParseError as e:
+        raise ValueError(str(e))
+
+
+def _read_epub(epub_path):
+    """
+    读取由本模块生成的epub的元数据和章节信息.
+
+    Parameters:
+        epub_path (str): epub文件的路径.
+
+    Returns:
+        dict: content.opf 中的元数据(title, creator, language, rights, publisher, uid, date).
+        list: 按阅读顺序排列的 _ChapterRecord.
+
+    Raises:
+        ValueError: epub中缺少 content.opf 或 toc.html, 或者它们无法解析时触发此 Error.
+    """
+    try:
+        with zipfile.ZipFile(epub_path) as z:
+            opf_data = z.read('OEBPS/content.opf')
+            toc_data = z.read('OEBPS/toc.html')
+    except KeyError:
+        raise ValueError('%s is not an epub created by html2epub' % epub_path)
+    try:
+        opf = _parse_xml(opf_data)
+        toc = _parse_xml(toc_data)
+    except ValueError as e:
+        raise ValueError('%s cannot be read: %s' % (epub_path, e))
+
+    def get_text(name):
+        node = opf.find('opf:metadata/dc:' + name, _NAMESPACES)
+        return ''.join(node.itertext()) if node is not None else ''
+    metadata = {'title': get_text('title').strip(),
+                'creator': get_text('creator'),
+                'language': get_text('language'),
+                'rights': get_text('rights'),
+                'publisher': get_text('publisher'),
+                'uid': get_text('identifier'),
+                'date': get_text('date')}
+    titles = {a.get('href'): ''.join(a.itertext())
+              for a in toc.iterfind(".//xhtml:div[@id='chapters']//xhtml:a", _NAMESPACES)}
+    # opf 中每个章节之后紧跟着该章节新增的图片
+    chapter_imgs = {}
+    imgs = None
+    items = opf.findall('opf:manifest/opf:item', _NAMESPACES)
+    for item in items:
+        media_type = item.get('media-type', '')
+        if media_type == 'application/xhtml+xml' and item.get('id') != 'toc':
+            imgs = chapter_imgs.setdefault(item.get('href'), [])
+        elif media_type.startswith('image/') and imgs is not None:
+            imgs.append({'link': item.get('href'), 'id': item.get('id'),
+                         'type': media_type.split('/', 1)[1]})
+    manifest = {item.get('id'): item.get('href') for item in items}
+    records = []
+    for itemref in opf.iterfind('opf:spine/opf:itemref', _NAMESPACES):
+        if itemref.get('idref') == 'toc':
+            continue
+        link = manifest[itemref.get('idref')]
+        records.append(_ChapterRecord(titles.get(link, link), link, itemref.get('idref'),
+                                      chapter_imgs.get(link, [])))
+    return metadata, records
+
+
+class _BuildJournal():
+    """
+    可恢复构建的日志, 保存在构建目录中. 每行是一个json对象: 第一行是书的元数据, 之后每完成一个章节追加一行,
+    记录章节的 key, 标题, 路径, 新增的图片, 下载过的图片url和已占用的图片字节数.
+    章节文件写完之后才追加日志, 每行写入后立即 fsync. 中断时写了一半的最后一行会被忽略.
+
+    Parameters:
+        path (str): 日志文件的路径.
+
+    Attributes:
+        metadata (Option[dict]): 元数据, 新的日志为None.
+        entries (list): 已完成章节的记录, 按添加顺序排列.
+
+    Raises:
+        ValueError: 日志中间有无法解析的行时触发此 Error.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.metadata = None
+        self.entries = []
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        # 最后一个元素是最后一个换行之后的内容, 只有中断时才不为空
+        for number, line in enumerate(lines[:-1]):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError('%s is corrupted at line %d' % (self.path, number + 1))
+            if 'metadata' in record:
+                self.metadata = record['metadata']
+            else:
+                self.entries.append(record)
+        if lines[-1]:
+            with open(self.path, 'r+', encoding='utf-8') as f:
+                f.truncate(len('\n'.join(lines[:-1]).encode('utf-8')) + (len(lines) > 1))
+
+    def start(self, metadata):
+        """
+        写入元数据, 开始一个新的日志.
+        """
+        self.metadata = metadata
+        self._write({'metadata': metadata})
+
+    def append(self, entry):
+        """
+        记录一个已完成的章节.
+        """
+        self.entries.append(entry)
+        self._write(entry)
+
+    def _write(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
 class Epub():
     """
     表示epub的类. 包含添加chapter和输出epub文件.
@@ -196,10 +440,69 @@ class Epub():
         language (Option[str]): epub的语言.
         rights (Option[str]): epub的版权.
         publisher (Option[str]): epub的出版商.
+        epub_dir (Option[str]): 存放epub各文件的目录, 为None时使用临时目录.
+        image_workers (Option[int]): 每个章节并发下载图片的最大线程数, 小于等于1时逐个下载.
+        session (Option[requests.Session]): 下载图片用的Session, 可以与 ChapterFactory 共用.
+            为None时创建一个连接池大小与 image_workers 相当的 Session, create_epub 时关闭. 传入的 Session 不会被关闭.
+        output (Option[str or file-like]): 设置后, 每添加一个章节就直接将其写入该epub文件或文件对象,
+            不再在 epub_dir 中生成整本书. 不能与 epub_dir 同时使用.
+        stats (Option[BuildStats]): 记录各阶段耗时的统计, 可以与 ChapterFactory 共用. 为None时创建一个新的.
+        image_optimizer (Option[callable]): 保存图片前对其缩小, 重新压缩或转换格式, 例如 image.ImageOptimizer.
+            在下载图片的线程池中与下载一起执行, content.opf 中的 media-type 使用处理后的类型.
+        max_image_bytes (Option[int]): 单张图片的最大字节数, 更大的图片会被放弃. 为None时不限制.
+        max_book_image_bytes (Option[int]): 整本书图片的最大总字节数, 超出后的图片会被放弃. 为None时不限制.
+        image_executor (Option[concurrent.futures.Executor]): 下载图片时共用的线程池, 例如同时生成多本书时.
+            为None时按 image_workers 创建自己的线程池. 共用的线程池不会被关闭.
+        build_dir (Option[str]): 可恢复的构建目录. 章节和图片写入该目录, 每完成一个章节都记录在其中的日志里.
+            构建中断后用同一个 build_dir 重新创建 Epub, 已完成的章节, 图片和 content.opf 中的条目会从日志恢复,
+            用 has_chapter 跳过它们即可从第一个未完成的章节继续. create_epub 成功后删除该目录.
+            不能与 epub_dir 或 output 同时使用.
+        compress_level (Option[int]): 压缩xhtml等文本文件的级别(0-9). 图片等已经压缩过的文件不再压缩.
+        compress_workers (Option[int]): create_epub 打包 epub_dir 或 build_dir 时同时压缩文件的最大线程数.
+            设置 output 时每个章节在 add_chapter 中逐个压缩写入, 不使用该线程池.
+
+    Attributes:
+        stats (BuildStats): 该epub的统计.
+
+    Raises:
+        ValueError: build_dir 属于另一本书, 或者是一个不为空的普通目录时触发此 Error.
     """
 
-    def __init__(self, title, creator='zzZ5', language='en', rights='', publisher='zzZ5', epub_dir=None):
+    def __init__(self, title, creator='zzZ5', language='en', rights='', publisher='zzZ5', epub_dir=None,
+                 image_workers=constants.DEFAULT_IMAGE_WORKERS, session=None, output=None, stats=None,
+                 image_optimizer=None, max_image_bytes=None, max_book_image_bytes=None,
+                 image_executor=None, build_dir=None,
+                 compress_level=constants.DEFAULT_COMPRESS_LEVEL,
+                 compress_workers=constants.DEFAULT_COMPRESS_WORKERS):
+        if output is not None and epub_dir is not None:
+            raise ValueError('output and epub_dir cannot be used together')
+        if build_dir is not None and (output is not None or epub_dir is not None):
+            raise ValueError('build_dir cannot be used with output or epub_dir')
+        journal = None
+        if build_dir is not None:
+            journal_path = os.path.join(build_dir, constants.BUILD_JOURNAL_NAME)
+            if os.path.isdir(build_dir) and os.listdir(build_dir) and not os.path.exists(journal_path):
+                raise ValueError('%s is not empty and is not a build directory' % build_dir)
+            os.makedirs(build_dir, exist_ok=True)
+            journal = _BuildJournal(journal_path)
+            epub_dir = build_dir
+        # 构建目录在成功后删除, 与临时目录相同
+        self._owns_epub_dir = epub_dir is None or build_dir is not None
         self._create_directories(epub_dir)
+        self.image_workers = image_workers
+        self._owns_session = session is None
+        if session is None:
+            session = _session.Session(
+                pool_size=max(image_workers or 1, constants.DEFAULT_POOL_SIZE))
+        self.session = session
+        if stats is None:
+            stats = _stats.BuildStats()
+        self.stats = stats
+        self.image_optimizer = image_optimizer
+        self.image_budget = chapter.ImageBudget(max_image_bytes, max_book_image_bytes)
+        self.image_index = chapter.ImageIndex()
+        self._image_executor = image_executor
+        self._owns_image_executor = image_executor is None
         self.chapters = []
         self.title = title
         try:
@@ -218,8 +521,71 @@ class Epub():
         self.toc_ncx = TocNcx()
         self.opf = ContentOpf(
             self.title, self.creator, self.language, self.rights, self.publisher, self.uid)
-        self.minetype = _Mimetype(self.EPUB_DIR)
-        self.container = _ContainerFile(self.META_INF_DIR)
+        self.output = output
+        self.compress_level = compress_level
+        self.compress_workers = compress_workers
+        self._append_target = None
+        self.journal = journal
+        self._completed_keys = set()
+        self._journaled_images = 0
+        if journal is not None:
+            self._resume()
+        if output is None:
+            self.archive = None
+            self.minetype = _Mimetype(self.EPUB_DIR)
+            self.container = _ContainerFile(self.META_INF_DIR)
+        else:
+            # 流式写入时 EPUB_DIR 只用来暂存下载的图片
+            self.archive = archive.EpubArchive(output, compress_level, compress_workers)
+            self.archive.write_file(os.path.join(
+                constants.EPUB_TEMPLATES_DIR, 'container.xml'), 'META-INF/container.xml')
+
+    @classmethod
+    def open(cls, epub_path, image_workers=constants.DEFAULT_IMAGE_WORKERS, session=None, stats=None,
+             image_optimizer=None, max_image_bytes=None, max_book_image_bytes=None,
+             image_executor=None, compress_level=constants.DEFAULT_COMPRESS_LEVEL,
+             compress_workers=constants.DEFAULT_COMPRESS_WORKERS):
+        """
+        打开一个由本模块生成的epub, 用于追加章节. 原有的章节和图片会被原样复制, 不会解压或重新解析,
+        调用 create_epub() 时只重新生成 toc.html, toc.ncx 和 content.opf, 然后替换原文件.
+
+        Parameters:
+            epub_path (str): 要追加章节的epub文件.
+            image_workers (Option[int]): 每个章节并发下载图片的最大线程数.
+            session (Option[requests.Session]): 下载图片用的Session.
+            stats (Option[BuildStats]): 记录各阶段耗时的统计.
+            image_optimizer (Option[callable]): 新添加图片的处理函数, 原有的图片不会被修改.
+            max_image_bytes (Option[int]): 新添加的单张图片的最大字节数.
+            max_book_image_bytes (Option[int]): 新添加的图片的最大总字节数, 原有的图片不计入.
+            image_executor (Option[concurrent.futures.Executor]): 下载图片时共用的线程池.
+            compress_level (Option[int]): 压缩新添加的文本文件的级别(0-9). 原有的文件按原样复制.
+            compress_workers (Option[int]): 打包时同时压缩文件的最大线程数.
+
+        Returns:
+            Epub: 新添加的章节会排在原有章节之后.
+        """
+        metadata, records = _read_epub(epub_path)
+        temp_path = epub_path + '.part'
+        epub = cls(metadata['title'], metadata['creator'], metadata['language'],
+                   metadata['rights'], metadata['publisher'],
+                   image_workers=image_workers, session=session, output=temp_path, stats=stats,
+                   image_optimizer=image_optimizer, max_image_bytes=max_image_bytes,
+                   max_book_image_bytes=max_book_image_bytes, image_executor=image_executor,
+                   compress_level=compress_level, compress_workers=compress_workers)
+        epub.uid = metadata['uid']
+        epub.opf = ContentOpf(epub.title, epub.creator, epub.language, epub.rights,
+                              epub.publisher, epub.uid, metadata['date'])
+        epub.archive.copy_entries(epub_path, exclude=(
+            'mimetype', 'META-INF/container.xml', 'OEBPS/toc.html',
+            'OEBPS/toc.ncx', 'OEBPS/content.opf'))
+        epub.chapters = records
+        for record in records:
+            for img in record.imgs:
+                epub.image_index.register(tuple(img))
+        epub.current_chapter_number = len(records) - 1
+        epub._increase_current_chapter_number()
+        epub._append_target = epub_path
+        return epub
 
     def _create_directories(self, epub_dir=None):
         """
@@ -234,9 +600,57 @@ class Epub():
         self.META_INF_DIR = os.path.join(self.EPUB_DIR, 'META-INF')
         self.LOCAL_IMAGE_DIR = 'images'
         self.IMAGE_DIR = os.path.join(self.OEBPS_DIR, self.LOCAL_IMAGE_DIR)
-        os.makedirs(self.OEBPS_DIR)
-        os.makedirs(self.META_INF_DIR)
-        os.makedirs(self.IMAGE_DIR)
+        os.makedirs(self.OEBPS_DIR, exist_ok=True)
+        os.makedirs(self.META_INF_DIR, exist_ok=True)
+        os.makedirs(self.IMAGE_DIR, exist_ok=True)
+
+    def _resume(self):
+        """
+        从构建日志恢复已完成的章节, 并删除中断时写了一半的章节和图片. 图片的 .part 临时文件会保留,
+        重新下载时从断开的位置继续.
+        """
+        metadata = self.journal.metadata
+        if metadata is None:
+            self.journal.start({'title': self.title, 'creator': self.creator,
+                                'language': self.language, 'rights': self.rights,
+                                'publisher': self.publisher, 'uid': self.uid,
+                                'date': self.opf.non_chapter_parameters['date']})
+            return
+        if metadata['title'] != self.title:
+            raise ValueError('%s belongs to the book %s' % (self.EPUB_DIR, metadata['title']))
+        self.uid = metadata['uid']
+        self.opf = ContentOpf(self.title, self.creator, self.language, self.rights,
+                              self.publisher, self.uid, metadata['date'])
+        for entry in self.journal.entries:
+            imgs = [{'link': link, 'id': id, 'type': type} for link, id, type in entry['imgs']]
+            self.chapters.append(_ChapterRecord(entry['title'], entry['link'], entry['id'], imgs))
+            self._completed_keys.add(entry['key'])
+            for image_url, link, id, type in entry['images']:
+                self.image_index.add(image_url, (link, id, type))
+            self.image_budget.used = entry['image_bytes']
+        self._journaled_images = len(self.image_index)
+        links = {record.link for record in self.chapters}
+        for file_name in os.listdir(self.OEBPS_DIR):
+            if file_name.endswith('.xhtml') and file_name not in links:
+                os.remove(os.path.join(self.OEBPS_DIR, file_name))
+        links = {img.link for record in self.chapters for img in record.imgs}
+        for file_name in os.listdir(self.IMAGE_DIR):
+            link = self.LOCAL_IMAGE_DIR + '/' + file_name
+            if not file_name.startswith('.') and link not in links:
+                os.remove(os.path.join(self.IMAGE_DIR, file_name))
+        self.current_chapter_number = len(self.chapters) - 1
+        self._increase_current_chapter_number()
+        self.stats.count('chapters_resumed', len(self.chapters))
+
+    def has_chapter(self, key):
+        """
+        Parameters:
+            key (str): add_chapter 时记录的 key.
+
+        Returns:
+            bool: 该章节是否已经在之前中断的构建中完成. 没有使用 build_dir 时总是False.
+        """
+        return key in self._completed_keys
 
     def _increase_current_chapter_number(self):
         """
@@ -251,34 +665,112 @@ class Epub():
         self.current_chapter_path = ''.join(
             [self.current_chapter_id, '.xhtml'])
 
-    def add_chapter(self, c):
+    def _get_image_executor(self):
+        """
+        获取下载图片用的线程池, 在第一次使用时创建.
+        """
+
+        if not self._owns_image_executor:
+            return self._image_executor
+        if self.image_workers is None or self.image_workers <= 1:
+            return None
+        if self._image_executor is None:
+            self._image_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.image_workers)
+        return self._image_executor
+
+    def _shutdown_image_executor(self):
+        if self._image_executor is not None and self._owns_image_executor:
+            self._image_executor.shutdown()
+            self._image_executor = None
+
+    def _close_session(self):
+        if self._owns_session:
+            self.session.close()
+
+    def add_chapter(self, c, key=None):
         """
         向epub中添加chapter. 创建各章节的xhtml文件.
+        写入之后 Epub 只保留该章节的标题, 路径和图片信息, 不再引用 chapter 本身.
 
         Parameters:
             c (Chapter): 要添加的chapter.
+            key (Option[str]): 使用 build_dir 时记录在日志中的章节标识, 恢复后用 has_chapter 查询.
+                为None时使用章节的url.
         Raises:
             TypeError: 如果添加的章节类型不对触发此 Error.
+            ValueError: 使用 build_dir 时 key 和章节的url都为None触发此 Error, 否则恢复时无法区分章节.
         """
         try:
             assert type(c) == chapter.Chapter
         except AssertionError:
             raise TypeError('chapter must be of type Chapter')
-        chapter_file_output = os.path.join(
-            self.OEBPS_DIR, self.current_chapter_path)
-        c._replace_images_in_chapter(self.OEBPS_DIR)
-        c.write(chapter_file_output)
+        if key is None:
+            key = c.url
+        if self.journal is not None and key is None:
+            raise ValueError('chapters without a url need a key when build_dir is used')
+        start = time.perf_counter()
+        with self.stats.timer('images'):
+            c._replace_images_in_chapter(
+                self.OEBPS_DIR, self._get_image_executor(), self.session, self.image_index,
+                self.stats, self.image_optimizer, self.image_budget)
+        with self.stats.timer('write'):
+            if self.archive is None:
+                chapter_file_output = os.path.join(
+                    self.OEBPS_DIR, self.current_chapter_path)
+                c.write(chapter_file_output)
+            else:
+                self._write_chapter_to_archive(c)
+        self.chapters.append(_ChapterRecord(
+            c.title, self.current_chapter_path, self.current_chapter_id, c.imgs))
+        if self.journal is not None:
+            self._journal_chapter(key)
+        c._release_content_tree()
+        seconds = time.perf_counter() - start
+        self.stats.record('add_chapter', seconds)
+        self.stats.count('chapters_added')
+        self.stats.emit('chapter_added', number=self.current_chapter_number, title=c.title,
+                        images=len(c.imgs), seconds=seconds)
         self._increase_current_chapter_number()
-        self.chapters.append(c)
 
-    def create_epub(self, output_directory, epub_name=None):
+    def _journal_chapter(self, key):
+        """
+        在日志中记录刚写入的章节.
+        """
+        record = self.chapters[-1]
+        images = self.image_index.items(self._journaled_images)
+        self._journaled_images += len(images)
+        self.journal.append({
+            'key': key, 'title': record.title, 'link': record.link, 'id': record.id,
+            'imgs': [list(img) for img in record.imgs],
+            'images': [[image_url] + list(image_info) for image_url, image_info in images],
+            'image_bytes': self.image_budget.used})
+        self._completed_keys.add(key)
+
+    def _write_chapter_to_archive(self, c):
+        """
+        将章节和它新增的图片写入epub, 然后清空暂存的图片.
+        """
+
+        self.archive.write_text(
+            'OEBPS/' + self.current_chapter_path, c.content)
+        for img in c.imgs:
+            self.archive.write_file(os.path.join(
+                self.OEBPS_DIR, img['link']), 'OEBPS/' + img['link'])
+        for file_name in os.listdir(self.IMAGE_DIR):
+            os.remove(os.path.join(self.IMAGE_DIR, file_name))
+
+    def create_epub(self, output_directory=None, epub_name=None):
         """
-        从该对象中创建epub文件.
+        从该对象中创建epub文件. 使用 epub_dir 之外的临时目录时, 创建完成后会删除该临时目录.
 
         Parameters:
-            output_directory (str): Directory to output the epub file to
+            output_directory (Option[str]): Directory to output the epub file to. 流式写入时不需要.
             epub_name (Option[str]): The file name of your epub. This should not contain
                 .epub at the end. If this argument is not provided, defaults to the title of the epub.
+
+        Returns:
+            str or file-like: epub文件的路径. 流式写入时为创建时传入的 output, 追加章节时为原epub的路径.
         """
         def createTOCs_and_ContentOPF():
             """
@@ -287,9 +779,13 @@ class Epub():
 
             for epub_file, name in ((self.toc_html, 'toc.html'), (self.toc_ncx, 'toc.ncx'), (self.opf, 'content.opf'),):
                 epub_file.add_chapters(self.chapters)
-                epub_file.write(os.path.join(self.OEBPS_DIR, name))
+                if self.archive is None:
+                    epub_file.write(os.path.join(self.OEBPS_DIR, name))
+                else:
+                    self.archive.write_chunks(
+                        'OEBPS/' + name, epub_file.generate())
 
-        def create_zip_archive(epub_name):
+        def get_epub_path(epub_name):
             try:
                 assert isinstance(
                     epub_name, str) or epub_name is None
@@ -297,24 +793,32 @@ class Epub():
                 raise TypeError('epub_name must be string or None')
             if epub_name is None:
                 epub_name = self.title
-            epub_name = ''.join(
-                [c for c in epub_name if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
-            epub_name_with_path = os.path.join(output_directory, epub_name)
-            try:
-                os.remove(os.path.join(epub_name_with_path, '.zip'))
-            except OSError:
-                pass
-            shutil.make_archive(epub_name_with_path, 'zip', self.EPUB_DIR)
-            return epub_name_with_path + '.zip'
-
-        def turn_zip_into_epub(zip_archive):
-            epub_full_name = zip_archive.strip('.zip') + '.epub'
-            try:
-                os.remove(epub_full_name)
-            except OSError:
-                pass
-            os.rename(zip_archive, epub_full_name)
-            return epub_full_name
-        createTOCs_and_ContentOPF()
-        epub_path = turn_zip_into_epub(create_zip_archive(epub_name))
+            return os.path.join(output_directory, _file_name(epub_name) + '.epub')
+
+        self._shutdown_image_executor()
+        # 图片已经全部下载, 关闭自己创建的 Session 的连接池
+        self._close_session()
+        start = time.perf_counter()
+        if self.archive is None:
+            if output_directory is None:
+                raise ValueError('output_directory cannot be None')
+            epub_path = get_epub_path(epub_name)
+            createTOCs_and_ContentOPF()
+            epub_archive = archive.EpubArchive(epub_path, self.compress_level,
+                                               self.compress_workers)
+            epub_archive.write_directory(self.EPUB_DIR)
+            epub_archive.close()
+        else:
+            createTOCs_and_ContentOPF()
+            self.archive.close()
+            epub_path = self.output
+            if self._append_target is not None:
+                os.replace(epub_path, self._append_target)
+                epub_path = self._append_target
+        seconds = time.perf_counter() - start
+        self.stats.record('package', seconds)
+        self.stats.emit('epub_created', path=epub_path, chapters=len(self.chapters),
+                        seconds=seconds)
+        if self._owns_epub_dir:
+            shutil.rmtree(self.EPUB_DIR, ignore_errors=True)
         return epub_path
@@ -0,0 +1,123 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import io
+
+# Third party modules
+try:
+    import PIL.Image
+    pillow_module_exists = True
+except ImportError:
+    pillow_module_exists = False
+
+# Local modules
+from . import constants
+
+
+class ImageOptimizer():
+    """
+    缩小和重新压缩下载的图片. 在 Epub 下载图片的线程池中对每张图片调用, Pillow 在缩放和编码时会释放GIL.
+    可以被 pickle, 也可以放到进程池中使用.
+
+    Parameters:
+        max_dimension (Option[int]): 图片最长边的最大像素数, 超过时等比例缩小. 为None时不缩小.
+        quality (Option[int]): JPEG 和 WebP 的压缩质量(1-95).
+        convert (Option[dict]): 图片类型的转换, 例如 {'png': 'jpeg', 'bmp': 'png'}. 没有列出的类型保持不变.
+
+    Raises:
+        NotImplementedError: 没有安装Pillow时触发此 Error.
+        ValueError: convert 中有不支持的图片类型时触发此 Error.
+    """
+
+    def __init__(self, max_dimension=None, quality=constants.DEFAULT_IMAGE_QUALITY, convert=None):
+        if not pillow_module_exists:
+            raise NotImplementedError('ImageOptimizer requires Pillow')
+        convert = dict(convert or {})
+        for image_type in list(convert) + list(convert.values()):
+            if image_type not in constants.IMAGE_PIL_FORMATS:
+                raise ValueError('unsupported image type %s' % image_type)
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.convert = convert
+
+    def __call__(self, content, image_type):
+        return self.optimize(content, image_type)
+
+    def optimize(self, content, image_type):
+        """
+        优化一张图片. 无法解码或无法编码为目标类型的图片, 动图, 以及优化后反而更大且不需要缩小或转换的图片, 原样返回.
+
+        Parameters:
+            content (bytes): 图片内容.
+            image_type (str): 图片类型, 见 chapter.get_image_type.
+
+        Returns:
+            bytes: 优化后的图片内容.
+            str: 优化后的图片类型, 用作文件后缀和 content.opf 中的 media-type.
+        """
+        target_type = self.convert.get(image_type, image_type)
+        if target_type == 'jpg':
+            target_type = 'jpeg'
+        try:
+            image = PIL.Image.open(io.BytesIO(content))
+            if getattr(image, 'is_animated', False):
+                return content, image_type
+            image.load()
+        except (OSError, ValueError, PIL.Image.DecompressionBombError):
+            return content, image_type
+        resized = False
+        try:
+            if self.max_dimension is not None and max(image.size) > self.max_dimension:
+                image.thumbnail((self.max_dimension, self.max_dimension), PIL.Image.LANCZOS)
+                resized = True
+            optimized = self._encode(image, constants.IMAGE_PIL_FORMATS[target_type])
+        except (OSError, ValueError, KeyError):
+            # 例如 CMYK 图片不能保存为PNG, 或者 Pillow 没有该格式的编码器
+            return content, image_type
+        converted = target_type != _normalize(image_type)
+        if not resized and not converted and len(optimized) >= len(content):
+            return content, image_type
+        return optimized, target_type
+
+    def _encode(self, image, pil_format):
+        """
+        Parameters:
+            image (PIL.Image.Image): 已解码(可能已缩小)的图片.
+            pil_format (str): Pillow 的格式名, 见 constants.IMAGE_PIL_FORMATS.
+
+        Returns:
+            bytes: 编码后的图片内容.
+        """
+        options = {}
+        if pil_format == 'JPEG':
+            image = _to_rgb(image)
+            options = {'quality': self.quality, 'optimize': True, 'progressive': True}
+        elif pil_format == 'WEBP':
+            options = {'quality': self.quality}
+        elif pil_format == 'PNG':
+            options = {'optimize': True}
+        elif pil_format == 'GIF' and image.mode not in ('P', 'L', '1'):
+            image = image.convert('P', palette=PIL.Image.ADAPTIVE)
+        output = io.BytesIO()
+        image.save(output, pil_format, **options)
+        return output.getvalue()
+
+
+def _normalize(image_type):
+    return 'jpeg' if image_type == 'jpg' else image_type
+
+
+def _to_rgb(image):
+    """
+    JPEG 不支持透明和调色板, 带透明通道的图片先合成到白色背景上.
+    """
+    if image.mode in ('RGB', 'L'):
+        return image
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA'):
+        background = PIL.Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
@@ -0,0 +1,46 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import collections
+import concurrent.futures
+
+
+def map_ordered(function, items, max_workers, executor=None):
+    """
+    用线程池并发地对 items 调用 function, 按输入顺序逐个返回结果.
+    同时进行中的任务数量有上限, 因此 items 可以是很长的生成器.
+
+    Parameters:
+        function (function): 处理单个输入项的函数.
+        items (iterable): 输入项.
+        max_workers (int): 最大线程数.
+        executor (Option[concurrent.futures.Executor]): 共用的线程池. 为None时创建一个新的,
+            结束时关闭; 否则结束时只取消本次还没有开始的任务.
+
+    Yields:
+        tuple: (序号, 输入项, 结果, 异常), 成功时异常为None, 失败时结果为None.
+    """
+    owns_executor = executor is None
+    if owns_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    pending = collections.deque()
+
+    def resolve(index, item, future):
+        try:
+            return index, item, future.result(), None
+        except Exception as e:
+            return index, item, None, e
+    try:
+        for index, item in enumerate(items):
+            pending.append((index, item, executor.submit(function, item)))
+            if len(pending) >= max_workers * 2:
+                yield resolve(*pending.popleft())
+        while pending:
+            yield resolve(*pending.popleft())
+    finally:
+        if owns_executor:
+            executor.shutdown(cancel_futures=True)
+        else:
+            for _, _, future in pending:
+                future.cancel()
@@ -0,0 +1,191 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import collections
+import email.utils
+import threading
+import time
+from urllib.parse import urlparse
+
+# Local modules
+from . import constants
+
+
+def _parse_retry_after(value):
+    """
+    Parameters:
+        value (Option[str]): Retry-After 响应头, 可以是秒数或 HTTP 日期.
+
+    Returns:
+        Option[float]: 需要等待的秒数, 没有或无法解析时为None.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class _HostState():
+    """
+    一个站点的令牌桶, 并发上限和暂停时间. 所有字段都在 condition 的锁内修改.
+    """
+
+    __slots__ = ('condition', 'tokens', 'refilled_at', 'in_flight', 'limit', 'paused_until')
+
+    def __init__(self, burst, limit):
+        self.condition = threading.Condition()
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.limit = float(limit)
+        self.paused_until = 0.0
+
+
+class FetchScheduler():
+    """
+    按站点(host)调度所有http请求. 章节和图片共用同一个 Session 时, 它们的请求也共用同一个调度器.
+
+    * 令牌桶: 每个站点每秒最多发起 rate 个请求, 空闲后最多可以连续发起 burst 个.
+    * 并发上限: 每个站点同时进行的请求数不超过当前上限. 上限从 initial_in_flight 开始,
+      请求的延迟不超过 target_latency 时逐渐提高(每完成约 上限 个请求加1), 直到 max_in_flight;
+      延迟过高或请求失败时逐渐降低.
+    * 退避: 收到 429 或 503 时并发上限减半, 整个站点暂停 Retry-After 指定的时间
+      (没有时为 backoff, 之后每次翻倍), 然后重试该请求, 最多重试 max_retries 次.
+
+    Parameters:
+        rate (Option[float]): 每个站点每秒最多发起的请求数, 为None时不限制.
+        burst (Option[int]): 令牌桶的容量.
+        max_in_flight (Option[int]): 每个站点同时进行的最大请求数.
+        initial_in_flight (Option[int]): 每个站点开始时的并发上限, 为None时从 max_in_flight 开始,
+            即不逐渐提高.
+        target_latency (Option[float]): 健康的请求延迟(秒), 为None时不根据延迟调整并发上限.
+        max_retries (Option[int]): 收到 429 或 503 时的最大重试次数.
+        backoff (Option[float]): 没有 Retry-After 时第一次退避的秒数.
+        max_backoff (Option[float]): 最长的退避时间(秒). Retry-After 更长时不再重试, 直接返回该响应.
+
+    Attributes:
+        throttled (collections.Counter): 每个站点收到 429 或 503 的次数.
+    """
+
+    def __init__(self, rate=None, burst=1, max_in_flight=constants.DEFAULT_HOST_MAX_IN_FLIGHT,
+                 initial_in_flight=constants.DEFAULT_HOST_INITIAL_IN_FLIGHT,
+                 target_latency=constants.DEFAULT_TARGET_LATENCY, max_retries=constants.DEFAULT_RETRIES, backoff=constants.DEFAULT_BACKOFF_FACTOR,
+                 max_backoff=constants.DEFAULT_MAX_BACKOFF):
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_in_flight = max_in_flight
+        if initial_in_flight is None:
+            initial_in_flight = max_in_flight
+        self.initial_in_flight = min(max(initial_in_flight, 1), max_in_flight)
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.throttled = collections.Counter()
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState(self.burst, self.initial_in_flight)
+            return host, state
+
+    def limit(self, url):
+        """
+        Parameters:
+            url (str): 站点中的任意地址.
+
+        Returns:
+            int: 该站点当前的并发上限.
+        """
+        _, state = self._host(url)
+        with state.condition:
+            return int(state.limit)
+
+    def _acquire(self, state):
+        with state.condition:
+            while True:
+                now = time.monotonic()
+                if now < state.paused_until:
+                    state.condition.wait(state.paused_until - now)
+                    continue
+                if state.in_flight >= int(state.limit):
+                    state.condition.wait()
+                    continue
+                if self.rate is not None:
+                    state.tokens = min(state.tokens + (now - state.refilled_at) * self.rate,
+                                       self.burst)
+                    state.refilled_at = now
+                    if state.tokens < 1:
+                        state.condition.wait((1 - state.tokens) / self.rate)
+                        continue
+                    state.tokens -= 1
+                state.in_flight += 1
+                return
+
+    def _release(self, state, latency, throttled_for=None, failed=False):
+        with state.condition:
+            state.in_flight -= 1
+            if throttled_for is not None:
+                state.limit = max(state.limit / 2, 1.0)
+                state.paused_until = max(state.paused_until, time.monotonic() + throttled_for)
+            elif failed or (self.target_latency is not None and latency > 2 * self.target_latency):
+                state.limit = max(state.limit - 1 / state.limit, 1.0)
+            elif self.target_latency is None or latency <= self.target_latency:
+                state.limit = min(state.limit + 1 / state.limit, float(self.max_in_flight))
+            state.condition.notify_all()
+
+    def request(self, send, url):
+        """
+        在调度下发起一个请求.
+
+        Parameters:
+            send (callable): 发起请求的函数, 没有参数, 返回 requests.Response. 重试时会再次调用.
+            url (str): 请求的地址, 用于确定站点.
+
+        Returns:
+            requests.Response: 最后一次请求的响应. 重试次数用完后可能仍是 429 或 503,
+                调用者应把它当作失败, 例如 ChapterFactory.create_chapter_from_url 会触发 ValueError.
+        """
+        host, state = self._host(url)
+        attempt = 0
+        while True:
+            self._acquire(state)
+            start = time.monotonic()
+            try:
+                response = send()
+            except BaseException:
+                self._release(state, time.monotonic() - start, failed=True)
+                raise
+            latency = time.monotonic() - start
+            if response.status_code not in constants.THROTTLE_STATUS_CODES:
+                self._release(state, latency)
+                return response
+            with self._lock:
+                self.throttled[host] += 1
+            delay = _parse_retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self.backoff * 2 ** attempt
+            give_up = attempt >= self.max_retries or delay > self.max_backoff
+            self._release(state, latency, min(delay, self.max_backoff))
+            if give_up:
+                return response
+            response.close()
+            attempt += 1
@@ -0,0 +1,119 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import functools
+import threading
+
+# Third party modules
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Local modules
+from . import constants
+
+
+class Session(requests.Session):
+    """
+    带连接池, 重试和默认请求头的 requests.Session. 同一本书的所有章节和图片请求共用一个Session,
+    这样对同一个站点的请求可以复用已建立的 TCP/TLS 连接.
+
+    Parameters:
+        pool_size (Option[int]): 每个站点保持的最大连接数, 应不小于并发请求的线程数.
+        headers (Option[dict]): 额外的请求头, 会覆盖默认的 User-Agent.
+        cookies (Option[dict]): 请求时带上的cookies.
+        retries (Option[int]): 连接失败或服务器返回 5xx 时的最大重试次数.
+        backoff_factor (Option[float]): 重试间隔的退避系数.
+        timeout (Option[float]): 请求的默认超时时间(秒), 为None时不设超时.
+        cache (Option[HttpCache]): 持久化的磁盘缓存, GET请求会先查找缓存. 为None时不使用缓存.
+        scheduler (Option[FetchScheduler]): 按站点限速, 限制并发, 并在收到 429/503 时退避重试的调度器.
+            命中缓存的请求不经过调度器. 流式请求在收到响应头后就释放并发名额. 为None时不限制.
+    """
+
+    def __init__(self, pool_size=constants.DEFAULT_POOL_SIZE, headers=None, cookies=None,
+                 retries=constants.DEFAULT_RETRIES, backoff_factor=constants.DEFAULT_BACKOFF_FACTOR,
+                 timeout=constants.DEFAULT_TIMEOUT, cache=None, scheduler=None):
+        super(Session, self).__init__()
+        self.cache = cache
+        self.scheduler = scheduler
+        self.headers['User-Agent'] = constants.USER_AGENT
+        if headers:
+            self.headers.update(headers)
+        if cookies:
+            self.cookies.update(cookies)
+        self.timeout = timeout
+        status_forcelist = (500, 502, 503, 504)
+        if scheduler is not None:
+            # 由调度器处理 429, 503 和 Retry-After, 退避时整个站点一起暂停, 而不只是当前线程
+            status_forcelist = tuple(status for status in status_forcelist
+                                     if status not in constants.THROTTLE_STATUS_CODES)
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=status_forcelist,
+                      respect_retry_after_header=scheduler is None)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cache is None or method.upper() != 'GET' \
+                or 'Range' in (kwargs.get('headers') or {}):
+            return self._send(method, url, **kwargs)
+        stream = kwargs.get('stream', False)
+        entry = self.cache.load(url)
+        if entry is not None and entry.is_fresh(self.cache.ttl):
+            try:
+                return entry.to_response(stream)
+            except IOError:
+                # 读取之前被其它线程淘汰, 当作没有缓存
+                entry = None
+        if entry is not None:
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers.update(entry.validators())
+            kwargs['headers'] = headers
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.refresh(entry, response)
+            response.close()
+            try:
+                return entry.to_response(stream)
+            except IOError:
+                # 验证期间被淘汰, 不带验证信息重新获取
+                for name in entry.validators():
+                    del kwargs['headers'][name]
+                response = self._send(method, url, **kwargs)
+        if response.status_code == 200:
+            if stream:
+                self.cache.wrap_stream(url, response)
+            else:
+                self.cache.store(url, response)
+        return response
+
+    def _send(self, method, url, **kwargs):
+        """
+        通过网络发起请求, 设置了调度器时由调度器安排.
+        """
+        send = functools.partial(super(Session, self).request, method, url, **kwargs)
+        if self.scheduler is None:
+            return send()
+        return self.scheduler.request(send, url)
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_default_session():
+    """
+    获取没有指定Session时共用的默认Session, 在第一次使用时创建.
+
+    Returns:
+        Session: 默认Session.
+    """
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = Session()
+        return _default_session
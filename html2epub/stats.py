@@ -0,0 +1,164 @@
+#!usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Included modules
+import bisect
+import collections
+import threading
+import time
+
+# Local modules
+from . import constants
+
+
+class StageStats():
+    """
+    一个阶段的耗时统计.
+
+    Attributes:
+        count (int): 该阶段执行的次数.
+        total (float): 总耗时(秒).
+        max (float): 最长的一次耗时(秒).
+        histogram (list): 每个耗时区间的次数, 区间上限为 constants.LATENCY_BUCKETS, 最后一个为超出上限的次数.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(constants.LATENCY_BUCKETS) + 1)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.histogram[bisect.bisect_left(constants.LATENCY_BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        labels = ['<=%g' % bucket for bucket in constants.LATENCY_BUCKETS] + ['>%g' % constants.LATENCY_BUCKETS[-1]]
+        return {'count': self.count, 'total': self.total, 'mean': self.mean, 'max': self.max,
+                'histogram': dict(zip(labels, self.histogram))}
+
+
+class _Timer():
+    __slots__ = ('stats', 'stage', 'start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+
+
+class BuildStats():
+    """
+    构建epub时各阶段的耗时和计数. 可以由 ChapterFactory 和 Epub 共用, 所有方法都是线程安全的.
+
+    ChapterFactory 记录的阶段:
+        fetch: 获取章节网页. read: 读取章节文件. sanitize: 解析和清理html. xhtml: 转换为xhtml.
+        chapter: 创建一个章节的总耗时.
+    Epub 记录的阶段:
+        images: 下载和保存一个章节的图片. write: 序列化并写入一个章节. add_chapter: 添加一个章节的总耗时.
+        package: 生成目录并打包.
+    计数:
+        requests, bytes_fetched, cache_hits: 章节和图片的http请求数, 下载的字节数和缓存命中数.
+        chapters_created, chapters_added, images_downloaded, images_deduped, images_failed.
+        chapters_resumed: 从构建日志恢复的章节数.
+
+    Parameters:
+        callback (Option[callable]): 事件回调, 以 callback(事件名, 字段dict) 调用, 例如转发给监控系统.
+            事件有 'chapter_created', 'chapter_added' 和 'epub_created'. 回调在产生事件的线程中执行,
+            应尽快返回. 为None时不产生事件.
+
+    Attributes:
+        stages (dict): 阶段名到 StageStats 的映射.
+        counters (collections.Counter): 各项计数.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = collections.defaultdict(StageStats)
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """
+        用于 with 语句, 记录语句块的耗时.
+
+        Parameters:
+            stage (str): 阶段名.
+        """
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds):
+        """
+        记录一个阶段的一次耗时.
+
+        Parameters:
+            stage (str): 阶段名.
+            seconds (float): 耗时(秒).
+        """
+        with self._lock:
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        """
+        增加一项计数.
+
+        Parameters:
+            name (str): 计数名.
+            n (Option[int]): 增加的数量.
+        """
+        with self._lock:
+            self.counters[name] += n
+
+    def record_response(self, response, size=None):
+        """
+        记录一次http请求的下载字节数和是否命中缓存.
+
+        Parameters:
+            response (requests.Response): 响应.
+            size (Option[int]): 下载的字节数. 为None时使用 response.content 的长度,
+                流式读取的响应应该传入实际读取的字节数.
+        """
+        from_cache = getattr(response, 'from_cache', False)
+        if size is None:
+            size = len(response.content)
+        with self._lock:
+            self.counters['requests'] += 1
+            if from_cache:
+                self.counters['cache_hits'] += 1
+            else:
+                self.counters['bytes_fetched'] += size
+
+    def emit(self, event, **fields):
+        """
+        产生一个事件. 没有设置 callback 时什么都不做.
+
+        Parameters:
+            event (str): 事件名.
+            **fields: 事件的字段.
+        """
+        if self.callback is not None:
+            self.callback(event, fields)
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: 可以直接转为json的统计结果, 包含 'stages' 和 'counters'.
+        """
+        with self._lock:
+            return {'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+                    'counters': dict(self.counters)}
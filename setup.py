@@ -20,8 +20,13 @@ setup(
         "Operating System :: OS Independent",
     ],
     install_requires=[
-        'beautifulsoup4',
+        'beautifulsoup4>=4.10.0',
         'jinja2',
         'requests',
-    ]
+    ],
+    entry_points={
+        'console_scripts': [
+            'html2epub = html2epub.cli:main',
+        ],
+    },
 )
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import functools
+import http.server
+import os
+import threading
+
+import pytest
+
+
+class _RecordingHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    记录收到的请求的静态文件服务器, 用来代替真实网站.
+    支持 "Range: bytes=N-" 和 If-Range(Last-Modified) 请求. server.truncate 中的路径只发送前若干个字节就断开连接(只生效一次).
+    server.status 中的路径总是返回该状态码.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path in self.server.status:
+            self.send_response(self.server.status[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = self.translate_path(self.path)
+        range_header = self.headers.get('Range')
+        cut = self.server.truncate.pop(self.path, None)
+        if (range_header is None and cut is None) or not os.path.isfile(path):
+            return super(_RecordingHandler, self).do_GET()
+        with open(path, 'rb') as f:
+            data = f.read()
+        last_modified = self.date_time_string(int(os.path.getmtime(path)))
+        if self.headers.get('If-Range', last_modified) != last_modified:
+            range_header = None
+        start = 0
+        if range_header is not None:
+            start = int(range_header.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if cut is not None:
+            body = body[:cut]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """
+    在本地启动一个提供 tmp_path/www 目录中文件的http服务器.
+    server.base_url 为服务器地址, server.root 为网站目录, server.requests 为收到的请求,
+    server.truncate 为 {路径: 字节数}, 用于模拟中断的下载. server.status 为 {路径: 状态码}.
+    """
+    root = tmp_path / 'www'
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(_RecordingHandler, directory=str(root)))
+    server.requests = []
+    server.truncate = {}
+    server.status = {}
+    server.root = root
+    server.base_url = 'http://127.0.0.1:%d/' % server.server_port
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+import html2epub
+from html2epub import aio, chapter
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+
+
+def _write_book(http_server, chapter_count):
+    (http_server.root / 'a.png').write_bytes(PNG)
+    for n in range(chapter_count):
+        (http_server.root / ('%d.html' % n)).write_text(
+            '<html><head><title>%d</title></head><body><p>%d</p><img src="a.png"></body></html>'
+            % (n, n))
+    return [http_server.base_url + '%d.html' % n for n in range(chapter_count)]
+
+
+def test_async_build(http_server):
+    urls = _write_book(http_server, 12)
+
+    async def build():
+        factory = aio.AsyncChapterFactory(max_concurrency=4)
+        output = io.BytesIO()
+        epub = aio.AsyncEpub(html2epub.Epub('Async', output=output))
+        errors = []
+        titles = []
+        async for c in factory.create_chapters_from_urls(urls, errors=errors):
+            titles.append(c.title)
+            await epub.add_chapter(c)
+        await epub.create_epub()
+        factory.close()
+        return titles, errors, output
+
+    titles, errors, output = asyncio.run(build())
+    assert titles == [str(n) for n in range(12)]
+    assert errors == []
+    z = zipfile.ZipFile(io.BytesIO(output.getvalue()))
+    assert 'OEBPS/11.xhtml' in z.namelist()
+
+
+def test_async_batch_reports_errors_after_results():
+    async def build():
+        factory = aio.AsyncChapterFactory(
+            chapter.ChapterFactory(session=html2epub.Session(retries=0)), max_concurrency=2)
+        titles = []
+        with pytest.raises(chapter.ChapterBatchError):
+            async for c in factory.create_chapters_from_urls(
+                    ['http://127.0.0.1:1/unreachable', 'not a url']):
+                titles.append(c.title)
+        factory.close()
+        return titles
+
+    assert asyncio.run(build()) == []
+
+
+def test_async_fetch_can_be_cancelled(http_server):
+    urls = _write_book(http_server, 50)
+
+    async def build():
+        factory = aio.AsyncChapterFactory(max_concurrency=2)
+        task = asyncio.ensure_future(asyncio.gather(
+            *[factory.create_chapter_from_url(url) for url in urls]))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        factory.close()
+
+    asyncio.run(build())
@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+
+from benchmarks import run
+
+
+def test_benchmark_suite_runs_and_compares(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    argv = ['--chapters', '2', '--chapter-size', '2000', '--repeat', '1',
+            '--baseline', str(baseline)]
+    assert run.main(argv + ['--save-baseline']) == 0
+    results = json.loads(baseline.read_text())
+    assert set(results['stages']) == set(run.STAGES)
+    assert all('peak_memory' in stage for stage in results['stages'].values())
+    # 把基准改得很快, 本次运行必然被判定为退化
+    for stage in results['stages'].values():
+        stage['seconds'] /= 100
+    baseline.write_text(json.dumps(results))
+    assert run.main(argv + ['--no-memory']) == 1
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+import html2epub
+from html2epub import cache
+
+
+def test_fresh_entries_skip_the_network(tmp_path, http_server):
+    (http_server.root / 'a.html').write_text('<p>hello</p>')
+    session = html2epub.Session(cache=html2epub.HttpCache(str(tmp_path / 'cache'), ttl=60))
+    assert session.get(http_server.base_url + 'a.html').text == '<p>hello</p>'
+    response = session.get(http_server.base_url + 'a.html')
+    assert response.text == '<p>hello</p>'
+    assert response.from_cache
+    assert len(http_server.requests) == 1
+
+
+def test_stale_entries_are_revalidated(tmp_path, http_server):
+    (http_server.root / 'a.html').write_text('<p>hello</p>')
+    cache = html2epub.HttpCache(str(tmp_path / 'cache'), ttl=None)
+    session = html2epub.Session(cache=cache)
+    session.get(http_server.base_url + 'a.html')
+    response = html2epub.Session(cache=cache).get(http_server.base_url + 'a.html')
+    assert response.from_cache
+    assert 'If-Modified-Since' in http_server.requests[1][1]
+
+
+def test_response_cache_control_limits_freshness():
+    entry = cache._CacheEntry('http://example.com/', {}, time.time() - 30, None)
+    assert entry.is_fresh(60)
+    assert not entry.is_fresh(0) and not entry.is_fresh(None)
+    entry.headers['Cache-Control'] = 'public, max-age=10'
+    assert not entry.is_fresh(60)
+    entry.headers['Cache-Control'] = 'max-age=3600'
+    assert entry.is_fresh(60) and not entry.is_fresh(20)
+    entry.headers['Cache-Control'] = 'no-cache'
+    assert not entry.is_fresh(60)
+
+
+@pytest.mark.parametrize('ttl', [60, 0])
+def test_evicted_body_is_a_cache_miss(tmp_path, http_server, monkeypatch, ttl):
+    (http_server.root / 'a.html').write_text('<p>hello</p>')
+    http_cache = html2epub.HttpCache(str(tmp_path / 'cache'), ttl=ttl)
+    session = html2epub.Session(cache=http_cache)
+    url = http_server.base_url + 'a.html'
+    session.get(url)
+    load = http_cache.load
+
+    def load_then_evict(url):
+        # 另一个线程在检查之后删除了缓存内容
+        entry = load(url)
+        os.remove(entry.body_path)
+        return entry
+    monkeypatch.setattr(http_cache, 'load', load_then_evict)
+    response = session.get(url)
+    assert response.text == '<p>hello</p>' and not getattr(response, 'from_cache', False)
+    assert 'If-Modified-Since' not in http_server.requests[-1][1]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, http_server):
+    for name in 'abc':
+        (http_server.root / name).write_bytes(b'x' * 100)
+    cache = html2epub.HttpCache(str(tmp_path / 'cache'), max_size=250)
+    session = html2epub.Session(cache=cache)
+    for name in 'abc':
+        session.get(http_server.base_url + name)
+    assert cache.load(http_server.base_url + 'a') is None
+    assert cache.load(http_server.base_url + 'c') is not None
+    # 重新打开缓存目录时能恢复总大小
+    assert html2epub.HttpCache(str(tmp_path / 'cache'), max_size=250)._size == 200
+
+
+def test_eviction_follows_loads_without_scanning_the_directory(tmp_path, http_server, monkeypatch):
+    for name in 'abc':
+        (http_server.root / name).write_bytes(b'x' * 100)
+    cache = html2epub.HttpCache(str(tmp_path / 'cache'), max_size=250)
+    session = html2epub.Session(cache=cache)
+    session.get(http_server.base_url + 'a')
+    session.get(http_server.base_url + 'b')
+
+    def listdir(path):
+        raise AssertionError('cache directory listed')
+    monkeypatch.setattr(os, 'listdir', listdir)
+    assert cache.load(http_server.base_url + 'a') is not None
+    session.get(http_server.base_url + 'c')
+    assert cache.load(http_server.base_url + 'b') is None
+    assert cache.load(http_server.base_url + 'a') is not None
+    assert cache._size == 200
+
+
+def test_streamed_responses_are_cached_only_when_complete(tmp_path, http_server):
+    (http_server.root / 'a.bin').write_bytes(b'x' * 1000)
+    cache = html2epub.HttpCache(str(tmp_path / 'cache'), ttl=60)
+    session = html2epub.Session(cache=cache)
+    url = http_server.base_url + 'a.bin'
+    response = session.get(url, stream=True)
+    next(response.iter_content(10))
+    response.close()
+    assert cache.load(url) is None
+    response = session.get(url, stream=True)
+    assert b''.join(response.iter_content(100)) == b'x' * 1000
+    response = session.get(url, stream=True)
+    assert response.from_cache
+    assert b''.join(response.iter_content(100)) == b'x' * 1000
+    response.close()
+    assert len(http_server.requests) == 2
+    assert [name for name in (tmp_path / 'cache').iterdir() if name.suffix == '.tmp'] == []
+
+
+def test_streamed_cache_hits_close_their_files(tmp_path, http_server):
+    (http_server.root / 'a.bin').write_bytes(b'x' * 1000)
+    session = html2epub.Session(cache=html2epub.HttpCache(str(tmp_path / 'cache')))
+    url = http_server.base_url + 'a.bin'
+    session.get(url)
+    response = session.get(url, stream=True)
+    assert response.from_cache
+    assert b''.join(response.iter_content(100)) == b'x' * 1000
+    response.close()
+    assert response.raw.closed
+    response = session.get(url, stream=True)
+    next(response.iter_content(10))
+    response.close()
+    assert response.raw.closed
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import concurrent.futures
+
+import pytest
+from bs4 import BeautifulSoup
+
+import html2epub
+from html2epub import chapter
+from html2epub import clean
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n\x00\x00', 'png'),
+    (b'GIF89a\x01\x00', 'gif'),
+    (b'RIFF\x00\x00\x00\x00WEBPVP8 ', 'webp'),
+])
+def test_get_image_type_from_bytes(data, expected):
+    # 文件头优先于url后缀
+    assert chapter.get_image_type('http://example.com/a.jpg', data) == expected
+
+
+def test_get_image_type_fallbacks():
+    assert chapter.get_image_type(
+        'http://example.com/a', b'<html>', 'image/png; charset=x') == 'png'
+    assert chapter.get_image_type('http://example.com/a.png?v=1') == 'png'
+    assert chapter.get_image_type('http://example.com/a.gif') == 'gif'
+    assert chapter.get_image_type('http://example.com/a', b'<html>') is None
+
+
+def test_images_deduplicated_across_chapters(tmp_path):
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+    (tmp_path / 'a.png').write_bytes(png)
+    (tmp_path / 'b.png').write_bytes(png)
+    html_string = '<html><body><img src="%s"><img src="%s"><img src="%s"></body></html>' % (
+        tmp_path / 'a.png', tmp_path / 'b.png', tmp_path / 'a.png')
+    epub = html2epub.Epub('t', epub_dir=str(tmp_path / 'book'))
+    first = html2epub.create_chapter_from_string(html_string, title='1')
+    second = html2epub.create_chapter_from_string(html_string, title='2')
+    epub.add_chapter(first)
+    epub.add_chapter(second)
+    assert len(first.imgs) == 1
+    assert second.imgs == []
+    assert len(list((tmp_path / 'book' / 'OEBPS' / 'images').iterdir())) == 1
+    assert second.content.count(first.imgs[0]['link']) == 3
+
+
+def test_default_pipeline_parses_each_chapter_once(tmp_path, monkeypatch):
+    (tmp_path / 'a.png').write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 16)
+    html_string = ('<html><head><title>t</title></head><body><div class="x"><p>one<br>two</p>'
+                   '<script>x</script><img src="%s"></div><pre> a\n  b</pre></body></html>'
+                   % (tmp_path / 'a.png'))
+    # 以前的流程: clean 序列化后由 html_to_xhtml 重新解析
+    expected = clean.html_to_xhtml(clean.clean(html_string))
+    parses = []
+
+    class CountingSoup(BeautifulSoup):
+        def __init__(self, *args, **kwargs):
+            parses.append(args[0])
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(chapter, 'BeautifulSoup', CountingSoup)
+    monkeypatch.setattr(clean, 'BeautifulSoup', CountingSoup)
+    c = html2epub.create_chapter_from_string(html_string)
+    assert c.title == 't'
+    assert c._content is None
+    assert c.content == expected
+    # 下载图片, 写入和释放解析树都使用同一棵树
+    epub = html2epub.Epub('t', epub_dir=str(tmp_path / 'book'))
+    epub.add_chapter(c)
+    assert c._content_tree is None
+    assert 'src="images/' in c.content
+    assert len(parses) == 1
+
+
+def test_create_chapters_from_urls_keeps_order(http_server):
+    for n in range(20):
+        (http_server.root / ('%d.html' % n)).write_text(
+            '<html><head><title>%d</title></head><body><p>%d</p></body></html>' % (n, n))
+    factory = chapter.ChapterFactory()
+    urls = [http_server.base_url + '%d.html' % n for n in range(20)]
+    titles = [c.title for c in factory.create_chapters_from_urls(iter(urls), max_workers=4)]
+    assert titles == [str(n) for n in range(20)]
+
+
+def test_create_chapters_from_urls_reports_http_errors(http_server):
+    (http_server.root / 'ok.html').write_text(
+        '<html><head><title>ok</title></head><body><p>ok</p></body></html>')
+    factory = chapter.ChapterFactory()
+    errors = []
+    urls = [http_server.base_url + 'ok.html', http_server.base_url + 'missing.html']
+    chapters = list(factory.create_chapters_from_urls(urls, errors=errors))
+    assert [c.title for c in chapters] == ['ok']
+    assert [(index, item) for index, item, _ in errors] == [(1, urls[1])]
+    assert isinstance(errors[0][2], ValueError) and '404' in str(errors[0][2])
+
+
+def test_create_chapter_from_url_follows_redirects(http_server, tmp_path):
+    # 没有结尾斜杠的目录会被重定向到 /book/, 图片的相对地址按重定向后的地址解析
+    (http_server.root / 'book').mkdir()
+    (http_server.root / 'book' / 'index.html').write_text(
+        '<html><head><title>one</title></head><body><p>x</p><img src="a.png"></body></html>')
+    (http_server.root / 'book' / 'a.png').write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 16)
+    url = http_server.base_url + 'book'
+    c = chapter.ChapterFactory().create_chapter_from_url(url)
+    assert c.title == 'one'
+    assert (c.url, c.base_url) == (url, url + '/')
+    html2epub.Epub('t', epub_dir=str(tmp_path / 'epub')).add_chapter(c)
+    assert len(c.imgs) == 1
+    assert [path for path, _ in http_server.requests] == ['/book', '/book/', '/book/a.png']
+
+
+def test_persistent_server_errors_raise_value_error(http_server):
+    http_server.status['/broken.html'] = 500
+    factory = chapter.ChapterFactory(session=html2epub.Session(retries=1, backoff_factor=0))
+    with pytest.raises(ValueError):
+        factory.create_chapter_from_url(http_server.base_url + 'broken.html')
+    assert len(http_server.requests) == 2
+
+
+def test_create_chapters_collects_errors():
+    factory = chapter.ChapterFactory()
+    items = ['<p>a</p>', ('<p>b</p>', None, 'b'), ('<p>x</p>', None, 5), '<p>c</p>']
+    errors = []
+    chapters = list(factory.create_chapters_from_strings(items, errors=errors))
+    assert [c.title for c in chapters] == ['Ebook Chapter', 'b', 'Ebook Chapter']
+    assert [index for index, _, _ in errors] == [2]
+    with pytest.raises(chapter.ChapterBatchError) as excinfo:
+        list(factory.create_chapters_from_strings(items))
+    assert len(excinfo.value.errors) == 1
+
+
+def test_process_pool_matches_in_process_cleaning():
+    items = ['<html><head><title>%d</title></head><body><div><p>%d<br>x</p>'
+             '<img src="a.png"></div></body></html>' % (n, n) for n in range(6)]
+    policy = html2epub.clean.SanitizerPolicy()
+    expected = [(c.title, c.content) for c in
+                chapter.ChapterFactory(policy).create_chapters_from_strings(items)]
+    factory = chapter.ChapterFactory(policy, processes=2)
+    try:
+        chapters = list(factory.create_chapters_from_strings(items, max_workers=4))
+    finally:
+        factory.close()
+    assert [(c.title, c.content) for c in chapters] == expected
+
+
+def _image_dir(tmp_path):
+    folder = tmp_path / 'OEBPS'
+    (folder / 'images').mkdir(parents=True)
+    return folder
+
+
+def test_concurrent_image_downloads_follow_document_order(http_server, tmp_path):
+    # 第一张图片最大, 最后才下载完
+    (http_server.root / '0.png').write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 500000)
+    for n in (2, 4):
+        (http_server.root / ('%d.png' % n)).write_bytes(b'\x89PNG\r\n\x1a\n' + bytes([n]) * 100)
+    names = ['0.png', '1.png', '2.png', '3.png', '4.png', '0.png']
+    html_string = '<html><body>%s</body></html>' % ''.join(
+        '<img src="%s%s">' % (http_server.base_url, name) for name in names)
+    results = []
+    for image_workers in (None, 4):
+        c = html2epub.create_chapter_from_string(html_string, title='t')
+        folder = _image_dir(tmp_path / str(image_workers))
+        if image_workers is None:
+            c._replace_images_in_chapter(str(folder))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(image_workers) as executor:
+                c._replace_images_in_chapter(str(folder), executor=executor)
+        results.append((c.content, [img['link'] for img in c.imgs]))
+        # 1.png 和 3.png 不存在, 它们的img标签被删除, 其余标签按原顺序指向本地图片
+        assert 'src="http' not in c.content
+        assert c.content.count('<img') == 4
+        links = [img['link'] for img in c.imgs]
+        assert len(links) == 3
+        positions = [c.content.index('src="%s"' % link) for link in links]
+        assert positions == sorted(positions)
+        assert c.content.rindex('src="%s"' % links[0]) > positions[2]
+    assert results[0] == results[1]
+
+
+def test_interrupted_image_download_resumes_with_range(http_server, tmp_path):
+    png = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 800
+    (http_server.root / 'big.png').write_bytes(png)
+    http_server.truncate['/big.png'] = 150000
+    folder = _image_dir(tmp_path)
+    session = html2epub.Session(retries=0)
+    link, _, image_type = chapter._download_image(
+        http_server.base_url + 'big.png', str(folder), session=session)
+    assert image_type == 'png'
+    assert (folder / link).read_bytes() == png
+    # 已经完整收到的块不会重新下载
+    ranges = [headers.get('Range') for _, headers in http_server.requests]
+    assert ranges == [None, 'bytes=%d-' % (2 * html2epub.constants.IMAGE_CHUNK_SIZE)]
+    assert [p.name for p in (folder / 'images').iterdir()] == [link.split('/')[1]]
+
+
+def test_changed_image_is_not_spliced_onto_an_old_partial_download(http_server, tmp_path):
+    old = b'\x89PNG\r\n\x1a\n' + b'\x01' * 1000
+    new = b'\x89PNG\r\n\x1a\n' + b'\x02' * 1000
+    (http_server.root / 'a.png').write_bytes(new)
+    folder = _image_dir(tmp_path)
+    url = http_server.base_url + 'a.png'
+    part = chapter._part_path(str(folder / 'images'), url)
+    # 上次运行留下的一半旧图片, 以及旧图片的 Last-Modified
+    with open(part, 'wb') as f:
+        f.write(old[:500])
+    with open(part + '.validator', 'w') as f:
+        f.write('Mon, 01 Jan 2001 00:00:00 GMT')
+    link, _, _ = chapter._download_image(url, str(folder))
+    assert (folder / link).read_bytes() == new
+    assert http_server.requests[0][1]['If-Range'] == 'Mon, 01 Jan 2001 00:00:00 GMT'
+
+    # 没有验证信息时不发送 Range, 从头下载
+    with open(part, 'wb') as f:
+        f.write(old[:500])
+    chapter._download_image(url, str(folder))
+    assert 'Range' not in http_server.requests[1][1]
+    assert [p.name for p in (folder / 'images').iterdir()] == [link.split('/')[1]]
+
+
+def test_image_byte_budgets(http_server, tmp_path):
+    for n in range(3):
+        (http_server.root / ('%d.png' % n)).write_bytes(b'\x89PNG\r\n\x1a\n' + bytes([n]) * 1000)
+    (http_server.root / 'big.png').write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 5000)
+    folder = _image_dir(tmp_path)
+    budget = chapter.ImageBudget(max_image_bytes=2000, max_book_bytes=2500)
+    results = [chapter._download_image(http_server.base_url + name, str(folder), budget=budget)
+               for name in ('big.png', '0.png', '1.png', '2.png')]
+    # big.png 超过单张上限, 2.png 超过整本书的上限
+    assert [result is not None for result in results] == [False, True, True, False]
+    assert budget.used == 2016
+    # 失败的下载不会留下临时文件
+    assert len(list((folder / 'images').iterdir())) == 2
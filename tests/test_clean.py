@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import pickle
+import re
+
+import pytest
+from bs4 import BeautifulSoup
+
+import html2epub
+from html2epub import clean
+
+# 两种引擎的一致性测试语料. html.parser 不会补全省略的结束标签(例如 <li>),
+# 所以语料只包含结构完整的html.
+PARITY_CORPUS = [
+    '',
+    '<p>fragment only</p>',
+    '<html><head><title>t</title></head><body><p>hello</p></body></html>',
+    '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"></head>'
+    '<body><div id="a" class="c" style="x"><p align="center">one<br>two</p></div></body></html>',
+    '<html><body><p>a&nbsp;b &amp; c &lt;d&gt;</p></body></html>',
+    '<html><body><img src="a.png" alt="x"><img alt="no src">tail</body></html>',
+    '<html><body><section><p>first</p><p>second</p></section><p>after</p></body></html>',
+    '<html><body><script>var x = 1;</script><p>text</p><style>p {}</style></body></html>',
+    '<html><body><article id="main"><h1>title</h1><nav><a href="#">x</a></nav></article></body></html>',
+    '<html><body><table class="t"><tr><td>1</td><td>2</td></tr></table></body></html>',
+    '<html><body><ul><li>one</li><li>two</li></ul><p>中文内容</p></body></html>',
+    '<html><body><p></p><span title="s"></span><hr><a name="n"></a></body></html>',
+    '<html><body><!-- comment --><p>kept</p></body></html>',
+    '<html><body><section>before<p>x</p>middle<custom>inner <b>bold</b></custom> after</section></body></html>',
+    '<html><head><title>t</title><style>p {}</style></head>'
+    '<body><div>a<noscript>no</noscript>b<button>ok</button>c</div></body></html>',
+    '<html><body><font color="red" onclick="x">red</font><div><span>a</span>b<em>c</em>d</div></body></html>',
+    '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+    '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n<html xmlns="http://www.w3.org/1999/xhtml">'
+    '<head><title>x</title></head><body><p>xhtml</p></body></html>',
+]
+
+
+def _canonical(node):
+    """
+    把xhtml树转换为与空白和序列化格式无关的结构, 用于比较.
+    """
+    result = []
+    for child in node.children:
+        if isinstance(child, str):
+            if type(child).__name__ in ('Doctype', 'Comment', 'ProcessingInstruction'):
+                continue
+            text = re.sub(r'\s+', ' ', child).strip()
+            if text:
+                if result and isinstance(result[-1], str):
+                    result[-1] = result[-1] + ' ' + text
+                else:
+                    result.append(text)
+        else:
+            if child.name == 'head' and not list(child.find_all(True)):
+                continue
+            result.append((child.name, sorted(child.attrs.items()),
+                           _canonical(child)))
+    return result
+
+
+def _canonical_xhtml(xhtml_string):
+    return _canonical(BeautifulSoup(xhtml_string, 'html.parser'))
+
+
+@pytest.mark.parametrize('html_string', PARITY_CORPUS)
+def test_lxml_engine_matches_bs4_engine(html_string):
+    bs4_output = clean.html_to_xhtml(clean.clean(html_string))
+    lxml_output = clean.clean_lxml(html_string)
+    assert _canonical_xhtml(lxml_output) == _canonical_xhtml(bs4_output)
+
+
+@pytest.mark.parametrize('html_string', PARITY_CORPUS[1:])
+def test_chapter_factory_engines_match(html_string):
+    bs4_chapter = html2epub.chapter.ChapterFactory().create_chapter_from_string(
+        html_string, title='t')
+    lxml_chapter = html2epub.chapter.ChapterFactory(
+        engine='lxml').create_chapter_from_string(html_string, title='t')
+    assert (_canonical_xhtml(lxml_chapter.content) ==
+            _canonical_xhtml(bs4_chapter.content))
+
+
+def test_lxml_engine_as_clean_function():
+    factory = html2epub.chapter.ChapterFactory(clean_function=clean.clean_lxml)
+    c = factory.create_chapter_from_string(PARITY_CORPUS[2])
+    assert c.title == 't'
+    assert 'xmlns="http://www.w3.org/1999/xhtml"' in c.content
+
+
+def test_lxml_engine_title():
+    factory = html2epub.chapter.ChapterFactory(engine='lxml')
+    assert factory.create_chapter_from_string(PARITY_CORPUS[2]).title == 't'
+    assert factory.create_chapter_from_string(
+        PARITY_CORPUS[1]).title == 'Ebook Chapter'
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        html2epub.chapter.ChapterFactory(engine='html5lib')
+
+
+def _text(xhtml_string):
+    return re.sub(r'\s+', '', BeautifulSoup(xhtml_string, 'html.parser').get_text())
+
+
+def test_unwrap_keeps_text_in_order():
+    html_string = '<html><body><div>a<custom>b<p>c</p>d</custom>e<nav>f</nav>g</div></body></html>'
+    assert _text(clean.clean(html_string)) == 'abcdefg'
+    assert _text(clean.clean_lxml(html_string)) == 'abcdefg'
+
+
+@pytest.mark.parametrize('engine', ['bs4', 'lxml'])
+def test_drop_selectors(engine):
+    policy = clean.SanitizerPolicy(drop_selectors=['nav', '.ad', '#comments'])
+    # 编译过的选择器不会被pickle
+    policy = pickle.loads(pickle.dumps(policy))
+    html_string = ('<html><body><nav><a href="/">home</a></nav><p>a<span class="ad">buy</span>b</p>'
+                   '<div id="comments"><p>spam</p></div><script>x()</script><p>c</p></body></html>')
+    c = html2epub.chapter.ChapterFactory(policy, engine=engine).create_chapter_from_string(
+        html_string, title='t')
+    assert _text(c.content) == 'abc'
+    assert pickle.loads(pickle.dumps(policy)).drop_selectors == policy.drop_selectors
+
+
+@pytest.mark.parametrize('html_string', PARITY_CORPUS[1:])
+def test_compact_serialization_matches_pretty(html_string):
+    pretty = html2epub.chapter.ChapterFactory().create_chapter_from_string(
+        html_string, title='t')
+    compact = html2epub.chapter.ChapterFactory(compact=True).create_chapter_from_string(
+        html_string, title='t')
+    assert '\n ' not in compact.content
+    assert len(compact.content) < len(pretty.content)
+    assert _canonical_xhtml(compact.content) == _canonical_xhtml(pretty.content)
+
+
+def test_serializer_closes_singletons():
+    html_string = '<p>a <br> b<img src="x.png"></p><pre> c\n  d</pre>'
+    for compact in (False, True):
+        xhtml = clean.html_to_xhtml(clean.clean(html_string), compact=compact)
+        assert '<br />' in xhtml and '<img src="x.png" />' in xhtml
+    xhtml = clean.html_to_xhtml(clean.clean(html_string, compact=True), compact=True)
+    assert '<p>a <br /> b<img src="x.png" /></p>' in xhtml
+    assert '<pre> c\n  d</pre>' in xhtml
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+import tempfile
+import zipfile
+
+import html2epub
+from html2epub import cli
+
+
+def test_build_single_book_from_files(tmp_path, capsys):
+    sources = []
+    for n in range(3):
+        path = tmp_path / ('%d.html' % n)
+        path.write_text('<html><head><title>c%d</title></head><body><p>%d</p></body></html>' % (n, n))
+        sources.append(str(path))
+    code = cli.main(['build', '-t', 'Book', '-o', str(tmp_path / 'out')] + sources)
+    summary = json.loads(capsys.readouterr().out)
+    assert code == 0
+    book = summary['books'][0]
+    assert book['chapters'] == 3
+    with zipfile.ZipFile(book['path']) as z:
+        assert z.namelist()[0] == 'mimetype'
+        assert 'OEBPS/2.xhtml' in z.namelist()
+
+
+def test_batch_manifest_reports_failures(tmp_path, http_server, capsys):
+    for n in range(4):
+        (http_server.root / ('%d.html' % n)).write_text(
+            '<html><head><title>c%d</title></head><body><p>%d</p></body></html>' % (n, n))
+    url = http_server.base_url
+    manifest = {'output_directory': str(tmp_path / 'out'), 'books': [
+        {'title': 'A', 'chapters': [url + '0.html', {'url': url + '1.html', 'title': 'one'}]},
+        {'title': 'B', 'name': 'bee', 'chapters': [url + '2.html', str(tmp_path / 'missing.html'),
+                                                   url + '3.html']},
+        {'title': 'C', 'chapters': []},
+    ]}
+    (tmp_path / 'manifest.json').write_text(json.dumps(manifest))
+    code = cli.main(['batch', str(tmp_path / 'manifest.json'), '--jobs', '2',
+                     '--cache-dir', str(tmp_path / 'cache'), '--cache-ttl', '3600'])
+    summary = json.loads(capsys.readouterr().out)
+    assert code == 1
+    assert (summary['built'], summary['failed'], summary['failed_chapters']) == (2, 1, 1)
+    a, b, c = summary['books']
+    assert a['chapters'] == 2 and a['stats']['counters']['chapters_added'] == 2
+    assert b['path'].endswith('bee.epub') and b['chapters'] == 2
+    assert b['failed_chapters'][0]['index'] == 1
+    assert c['path'] is None and 'error' in c
+
+
+def test_build_dir_resumes_interrupted_build(tmp_path, capsys):
+    sources = []
+    for n in range(3):
+        path = tmp_path / ('%d.html' % n)
+        path.write_text('<html><head><title>c%d</title></head><body><p>%d</p></body></html>' % (n, n))
+        sources.append(str(path))
+    # 上一次运行在写完第一章之后中断
+    build_dir = tmp_path / 'build' / 'Book'
+    epub = html2epub.Epub('Book', build_dir=str(build_dir))
+    epub.add_chapter(html2epub.create_chapter_from_file(sources[0]), cli._chapter_key(0, sources[0]))
+    del epub
+
+    code = cli.main(['build', '-t', 'Book', '-o', str(tmp_path / 'out'),
+                     '--build-dir', str(tmp_path / 'build')] + sources)
+    book = json.loads(capsys.readouterr().out)['books'][0]
+    assert code == 0
+    assert book['chapters'] == 3
+    assert book['stats']['counters']['chapters_resumed'] == 1
+    assert book['stats']['counters']['chapters_created'] == 2
+    assert not build_dir.exists()
+    with zipfile.ZipFile(book['path']) as z:
+        toc = z.read('OEBPS/toc.html').decode('utf-8')
+    assert toc.index('c0') < toc.index('c1') < toc.index('c2')
+
+
+def test_failed_books_remove_their_staging_directory(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    (tmp_path / 'tmp').mkdir()
+    code = cli.main(['build', '-t', 'Book', '-o', str(tmp_path / 'out'),
+                     str(tmp_path / 'missing.html')])
+    book = json.loads(capsys.readouterr().out)['books'][0]
+    assert code == 1 and book['path'] is None
+    assert list((tmp_path / 'tmp').iterdir()) == []
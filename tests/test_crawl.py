@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import html2epub
+from html2epub import crawl
+
+
+class _ListAdapter(crawl.SelectorAdapter):
+    # 测试服务器忽略查询参数, 每一页放在单独的文件中
+    def page_url(self, index_url, page_number):
+        return index_url.replace('list-1.html', 'list-%d.html' % page_number)
+
+
+def _write_site(root, pages, per_page):
+    # 从新到旧排列: 第1页是最新的章节
+    total = pages * per_page
+    for page in range(1, pages + 1):
+        links = ''.join(
+            '<li><a class="chapter" href="c%d.html#top">第%d章</a></li>' % (n, n)
+            for n in range(total - (page - 1) * per_page - 1, total - page * per_page - 1, -1))
+        # 每页都有一个重复的链接和一个不是章节的链接
+        links += '<li><a class="chapter" href="c0.html">第0章</a><a class="chapter" href="x.html">公告</a></li>'
+        (root / ('list-%d.html' % page)).write_text(
+            '<html><head><title>Book</title></head><body><span title="共 %d 页"></span>'
+            '<ul>%s</ul></body></html>' % (pages, links), encoding='utf-8')
+    for n in range(total):
+        (root / ('c%d.html' % n)).write_text(
+            '<html><head><title>c%d</title></head><body><p>%d</p></body></html>' % (n, n))
+    return total
+
+
+def test_crawler_orders_and_deduplicates(http_server):
+    total = _write_site(http_server.root, pages=6, per_page=5)
+    adapter = _ListAdapter('a.chapter', link_text_pattern=r'^第', page_count_selector='span[title]',
+                           reverse=True)
+    index = html2epub.Crawler(adapter, max_workers=3).open(http_server.base_url + 'list-1.html')
+    assert (index.title, index.page_count) == ('Book', 6)
+    links = list(index)
+    assert [link.url for link in links] == [
+        http_server.base_url + 'c%d.html' % n for n in range(total)]
+    assert links[1].title == '第1章'
+    # 第一页不会被重复请求
+    pages = [path for path, _ in http_server.requests if path.startswith('/list-')]
+    assert sorted(pages) == ['/list-%d.html' % n for n in range(1, 7)]
+
+
+def test_crawler_streams_into_chapter_factory(http_server):
+    total = _write_site(http_server.root, pages=3, per_page=4)
+    adapter = _ListAdapter('a.chapter', link_text_pattern=r'^第', page_count_selector='span[title]',
+                           reverse=True)
+    crawler = html2epub.Crawler(adapter)
+    title, chapters = crawler.chapters(http_server.base_url + 'list-1.html', max_workers=4)
+    assert title == 'Book'
+    assert [c.title for c in chapters] == ['第%d章' % n for n in range(total)]
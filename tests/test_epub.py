@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import io
+import warnings
+import zipfile
+
+import pytest
+
+import html2epub
+from html2epub import epub as epub_module
+
+CHAPTER = '<html><head><title>%s</title></head><body><p>text</p><img src="%s"></body></html>'
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+
+
+class _UnseekableStream(io.RawIOBase):
+    """
+    只能写入的文件对象, 模拟HTTP响应等不能 seek 的输出.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def _check_epub(data, chapter_count):
+    z = zipfile.ZipFile(io.BytesIO(data))
+    assert z.testzip() is None
+    first = z.infolist()[0]
+    assert first.filename == 'mimetype'
+    assert first.compress_type == zipfile.ZIP_STORED
+    assert z.read('mimetype') == b'application/epub+zip'
+    names = z.namelist()
+    for n in range(chapter_count):
+        assert 'OEBPS/%d.xhtml' % n in names
+    for name in ('META-INF/container.xml', 'OEBPS/toc.html', 'OEBPS/toc.ncx', 'OEBPS/content.opf'):
+        assert name in names
+    return z
+
+
+def test_create_epub_from_directory(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    epub = html2epub.Epub('Book')
+    epub.add_chapter(html2epub.create_chapter_from_string(
+        CHAPTER % ('one', tmp_path / 'a.png')))
+    epub_path = epub.create_epub(str(tmp_path))
+    assert epub_path == str(tmp_path / 'Book.epub')
+    with open(epub_path, 'rb') as f:
+        z = _check_epub(f.read(), 1)
+    assert len([n for n in z.namelist() if n.startswith('OEBPS/images/')]) == 1
+
+
+def test_stream_epub_to_file_objects(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    for output in (io.BytesIO(), _UnseekableStream()):
+        epub = html2epub.Epub('Book', output=output)
+        for title in ('one', 'two'):
+            epub.add_chapter(html2epub.create_chapter_from_string(
+                CHAPTER % (title, tmp_path / 'a.png')))
+        assert epub.create_epub() is output
+        data = output.getvalue() if isinstance(output, io.BytesIO) else output.buffer.getvalue()
+        z = _check_epub(data, 2)
+        assert len([n for n in z.namelist() if n.startswith('OEBPS/images/')]) == 1
+
+
+def _unescape_entries(epub_path, old, new):
+    """
+    模拟旧版本生成的没有转义的 content.opf 和 toc.html.
+    """
+    with zipfile.ZipFile(epub_path) as z:
+        entries = [(info, z.read(info)) for info in z.infolist()]
+    with zipfile.ZipFile(epub_path, 'w') as z:
+        for info, data in entries:
+            if info.filename in ('OEBPS/content.opf', 'OEBPS/toc.html'):
+                data = data.replace(old, new)
+            z.writestr(info, data)
+
+
+def test_open_reads_unescaped_ampersands_from_older_versions(tmp_path):
+    epub = html2epub.Epub('Old & Book')
+    epub.add_chapter(html2epub.chapter.Chapter('<p>hi</p>', 'Ch 1 & more'))
+    epub_path = epub.create_epub(str(tmp_path))
+    _unescape_entries(epub_path, b'&amp;', b'&')
+
+    epub = html2epub.Epub.open(epub_path)
+    assert epub.title == 'Old & Book'
+    epub.add_chapter(html2epub.chapter.Chapter('<p>two</p>', 'Ch 2 &copy;'))
+    epub.create_epub()
+    with zipfile.ZipFile(epub_path) as z:
+        assert '<dc:title>Old &amp; Book</dc:title>' in z.read('OEBPS/content.opf').decode('utf-8')
+        toc = z.read('OEBPS/toc.html').decode('utf-8')
+    assert 'Ch 1 &amp; more' in toc and 'Ch 2 &amp;copy;' in toc
+
+    # 其它无法解析的内容不会被猜测修复
+    _unescape_entries(epub_path, b'Ch 2 &amp;copy;', b'Ch 2 <c>')
+    with pytest.raises(ValueError):
+        html2epub.Epub.open(epub_path)
+
+
+def _records(count):
+    return [epub_module._ChapterRecord('c%d' % n, '%d.xhtml' % n, 'chapter_%d' % n,
+                                       [{'link': 'images/%d.png' % n, 'id': 'image_%d' % n,
+                                         'type': 'png'}])
+            for n in range(count)]
+
+
+def test_opf_streams_many_chapters(tmp_path):
+    opf = epub_module.ContentOpf('Book', uid='uid', date='01-01-2020')
+    records = _records(2000)
+    opf.add_chapters(records)
+    chunks = list(opf.generate())
+    assert len(chunks) > 2000
+    assert ''.join(chunks) == opf.content
+    # chapters 在 manifest 和 spine 中各遍历一次, 结果与一次性生成的列表相同
+    template = epub_module._get_template(opf.template_file)
+    expected = template.render(
+        chapters=[{'id': n, 'link': epub_module._chapter_link(n), 'imgs': record.imgs}
+                  for n, record in enumerate(records)],
+        **opf.non_chapter_parameters)
+    assert opf.content == expected
+    assert opf.content.count('<itemref ') == 2001
+    assert opf.content.count('media-type="image/png"') == 2000
+
+    opf.write(str(tmp_path / 'content.opf'))
+    assert (tmp_path / 'content.opf').read_text(encoding='utf-8') == expected
+    output = io.BytesIO()
+    epub_archive = html2epub.archive.EpubArchive(output)
+    epub_archive.write_chunks('OEBPS/content.opf', opf.generate(), buffer_size=100)
+    epub_archive.close()
+    with zipfile.ZipFile(output) as z:
+        assert z.read('OEBPS/content.opf').decode('utf-8') == expected
+
+
+def test_templates_are_compiled_once(monkeypatch):
+    epub_module._get_template.cache_clear()
+    compiled = []
+    from_string = epub_module._template_environment.from_string
+
+    def counting_from_string(source):
+        compiled.append(source)
+        return from_string(source)
+    monkeypatch.setattr(epub_module._template_environment, 'from_string', counting_from_string)
+    for _ in range(3):
+        opf = epub_module.ContentOpf('Book')
+        opf.add_chapters(_records(2))
+        toc = epub_module.TocHtml()
+        toc.add_chapters(_records(2))
+        assert opf.content and toc.content
+    assert len(compiled) == 2
+
+
+def test_added_chapters_are_kept_as_records(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    epub = html2epub.Epub('Book', epub_dir=str(tmp_path / 'book'))
+    c = html2epub.create_chapter_from_string(CHAPTER % ('one', tmp_path / 'a.png'))
+    assert c._content_tree is not None
+    epub.add_chapter(c)
+    # 解析树在写入后释放, 书中只保留目录和opf需要的信息
+    assert c._content_tree is None
+    assert 'src="images/' in c.content
+    record = epub.chapters[0]
+    assert type(record) is html2epub.epub._ChapterRecord
+    assert (record.title, record.link) == ('one', '0.xhtml')
+    assert [img.link for img in record.imgs] == [img['link'] for img in c.imgs]
+    assert not hasattr(record, 'content')
+
+
+def test_create_epub_closes_only_its_own_session(tmp_path, monkeypatch):
+    closed = []
+    shared = html2epub.Session()
+    for session in (None, shared):
+        epub = html2epub.Epub('Book', session=session)
+        monkeypatch.setattr(epub.session, 'close', lambda: closed.append(session))
+        epub.add_chapter(html2epub.chapter.Chapter('<p>hi</p>', 'one'))
+        epub.create_epub(str(tmp_path))
+    assert closed == [None]
+
+
+def test_append_chapters_to_existing_epub(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    (tmp_path / 'b.png').write_bytes(PNG + b'b')
+    epub = html2epub.Epub('Book', creator='someone')
+    epub.add_chapter(html2epub.create_chapter_from_string(
+        CHAPTER % ('one', tmp_path / 'a.png')))
+    epub_path = epub.create_epub(str(tmp_path))
+    with zipfile.ZipFile(epub_path) as z:
+        original = {info.filename: (info.CRC, info.compress_size) for info in z.infolist()}
+        original_chapter = z.read('OEBPS/0.xhtml')
+
+    epub = html2epub.Epub.open(epub_path)
+    for title, image in (('two', 'a.png'), ('three', 'b.png')):
+        epub.add_chapter(html2epub.create_chapter_from_string(
+            CHAPTER % (title, tmp_path / image)))
+    assert epub.create_epub() == epub_path
+
+    with open(epub_path, 'rb') as f:
+        z = _check_epub(f.read(), 3)
+    assert z.read('OEBPS/0.xhtml') == original_chapter
+    for info in z.infolist():
+        if info.filename in original and not info.filename.endswith(('toc.html', 'toc.ncx', '.opf')):
+            assert (info.CRC, info.compress_size) == original[info.filename]
+    # 第二章的图片与第一章相同, 不会重复保存
+    assert len([n for n in z.namelist() if n.startswith('OEBPS/images/')]) == 2
+    opf = z.read('OEBPS/content.opf').decode('utf-8')
+    assert opf.count('media-type="image/png"') == 2
+    assert 'someone' in opf
+    toc = z.read('OEBPS/toc.html').decode('utf-8')
+    assert toc.index('one') < toc.index('two') < toc.index('three')
+
+
+def test_open_reads_escaped_metadata_and_keeps_options(tmp_path):
+    epub = html2epub.Epub('Tom & Jerry <1>', creator='someone')
+    epub.add_chapter(html2epub.chapter.Chapter('<p>hi</p>', 'A & B'))
+    epub_path = epub.create_epub(str(tmp_path))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        epub = html2epub.Epub.open(epub_path, compress_level=0, max_image_bytes=10)
+    assert epub.title == 'Tom & Jerry <1>'
+    assert [record.title for record in epub.chapters] == ['A & B']
+    assert epub.image_budget.max_image_bytes == 10
+    epub.create_epub()
+    with zipfile.ZipFile(epub_path) as z:
+        info = z.getinfo('OEBPS/toc.html')
+        assert info.compress_size >= info.file_size
+
+
+def test_resume_interrupted_build(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    (tmp_path / 'b.png').write_bytes(PNG + b'b')
+    build_dir = tmp_path / 'build'
+    epub = html2epub.Epub('Book', build_dir=str(build_dir))
+    for title in ('one', 'two'):
+        epub.add_chapter(html2epub.create_chapter_from_string(
+            CHAPTER % (title, tmp_path / 'a.png')), key=title)
+    # 模拟在第三章写到一半时中断: 章节文件, 图片和日志的最后一行都只写了一部分
+    (build_dir / 'OEBPS' / '2.xhtml').write_text('<html')
+    (build_dir / 'OEBPS' / 'images' / 'orphan.png').write_bytes(PNG)
+    with open(str(build_dir / '.html2epub-journal'), 'a') as f:
+        f.write('{"key": "thr')
+    del epub
+
+    with pytest.raises(ValueError):
+        html2epub.Epub('Other Book', build_dir=str(build_dir))
+    epub = html2epub.Epub('Book', build_dir=str(build_dir))
+    assert [epub.has_chapter(key) for key in ('one', 'two', 'three')] == [True, True, False]
+    assert epub.stats.counters['chapters_resumed'] == 2
+    assert not (build_dir / 'OEBPS' / 'images' / 'orphan.png').exists()
+    for title, image in (('three', 'a.png'), ('four', 'b.png')):
+        epub.add_chapter(html2epub.create_chapter_from_string(
+            CHAPTER % (title, tmp_path / image)), key=title)
+    epub_path = epub.create_epub(str(tmp_path))
+    assert not build_dir.exists()
+
+    with open(epub_path, 'rb') as f:
+        z = _check_epub(f.read(), 4)
+    assert 'OEBPS/4.xhtml' not in z.namelist()
+    # 恢复前后的图片按url和内容去重
+    assert len([n for n in z.namelist() if n.startswith('OEBPS/images/')]) == 2
+    toc = z.read('OEBPS/toc.html').decode('utf-8')
+    assert toc.index('one') < toc.index('two') < toc.index('three') < toc.index('four')
+
+
+def test_build_dir_requires_chapter_keys(tmp_path):
+    epub = html2epub.Epub('Book', build_dir=str(tmp_path / 'build'))
+    with pytest.raises(ValueError):
+        epub.add_chapter(html2epub.create_chapter_from_string('<p>a</p>'))
+    epub.add_chapter(html2epub.create_chapter_from_string('<p>a</p>', url='http://example.com/a'))
+    assert epub.has_chapter('http://example.com/a') and not epub.has_chapter(None)
+
+
+def test_build_dir_must_be_empty_or_a_build(tmp_path):
+    (tmp_path / 'notes.txt').write_text('keep')
+    with pytest.raises(ValueError):
+        html2epub.Epub('Book', build_dir=str(tmp_path))
+    assert (tmp_path / 'notes.txt').exists()
+
+
+def test_compression_method_per_entry(tmp_path):
+    (tmp_path / 'a.png').write_bytes(PNG)
+    text = '<p>%s</p>' % ('lorem ipsum ' * 2000)
+    for output in (None, io.BytesIO()):
+        epub = html2epub.Epub('Book', output=output, compress_workers=4)
+        for title in ('one', 'two', 'three'):
+            epub.add_chapter(html2epub.create_chapter_from_string(
+                (CHAPTER % (title, tmp_path / 'a.png')).replace('<p>text</p>', text)))
+        epub_path = epub.create_epub(str(tmp_path))
+        if output is None:
+            with open(epub_path, 'rb') as f:
+                data = f.read()
+        else:
+            data = output.getvalue()
+        z = _check_epub(data, 3)
+        infos = {info.filename: info for info in z.infolist()}
+        images = [info for name, info in infos.items() if name.startswith('OEBPS/images/')]
+        assert [info.compress_type for info in images] == [zipfile.ZIP_STORED]
+        chapter = infos['OEBPS/0.xhtml']
+        assert chapter.compress_type == zipfile.ZIP_DEFLATED
+        assert chapter.compress_size < chapter.file_size / 10
+        assert text.split()[1] in z.read('OEBPS/2.xhtml').decode('utf-8')
+        assert z.namelist().index('META-INF/container.xml') < z.namelist().index('OEBPS/0.xhtml')
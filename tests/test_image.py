@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import io
+import zipfile
+
+import pytest
+
+import html2epub
+
+PIL_Image = pytest.importorskip('PIL.Image')
+
+
+def _png(size, mode='RGB'):
+    output = io.BytesIO()
+    PIL_Image.new(mode, size, (200, 30, 30, 128)[:len(mode)]).save(output, 'PNG')
+    return output.getvalue()
+
+
+def test_optimizer_downscales_and_converts():
+    optimizer = html2epub.ImageOptimizer(max_dimension=100, convert={'png': 'jpeg'})
+    content, image_type = optimizer(_png((400, 200), 'RGBA'), 'png')
+    assert image_type == 'jpeg'
+    image = PIL_Image.open(io.BytesIO(content))
+    assert image.format == 'JPEG'
+    assert image.size == (100, 50)
+
+
+def test_optimizer_keeps_original_when_nothing_to_gain():
+    optimizer = html2epub.ImageOptimizer(max_dimension=1000)
+    original = _png((10, 10))
+    assert optimizer(original, 'png') == (original, 'png')
+    assert optimizer(b'not an image', 'png') == (b'not an image', 'png')
+
+
+def test_optimizer_keeps_original_when_encoding_fails(tmp_path, monkeypatch):
+    output = io.BytesIO()
+    PIL_Image.new('CMYK', (20, 20), (0, 255, 255, 0)).save(output, 'JPEG')
+    cmyk = output.getvalue()
+    # PNG 不支持 CMYK
+    optimizer = html2epub.ImageOptimizer(convert={'jpeg': 'png'})
+    assert optimizer(cmyk, 'jpeg') == (cmyk, 'jpeg')
+
+    (tmp_path / 'a.jpg').write_bytes(cmyk)
+    c = html2epub.create_chapter_from_string(
+        '<html><body><img src="%s"></body></html>' % (tmp_path / 'a.jpg'), title='1')
+    epub = html2epub.Epub('t', epub_dir=str(tmp_path / 'book'), image_optimizer=optimizer)
+    epub.add_chapter(c)
+    assert [img['type'] for img in c.imgs] == ['jpeg']
+    assert 'src="images/' in c.content
+
+    # Pillow 没有该格式的编码器时 save 触发 KeyError
+    png = _png((400, 200))
+
+    def save(self, fp, format=None, **params):
+        raise KeyError(format)
+    monkeypatch.setattr(PIL_Image.Image, 'save', save)
+    assert html2epub.ImageOptimizer(max_dimension=100)(png, 'png') == (png, 'png')
+
+
+def test_optimized_images_in_epub(tmp_path):
+    (tmp_path / 'big.png').write_bytes(_png((300, 300)))
+    html_string = '<html><body><img src="%s"></body></html>' % (tmp_path / 'big.png')
+    output = io.BytesIO()
+    epub = html2epub.Epub('t', output=output, image_optimizer=html2epub.ImageOptimizer(
+        max_dimension=64, convert={'png': 'jpeg'}))
+    epub.add_chapter(html2epub.create_chapter_from_string(html_string, title='1'))
+    epub.create_epub()
+    with zipfile.ZipFile(output) as z:
+        images = [name for name in z.namelist() if name.startswith('OEBPS/images/')]
+        assert len(images) == 1 and images[0].endswith('.jpeg')
+        assert PIL_Image.open(io.BytesIO(z.read(images[0]))).size == (64, 64)
+        opf = z.read('OEBPS/content.opf').decode('utf-8')
+        assert 'media-type="image/jpeg"' in opf
+        assert images[0][len('OEBPS/'):] in z.read('OEBPS/0.xhtml').decode('utf-8')
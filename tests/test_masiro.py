@@ -32,26 +32,20 @@ html_template = """
 """
 
 
+class MasiroAdapter(html2epub.SelectorAdapter):    # 论坛版块的目录: 章节排序反向, 总页数在 "共 N 页" 中
+    def __init__(self):
+        super(MasiroAdapter, self).__init__(
+            'a.s.xst', link_text_pattern=r"^[\d]|第", page_count_selector='span[title^="共"]',
+            reverse=True)
+
+    def page_url(self, index_url, page_number):
+        return index_url + "&page={}".format(page_number)
+
+
 def getInfoList(URL):    # 获取所有章节网页地址和数名
-    totalPage = 1    # 该书总页数, 默认为一
-
-    r = requests.request('GET', URL)  # 获取主网页
-
-    soup = BeautifulSoup(r.text, 'html.parser')
-    infoList = []    # 储存所有章节地址
-    pageTag = soup.find('span', title=re.compile(r"^共"))    # 获取总页数
-    bookName = soup.title.string  # 获取书名
-    bookName = re.sub(r'[\/:*?"<>|]', '-', bookName)
-    if(pageTag):     # 如果只有一页的话是没有总页数的, 此时总页数为默认的1
-        totalPage = int(pageTag['title'].split(' ')[1])
-    for i in range(totalPage, 0, -1):     # 从所有网页获取全部章节, 由于章节排序反向, 所以页面反序
-        url = URL + "&page={}".format(i)    # 按页数获取页面网址
-        r = requests.request('GET', url)
-        soup = BeautifulSoup(r.text, 'html.parser')
-        tag = soup.findAll('a', class_="s xst",
-                           text=re.compile(r"^[\d]|第"))  # 匹配章节网址
-        for j in range(len(tag) - 1, -1, -1):     # 反向存如章节网址
-            infoList.append(tag[j]['href'])
+    index = html2epub.Crawler(MasiroAdapter()).open(URL)    # 获取主网页, 其余页面并发获取
+    bookName = re.sub(r'[\/:*?"<>|]', '-', index.title)
+    infoList = [link.url for link in index]    # 储存所有章节地址
     return infoList, bookName
 
 
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import email.utils
+import http.server
+import threading
+import time
+
+import pytest
+
+import html2epub
+from html2epub import scheduler
+
+
+class _RateLimitedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    模拟有限速的站点: 每 window 秒最多接受 limit 个请求, 超出的返回 429 和 server.retry_after.
+    每个请求处理 server.delay 秒, 并记录同时处理的最大请求数.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            now = time.monotonic()
+            while server.accepted and server.accepted[0] <= now - server.window:
+                server.accepted.popleft()
+            allowed = len(server.accepted) < server.limit
+            if allowed:
+                server.accepted.append(now)
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            else:
+                server.rejected += 1
+        if not allowed:
+            self.send_response(429)
+            if server.retry_after is not None:
+                self.send_header('Retry-After', server.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def limited_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RateLimitedHandler)
+    server.lock = threading.Lock()
+    server.accepted = collections.deque()
+    server.limit = 1000
+    server.window = 1.0
+    server.retry_after = None
+    server.delay = 0
+    server.active = server.max_active = server.rejected = 0
+    server.base_url = 'http://127.0.0.1:%d/' % server.server_port
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _fetch_all(session, urls):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return [response.status_code for response in executor.map(session.get, urls)]
+
+
+def test_token_bucket_stays_under_rate_limit(limited_server):
+    limited_server.limit, limited_server.window = 4, 0.25
+    urls = [limited_server.base_url + str(n) for n in range(6)]
+    assert 429 in _fetch_all(html2epub.Session(), urls)
+
+    time.sleep(limited_server.window)
+    limited_server.rejected = 0
+    fetch_scheduler = scheduler.FetchScheduler(rate=10, max_in_flight=8)
+    start = time.monotonic()
+    assert _fetch_all(html2epub.Session(scheduler=fetch_scheduler), urls) == [200] * 6
+    assert time.monotonic() - start >= 0.45
+    assert limited_server.rejected == 0
+
+
+def test_backs_off_and_honours_retry_after(limited_server):
+    limited_server.limit, limited_server.window = 1, 0.5
+    limited_server.retry_after = '1'
+    fetch_scheduler = scheduler.FetchScheduler(initial_in_flight=4, max_in_flight=4)
+    session = html2epub.Session(scheduler=fetch_scheduler)
+    start = time.monotonic()
+    assert _fetch_all(session, [limited_server.base_url + str(n) for n in range(3)]) == [200] * 3
+    assert time.monotonic() - start >= 1
+    assert fetch_scheduler.throttled['127.0.0.1:%d' % limited_server.server_port] >= 1
+    assert fetch_scheduler.limit(limited_server.base_url) < 4
+
+
+def test_max_in_flight_per_host(limited_server):
+    limited_server.delay = 0.05
+    fetch_scheduler = scheduler.FetchScheduler(max_in_flight=2)
+    session = html2epub.Session(scheduler=fetch_scheduler)
+    assert _fetch_all(session, [limited_server.base_url + str(n) for n in range(8)]) == [200] * 8
+    assert limited_server.max_active == 2
+
+
+def test_permanently_rate_limited_chapter_is_an_error(limited_server):
+    limited_server.limit = 0
+    fetch_scheduler = scheduler.FetchScheduler(max_retries=2, backoff=0.01)
+    factory = html2epub.chapter.ChapterFactory(
+        session=html2epub.Session(scheduler=fetch_scheduler))
+    errors = []
+    url = limited_server.base_url + 'chapter.html'
+    assert list(factory.create_chapters_from_urls([url], errors=errors)) == []
+    assert [(index, item) for index, item, _ in errors] == [(0, url)]
+    assert '429' in str(errors[0][2])
+    assert limited_server.rejected == 3
+
+
+class _Response():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+def test_concurrency_adapts_to_latency_and_throttling():
+    fetch_scheduler = scheduler.FetchScheduler(initial_in_flight=1, max_in_flight=4,
+                                               target_latency=1)
+    url = 'http://example.com/a'
+    for _ in range(10):
+        fetch_scheduler.request(lambda: _Response(200), url)
+    assert fetch_scheduler.limit(url) == 4
+    responses = iter([_Response(429, {'Retry-After': '0'}), _Response(200)])
+    assert fetch_scheduler.request(lambda: next(responses), url).status_code == 200
+    assert fetch_scheduler.limit(url) == 2
+    # 其它站点不受影响
+    assert fetch_scheduler.limit('http://example.org/') == 1
+
+
+def test_parse_retry_after():
+    assert scheduler._parse_retry_after('3') == 3
+    assert scheduler._parse_retry_after('soon') is None
+    assert scheduler._parse_retry_after(None) is None
+    later = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < scheduler._parse_retry_after(later) <= 60
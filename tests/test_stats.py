@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import html2epub
+from html2epub import chapter
+from html2epub import constants
+
+
+def test_stage_histogram_buckets():
+    stats = html2epub.BuildStats()
+    stats.record('fetch', 0.001)
+    stats.record('fetch', 0.3)
+    stats.record('fetch', 1000)
+    fetch = stats.as_dict()['stages']['fetch']
+    assert fetch['count'] == 3
+    assert fetch['max'] == 1000
+    assert fetch['histogram']['<=0.005'] == 1
+    assert fetch['histogram']['<=0.5'] == 1
+    assert fetch['histogram']['>%g' % constants.LATENCY_BUCKETS[-1]] == 1
+
+
+def test_build_stats_and_events(http_server, tmp_path):
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+    (http_server.root / 'a.png').write_bytes(png)
+    (http_server.root / 'b.png').write_bytes(png)
+    page = '<html><head><title>%d</title></head><body><p>x</p>' \
+        '<img src="a.png"><img src="b.png"><img src="a.png"></body></html>'
+    for n in range(2):
+        (http_server.root / ('%d.html' % n)).write_text(page % n)
+    events = []
+    stats = html2epub.BuildStats(callback=lambda event, fields: events.append((event, fields)))
+    factory = chapter.ChapterFactory(stats=stats)
+    epub = html2epub.Epub('t', stats=stats)
+    chapters = list(factory.create_chapters_from_urls(
+        [http_server.base_url + '%d.html' % n for n in range(2)]))
+    for c in chapters:
+        epub.add_chapter(c)
+    epub.create_epub(str(tmp_path))
+
+    result = stats.as_dict()
+    for stage in ('fetch', 'sanitize', 'xhtml', 'chapter', 'images', 'write',
+                  'add_chapter', 'package'):
+        assert result['stages'][stage]['count'] >= 1
+    counters = result['counters']
+    assert counters['chapters_created'] == 2
+    assert counters['chapters_added'] == 2
+    # 两章网页和 a.png, b.png 各请求一次
+    assert counters['requests'] == 4
+    assert counters['bytes_fetched'] > 2 * len(png)
+    assert counters['images_downloaded'] == 2
+    # 第一章中 b.png 与 a.png 内容相同, 第二个 a.png 与第一个相同; 第二章的三张图片都已保存过
+    assert counters['images_deduped'] == 5
+    assert [event for event, _ in events] == [
+        'chapter_created', 'chapter_created', 'chapter_added', 'chapter_added', 'epub_created']
+    assert events[2][1]['images'] == 1